@@ -105,7 +105,7 @@ USERS = {
         'uid':
         20131,
         'groups': ('presencesync_cacheserver', 'presencesync_public',
-                   'udb_public', 'mdb_public')
+                   'udb_public', 'mdb_public', 'mdbsync_public')
     },
     'concours': {
         'uid': 20150,
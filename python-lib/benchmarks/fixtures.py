@@ -0,0 +1,45 @@
+# This file is part of Prologin-SADM.
+#
+# Prologin-SADM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Prologin-SADM is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Prologin-SADM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Synthetic data shared by the benchmarks."""
+
+import random
+
+ROOMS = ['pasteur', 'alt', 'cluster', 'other']
+
+
+def mdb_machine(i, rng=random):
+    """Return a machine record like MDB `Machine.to_dict` does."""
+    room = ROOMS[i % len(ROOMS)]
+    return {
+        'hostname': '{}-r{:02}p{:02}'.format(room, i // 40, i % 40),
+        'aliases': 'alias{}'.format(i) if i % 10 == 0 else '',
+        'ip': '192.168.{}.{}'.format(1 + i // 250, 1 + i % 250),
+        'mac': ':'.join('{:02x}'.format(rng.randrange(256))
+                        for _ in range(6)),
+        'rfs': i % 4,
+        'hfs': i % 8,
+        'mtype': 'user' if i % 20 else 'orga',
+        'room': room,
+        'is_faulty': rng.random() < 0.01,
+    }
+
+
+def mdb_backlog(n=1000, seed=42):
+    """Return a realistic MDB backlog of `n` machines, always the same for a
+    given `seed`.
+    """
+    rng = random.Random(seed)
+    return [mdb_machine(i, rng) for i in range(n)]
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+
+# This file is part of Prologin-SADM.
+#
+# Prologin-SADM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Prologin-SADM is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Prologin-SADM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""JSON codec microbenchmark on a realistic MDB backlog.
+
+Compare the JSON backends that are installed on the operations of the
+synchronisation and RPC hot paths: sending the backlog to a new subscriber,
+publishing single updates, decoding them on the client side, and encoding
+and decoding a `query` response. Time is the best of several runs, in
+milliseconds per operation:
+
+    python3 benchmarks/json_codec.py --machines 1000
+"""
+
+import argparse
+import json
+import timeit
+
+import prologin.jsoncodec
+from prologin.synchronisation import items_to_updates
+from prologin.rpc import encoding
+
+from fixtures import mdb_backlog
+
+
+def backends():
+    """Return the (name, dumps, loads) of each available backend."""
+    found = [('json', lambda o: json.dumps(o).encode(), json.loads)]
+    try:
+        import orjson
+        found.append(('orjson', orjson.dumps, orjson.loads))
+    except ImportError:
+        pass
+    return found
+
+
+def best_of(func, number, repeat):
+    """Return the best time of `func` in milliseconds per call."""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the JSON backends on an MDB backlog')
+    parser.add_argument('--machines', type=int, default=1000,
+                        help='number of machines in the backlog')
+    parser.add_argument('--number', type=int, default=20,
+                        help='number of operations per run')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of runs (the best one is kept)')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    opts = parser.parse_args()
+
+    backlog = mdb_backlog(opts.machines)
+    backlog_msg = items_to_updates(backlog)
+    update_msgs = [[update] for update in backlog_msg]
+
+    results = []
+    print('{:<8} {:>13} {:>13} {:>13} {:>13}'.format(
+        'backend', 'backlog dump', 'backlog load', 'updates dump',
+        'updates load'))
+    for name, dumpb, loads in backends():
+        encoded = dumpb(backlog_msg)
+        encoded_updates = [dumpb(u) for u in update_msgs]
+        result = {
+            'backend': name,
+            'backlog_dump_ms': best_of(lambda: dumpb(backlog_msg),
+                                       opts.number, opts.repeat),
+            'backlog_load_ms': best_of(lambda: loads(encoded),
+                                       opts.number, opts.repeat),
+            'updates_dump_ms': best_of(
+                lambda: [dumpb(u) for u in update_msgs],
+                opts.number, opts.repeat),
+            'updates_load_ms': best_of(
+                lambda: [loads(u) for u in encoded_updates],
+                opts.number, opts.repeat),
+        }
+        results.append(result)
+        print('{backend:<8} {backlog_dump_ms:>13.3f} {backlog_load_ms:>13.3f} '
+              '{updates_dump_ms:>13.3f} {updates_load_ms:>13.3f}'
+              .format(**result))
+
+    # What the RPC library actually does with the selected backend.
+    response = {'type': 'result', 'data': backlog}
+    body = encoding.encode(response, encoding.JSON)
+    rpc = {
+        'backend': prologin.jsoncodec.BACKEND,
+        'encode_ms': best_of(lambda: encoding.encode(response, encoding.JSON),
+                             opts.number, opts.repeat),
+        'decode_ms': best_of(lambda: encoding.decode(body, encoding.JSON),
+                             opts.number, opts.repeat),
+    }
+    print('rpc query response with {backend}: encode {encode_ms:.3f} ms, '
+          'decode {decode_ms:.3f} ms'.format(**rpc))
+
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump({'machines': opts.machines, 'backends': results,
+                       'rpc': rpc}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
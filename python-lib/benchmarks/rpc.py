@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+
+# This file is part of Prologin-SADM.
+#
+# Prologin-SADM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Prologin-SADM is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Prologin-SADM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""RPC throughput and latency benchmark.
+
+Start an in-process RPC server and drive it with concurrent clients, for
+every combination of payload size, concurrency, authentication and client
+kind (async Client or SyncClient). Report the call rate and the p50/p99
+latencies, and optionally write the results as JSON to compare runs:
+
+    python3 benchmarks/rpc.py --calls 5000 --output before.json
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import itertools
+import json
+import logging
+import platform
+import socket
+import sys
+import threading
+import time
+
+import prologin.config
+import prologin.rpc.client
+import prologin.rpc.server
+from prologin.rpc import encoding
+
+
+SECRET = b'benchmark'
+
+
+class BenchServer(prologin.rpc.server.BaseRPCApp):
+    @prologin.rpc.remote_method
+    async def echo(self, payload):
+        return payload
+
+    @prologin.rpc.remote_method(auth_required=False)
+    async def public_echo(self, payload):
+        return payload
+
+
+class BenchServerInstance(threading.Thread):
+    def __init__(self, port):
+        super().__init__(daemon=True)
+        self.port = port
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.app = BenchServer('bench-rpc', secret=SECRET, loop=self.loop)
+        self.app.run(host='127.0.0.1', port=self.port)
+
+    def wait_ready(self, timeout=10):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', self.port)).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        raise RuntimeError('benchmark server did not start')
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def percentile(values, p):
+    """Return the `p` percentile (nearest rank) of sorted `values`."""
+    if not values:
+        return None
+    rank = max(0, min(len(values) - 1, round(p / 100 * len(values)) - 1))
+    return values[rank]
+
+
+def split_calls(calls, concurrency):
+    """Split `calls` calls between `concurrency` callers."""
+    return [calls // concurrency + (i < calls % concurrency)
+            for i in range(concurrency)]
+
+
+async def run_async(url, secret, method, payload, concurrency, calls):
+    async def caller(count):
+        latencies = []
+        async with prologin.rpc.client.Client(url, secret) as client:
+            remote = getattr(client, method)
+            for _ in range(count):
+                start = time.perf_counter()
+                await remote(payload)
+                latencies.append(time.perf_counter() - start)
+        return latencies
+
+    results = await asyncio.gather(*(caller(count)
+                                     for count in split_calls(calls,
+                                                              concurrency)))
+    return list(itertools.chain.from_iterable(results))
+
+
+def run_sync(url, secret, method, payload, concurrency, calls):
+    def caller(count):
+        latencies = []
+        remote = getattr(prologin.rpc.client.SyncClient(url, secret), method)
+        for _ in range(count):
+            start = time.perf_counter()
+            remote(payload)
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        results = executor.map(caller, split_calls(calls, concurrency))
+        return list(itertools.chain.from_iterable(results))
+
+
+def run_scenario(url, client, auth, payload_size, concurrency, calls):
+    method = 'echo' if auth else 'public_echo'
+    secret = SECRET if auth else None
+    payload = 'x' * payload_size
+
+    if client == 'async':
+        def run(count):
+            loop = asyncio.new_event_loop()
+            try:
+                return loop.run_until_complete(run_async(
+                    url, secret, method, payload, concurrency, count))
+            finally:
+                loop.close()
+    else:
+        def run(count):
+            return run_sync(url, secret, method, payload, concurrency, count)
+
+    run(concurrency)  # Warm up connections and caches
+    start = time.perf_counter()
+    latencies = sorted(run(calls))
+    duration = time.perf_counter() - start
+
+    return {
+        'client': client,
+        'auth': auth,
+        'payload_size': payload_size,
+        'concurrency': concurrency,
+        'calls': len(latencies),
+        'duration': duration,
+        'calls_per_second': len(latencies) / duration,
+        'latency_p50_ms': percentile(latencies, 50) * 1000,
+        'latency_p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+
+def int_list(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the RPC library throughput and latency')
+    parser.add_argument('--port', type=int, default=42600,
+                        help='port of the benchmark server')
+    parser.add_argument('--calls', type=int, default=2000,
+                        help='number of calls per scenario')
+    parser.add_argument('--concurrency', type=int_list, default=[1, 8, 32],
+                        help='comma-separated numbers of concurrent clients')
+    parser.add_argument('--payload-sizes', type=int_list,
+                        default=[16, 1024, 64 * 1024],
+                        help='comma-separated payload sizes (in bytes)')
+    parser.add_argument('--clients', default='async,sync',
+                        help='comma-separated client kinds (async, sync)')
+    parser.add_argument('--auth', default='on,off',
+                        help='comma-separated auth modes (on, off)')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    opts = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    # Check timeauth tokens even without a configuration file.
+    prologin.config.loaded_configs.setdefault('timeauth', {'enabled': True})
+
+    server = BenchServerInstance(opts.port)
+    server.start()
+    server.wait_ready()
+    url = 'http://127.0.0.1:{}'.format(opts.port)
+
+    results = []
+    scenarios = itertools.product(
+        opts.clients.split(','),
+        [mode == 'on' for mode in opts.auth.split(',')],
+        opts.payload_sizes,
+        opts.concurrency)
+    print('{:<6} {:<5} {:>8} {:>5} {:>10} {:>9} {:>9}'.format(
+        'client', 'auth', 'payload', 'conc', 'calls/s', 'p50 ms', 'p99 ms'))
+    try:
+        for client, auth, payload_size, concurrency in scenarios:
+            result = run_scenario(url, client, auth, payload_size,
+                                  concurrency, opts.calls)
+            results.append(result)
+            print('{client:<6} {auth!s:<5} {payload_size:>8} '
+                  '{concurrency:>5} {calls_per_second:>10.1f} '
+                  '{latency_p50_ms:>9.2f} {latency_p99_ms:>9.2f}'
+                  .format(**result))
+            sys.stdout.flush()
+    finally:
+        server.stop()
+
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump({
+                'time': time.time(),
+                'python': platform.python_version(),
+                'encoding': encoding.supported()[0],
+                'results': results,
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+
+# This file is part of Prologin-SADM.
+#
+# Prologin-SADM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Prologin-SADM is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Prologin-SADM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compression of synchronisation streams on a realistic MDB backlog.
+
+Measure the size and the CPU cost of the messages sent to subscribers: the
+backlog and single-record updates, sent as-is, compressed as independent
+zlib streams (what the sync server does, once for all subscribers) and
+compressed with a zlib context kept for the whole connection (which
+compresses small updates better but costs CPU for each subscriber):
+
+    python3 benchmarks/sync_compression.py --machines 1000
+"""
+
+import argparse
+import json
+import timeit
+import zlib
+
+from prologin.synchronisation import (
+    MessageReader, encode_message, items_to_updates)
+
+from fixtures import mdb_backlog
+
+
+def best_of(func, number, repeat):
+    """Return the best time of `func` in milliseconds per call."""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e3
+
+
+def stream_compress(messages, level):
+    """Compress `messages` with one zlib context, flushing after each one
+    like a per-connection compressor would.
+    """
+    compressor = zlib.compressobj(level)
+    return [compressor.compress(m) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            for m in messages]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the compression of synchronisation streams')
+    parser.add_argument('--machines', type=int, default=1000,
+                        help='number of machines in the backlog')
+    parser.add_argument('--levels', default='1,6,9',
+                        help='comma-separated zlib compression levels')
+    parser.add_argument('--number', type=int, default=10,
+                        help='number of operations per run')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of runs (the best one is kept)')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    opts = parser.parse_args()
+
+    backlog = mdb_backlog(opts.machines)
+    backlog_msg = encode_message(items_to_updates(backlog))
+    # Every machine updated once, one update per message.
+    update_msgs = [encode_message([update])
+                   for update in items_to_updates(backlog)]
+    raw_updates = sum(len(m) for m in update_msgs)
+
+    results = []
+    print('{:<10} {:>5} {:>12} {:>7} {:>10} {:>10} {:>12} {:>7}'.format(
+        'mode', 'level', 'backlog B', 'ratio', 'comp ms', 'decomp ms',
+        'updates B', 'ratio'))
+    print('{:<10} {:>5} {:>12} {:>7.2f} {:>10} {:>10} {:>12} {:>7.2f}'.format(
+        'raw', '-', len(backlog_msg), 1, '-', '-', raw_updates, 1))
+
+    for level in [int(l) for l in opts.levels.split(',')]:
+        compressed = zlib.compress(backlog_msg, level)
+        per_message = [zlib.compress(m, level) for m in update_msgs]
+        streamed = stream_compress(update_msgs, level)
+
+        def decompress():
+            MessageReader('deflate').feed(compressed)
+
+        for mode, updates in [('message', per_message),
+                              ('stream', streamed)]:
+            result = {
+                'mode': mode,
+                'level': level,
+                'backlog_bytes': len(compressed),
+                'backlog_ratio': len(backlog_msg) / len(compressed),
+                'compress_ms': best_of(
+                    lambda: zlib.compress(backlog_msg, level),
+                    opts.number, opts.repeat),
+                'decompress_ms': best_of(decompress, opts.number,
+                                         opts.repeat),
+                'updates_bytes': sum(len(u) for u in updates),
+            }
+            result['updates_ratio'] = raw_updates / result['updates_bytes']
+            results.append(result)
+            print('{mode:<10} {level:>5} {backlog_bytes:>12} '
+                  '{backlog_ratio:>7.2f} {compress_ms:>10.3f} '
+                  '{decompress_ms:>10.3f} {updates_bytes:>12} '
+                  '{updates_ratio:>7.2f}'.format(**result))
+
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump({'machines': opts.machines,
+                       'backlog_bytes': len(backlog_msg),
+                       'updates_bytes': raw_updates,
+                       'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
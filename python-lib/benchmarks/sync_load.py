@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+
+# This file is part of Prologin-SADM.
+#
+# Prologin-SADM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Prologin-SADM is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Prologin-SADM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Synchronisation server load test.
+
+Start a synchronisation server whose initial backlog is a synthetic MDB
+backlog (no database needed), connect many /poll subscribers to it, then
+post updates to /update at each of the given rates. Report the end-to-end
+propagation latency (from posting an update to a subscriber applying it),
+the share of the updates that were delivered, and the RSS and CPU usage of
+the server:
+
+    python3 benchmarks/sync_load.py --subscribers 2000 --rates 1,10,100
+
+The server runs in its own process so that its resource usage can be told
+apart from the subscribers', which are spread between `--workers` processes.
+Each update is stamped with its sending time in a `sent_at` field; the
+subscribers run in the same host, so they share the clock.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import socket
+import sys
+import time
+
+import prologin.config
+import prologin.jsoncodec
+import prologin.synchronisation
+
+from fixtures import mdb_backlog
+
+
+PK = 'mac'
+PUB_SECRET = 'benchmark-pub'
+SUB_SECRET = 'benchmark-sub'
+
+
+class BenchSyncServer(prologin.synchronisation.Server):
+    def __init__(self, backlog, port, **kwargs):
+        self.backlog = backlog
+        super().__init__(PK, PUB_SECRET, SUB_SECRET, port, 'bench-sync',
+                         **kwargs)
+
+    def get_initial_backlog(self):
+        return self.backlog
+
+
+def run_server(backlog, port, server_options):
+    logging.disable(logging.WARNING)
+    prologin.config.loaded_configs.setdefault('timeauth', {'enabled': True})
+    BenchSyncServer(backlog, port, **server_options).start()
+
+
+def wait_ready(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('benchmark server did not start')
+
+
+def run_subscribers(url, count, fields, compress, stop, messages):
+    """Run `count` subscribers until `stop` is set, then put the
+    (sent_at, latency) couples of the updates they received in `messages`.
+    """
+    logging.disable(logging.CRITICAL)
+    prologin.config.loaded_configs.setdefault('timeauth', {'enabled': True})
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    client = prologin.synchronisation.AsyncClient(url, PK, SUB_SECRET)
+    latencies = []
+    connected = 0
+
+    async def subscriber():
+        nonlocal connected
+        first = True
+        async for records, updates_metadata in client.subscribe(
+                fields=fields, compress=compress):
+            now = time.time()
+            if first:
+                # The first message is the backlog.
+                first = False
+                connected += 1
+                if connected == count:
+                    messages.put(('ready', count))
+                continue
+            for key, change in updates_metadata.items():
+                sent_at = records.get(key, {}).get('sent_at')
+                if change == 'updated' and sent_at is not None:
+                    latencies.append((sent_at, now - sent_at))
+
+    async def main():
+        tasks = [loop.create_task(subscriber()) for _ in range(count)]
+        await loop.run_in_executor(None, stop.wait)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    try:
+        loop.run_until_complete(main())
+    finally:
+        client.pool.close(loop)
+        loop.close()
+    messages.put(('latencies', latencies))
+
+
+class ProcessStats:
+    """CPU and memory usage of a process, read from /proc."""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.ticks_per_second = os.sysconf('SC_CLK_TCK')
+        self.start()
+
+    def cpu_seconds(self):
+        with open('/proc/{}/stat'.format(self.pid)) as f:
+            # The command name may contain spaces: skip it.
+            fields = f.read().rsplit(')', 1)[1].split()
+        # utime and stime are the 14th and 15th fields.
+        return (int(fields[11]) + int(fields[12])) / self.ticks_per_second
+
+    def memory_mib(self, name='VmRSS'):
+        with open('/proc/{}/status'.format(self.pid)) as f:
+            for line in f:
+                if line.startswith(name + ':'):
+                    return int(line.split()[1]) / 1024
+
+    def start(self):
+        """Start a new measurement period."""
+        self.start_time = time.monotonic()
+        self.start_cpu = self.cpu_seconds()
+
+    def cpu_percent(self):
+        """Return the CPU usage since the start of the period."""
+        elapsed = time.monotonic() - self.start_time
+        return (self.cpu_seconds() - self.start_cpu) / elapsed * 100
+
+
+def percentile(values, p):
+    """Return the `p` percentile (nearest rank) of sorted `values`."""
+    if not values:
+        return None
+    rank = max(0, min(len(values) - 1, round(p / 100 * len(values)) - 1))
+    return values[rank]
+
+
+def publish(client, backlog, rate, duration):
+    """Post one update per machine of `backlog` in turn, `rate` times per
+    second for `duration` seconds. Return the number of updates posted.
+    """
+    start = time.monotonic()
+    sent = 0
+    while True:
+        # Catch up as fast as possible if we fall behind schedule.
+        delay = start + sent / rate - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        if time.monotonic() - start >= duration:
+            return sent
+        record = dict(backlog[sent % len(backlog)], sent_at=time.time())
+        client.send_update({'type': 'update', 'data': record})
+        sent += 1
+
+
+def split(count, parts):
+    """Split `count` between `parts` parts."""
+    return [count // parts + (i < count % parts) for i in range(parts)]
+
+
+def int_list(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Load test the synchronisation server')
+    parser.add_argument('--port', type=int, default=42700,
+                        help='port of the benchmark server')
+    parser.add_argument('--machines', type=int, default=1000,
+                        help='number of machines in the backlog')
+    parser.add_argument('--subscribers', type=int, default=1000,
+                        help='number of /poll subscribers')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of processes running the subscribers')
+    parser.add_argument('--rates', type=int_list, default=[1, 10, 100],
+                        help='comma-separated update rates (per second)')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds of updates for each rate')
+    parser.add_argument('--drain', type=float, default=2,
+                        help='seconds to wait for late updates after each '
+                             'rate')
+    parser.add_argument('--fields',
+                        help='comma-separated fields the subscribers ask for '
+                             '(all by default)')
+    parser.add_argument('--no-compress', dest='compress',
+                        action='store_false',
+                        help='do not compress the poll streams')
+    parser.add_argument('--high-water-mark', type=int,
+                        default=prologin.synchronisation.HIGH_WATER_MARK,
+                        help='server high water mark (in bytes)')
+    parser.add_argument('--slow-timeout', type=float,
+                        default=prologin.synchronisation.SLOW_TIMEOUT,
+                        help='server slow subscriber timeout (in seconds)')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    opts = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    prologin.config.loaded_configs.setdefault('timeauth', {'enabled': True})
+    # Every subscriber needs a socket, on both sides.
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    fields = None
+    if opts.fields:
+        fields = set(opts.fields.split(',')) | {PK, 'sent_at'}
+    backlog = mdb_backlog(opts.machines)
+    url = 'http://127.0.0.1:{}'.format(opts.port)
+
+    server = multiprocessing.Process(
+        target=run_server, daemon=True,
+        args=(backlog, opts.port, {'high_water_mark': opts.high_water_mark,
+                                   'slow_timeout': opts.slow_timeout}))
+    server.start()
+    wait_ready(opts.port)
+    stats = ProcessStats(server.pid)
+    idle_rss = stats.memory_mib()
+
+    stop = multiprocessing.Event()
+    messages = multiprocessing.Queue()
+    workers = [multiprocessing.Process(
+        target=run_subscribers,
+        args=(url, count, fields, opts.compress, stop, messages))
+        for count in split(opts.subscribers, opts.workers) if count]
+    for worker in workers:
+        worker.start()
+
+    start = time.monotonic()
+    for _ in workers:
+        messages.get(timeout=max(60, opts.subscribers / 10))
+    connect_time = time.monotonic() - start
+    connected_rss = stats.memory_mib()
+    print('{} subscribers connected in {:.2f}s, server RSS {:.1f} MiB '
+          '({:.1f} MiB idle)'.format(opts.subscribers, connect_time,
+                                     connected_rss, idle_rss))
+    sys.stdout.flush()
+
+    client = prologin.synchronisation.Client(url, PK, PUB_SECRET, SUB_SECRET)
+    phases = []
+    try:
+        for rate in opts.rates:
+            stats.start()
+            phase_start = time.time()
+            sent = publish(client, backlog, rate, opts.duration)
+            phase_end = time.time()
+            time.sleep(opts.drain)
+            phases.append({
+                'rate': rate,
+                'sent': sent,
+                'sent_per_second': sent / (phase_end - phase_start),
+                'start': phase_start,
+                'end': phase_end,
+                'cpu_percent': stats.cpu_percent(),
+                'rss_mib': stats.memory_mib(),
+            })
+    finally:
+        stop.set()
+        received = []
+        pending = len(workers)
+        while pending:
+            kind, value = messages.get()
+            if kind == 'latencies':
+                received.extend(value)
+                pending -= 1
+        for worker in workers:
+            worker.join()
+        peak_rss = stats.memory_mib('VmHWM')
+        server.terminate()
+
+    print('{:>6} {:>8} {:>9} {:>9} {:>9} {:>9} {:>7} {:>9}'.format(
+        'rate', 'sent/s', 'delivered', 'p50 ms', 'p99 ms', 'max ms', 'cpu %',
+        'rss MiB'))
+    results = []
+    for phase in phases:
+        latencies = sorted(latency for sent_at, latency in received
+                           if phase['start'] <= sent_at < phase['end'])
+        expected = phase.pop('sent') * opts.subscribers
+        result = {
+            'rate': phase['rate'],
+            'sent_per_second': phase['sent_per_second'],
+            'delivered': len(latencies) / expected if expected else None,
+            'latency_p50_ms': percentile(latencies, 50),
+            'latency_p99_ms': percentile(latencies, 99),
+            'latency_max_ms': latencies[-1] if latencies else None,
+            'cpu_percent': phase['cpu_percent'],
+            'rss_mib': phase['rss_mib'],
+        }
+        for key in ('latency_p50_ms', 'latency_p99_ms', 'latency_max_ms'):
+            if result[key] is not None:
+                result[key] *= 1000
+        results.append(result)
+        print('{rate:>6} {sent_per_second:>8.1f} {delivered:>9.1%} '
+              '{latency_p50_ms:>9.2f} {latency_p99_ms:>9.2f} '
+              '{latency_max_ms:>9.2f} {cpu_percent:>7.1f} {rss_mib:>9.1f}'
+              .format(**{key: float('nan') if value is None else value
+                         for key, value in result.items()}))
+    print('server peak RSS {:.1f} MiB'.format(peak_rss))
+
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump({
+                'time': time.time(),
+                'python': platform.python_version(),
+                'json': prologin.jsoncodec.BACKEND,
+                'machines': opts.machines,
+                'subscribers': opts.subscribers,
+                'compress': opts.compress,
+                'fields': sorted(fields) if fields else None,
+                'connect_seconds': connect_time,
+                'idle_rss_mib': idle_rss,
+                'connected_rss_mib': connected_rss,
+                'peak_rss_mib': peak_rss,
+                'results': results,
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# This file is part of Prologin-SADM.
+#
+# Prologin-SADM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Prologin-SADM is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Prologin-SADM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Utilities for authentication in aiohttp servers, the counterpart of
+prologin.tornadauth: requests carry their message in the `data` argument and
+a timeauth token in the `hmac` argument, as sent by prologin.webapi.Client.
+"""
+
+import aiohttp.web
+import functools
+import logging
+import prologin.timeauth
+
+
+async def get_arguments(request):
+    """Return the query arguments of `request`, merged with its form
+    arguments for POST requests.
+    """
+    if request.method != 'POST':
+        return request.query
+    arguments = request.query.copy()
+    arguments.extend(await request.post())
+    return arguments
+
+
+def signature_checked(secret_name, check_msg=False):
+    """Return a decorator for aiohttp handlers that are methods.
+
+    The decorator wraps a given method handler so that the signature of
+    requests are checked before calling the handler itself. If checking fails,
+    log the failure and return a HTTP 403 error. The shared secret used for
+    checking is the `secret_name` attribute of the object the handler is
+    bound to. Include message checking if asked to.
+
+    The handler is called with the request and its `data` argument.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def method_wrapper(self, request):
+            arguments = await get_arguments(request)
+            try:
+                msg = arguments['data']
+                token = arguments['hmac']
+            except KeyError as e:
+                raise aiohttp.web.HTTPBadRequest(
+                    text='Missing argument {}'.format(e))
+            secret = getattr(self, secret_name)
+            verifier = prologin.timeauth.get_verifier(secret)
+            if not verifier.check(token, msg if check_msg else None):
+                logging.error('INVALID TOKEN!')
+                return aiohttp.web.Response(status=403, reason='Invalid token',
+                                            text='Invalid token')
+            return (await func(self, request, msg))
+
+        return method_wrapper
+    return decorator
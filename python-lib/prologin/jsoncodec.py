@@ -0,0 +1,91 @@
+# This file is part of Prologin-SADM.
+#
+# Prologin-SADM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Prologin-SADM is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Prologin-SADM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""JSON codec for hot paths: use orjson when available, and fall back to
+the standard json module otherwise.
+
+Both backends produce standard JSON and raise on objects they cannot
+serialize. Non-string dictionary keys are converted to strings, like the
+json module does.
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Exceptions raised when encoding and decoding fail, whatever the backend.
+EncodeError = (TypeError, ValueError, OverflowError)
+DecodeError = ValueError
+
+
+def _apply_object_hook(obj, object_hook):
+    """Call `object_hook` on every dictionary in `obj`, innermost first, like
+    json.loads does.
+    """
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            if isinstance(value, (dict, list)):
+                obj[key] = _apply_object_hook(value, object_hook)
+        return object_hook(obj)
+    if isinstance(obj, list):
+        for i, value in enumerate(obj):
+            if isinstance(value, (dict, list)):
+                obj[i] = _apply_object_hook(value, object_hook)
+    return obj
+
+
+if orjson is not None:
+    BACKEND = 'orjson'
+
+    def dumpb(obj, default=None):
+        return orjson.dumps(obj, default=default,
+                            option=orjson.OPT_NON_STR_KEYS)
+
+    def _loads(data):
+        return orjson.loads(data)
+
+else:
+    BACKEND = 'json'
+
+    def dumpb(obj, default=None):
+        return json.dumps(obj, default=default).encode()
+
+    def _loads(data):
+        return json.loads(data)
+
+
+dumpb.__doc__ = """Encode `obj` to JSON bytes. `default` is called on objects
+that cannot be serialized, and must return a serializable object or raise a
+TypeError.
+"""
+
+
+def dumps(obj, default=None):
+    """Encode `obj` to a JSON string. See `dumpb`."""
+    return dumpb(obj, default).decode()
+
+
+def loads(data, object_hook=None):
+    """Decode the JSON document in `data` (bytes or str). `object_hook` is
+    called on every decoded dictionary, like with json.loads.
+    """
+    obj = _loads(data)
+    if object_hook is not None:
+        obj = _apply_object_hook(obj, object_hook)
+    return obj
@@ -26,8 +26,6 @@ import prologin.rpc.server
 import random
 import time
 
-from base64 import b64decode, b64encode
-
 from .concoursquery import ConcoursQuery
 from .monitoring import (
     masternode_bad_result,
@@ -36,18 +34,24 @@ from .monitoring import (
     masternode_match_done_file,
     masternode_request_compilation_task,
     masternode_task_redispatch,
+    masternode_worker_disconnect,
     masternode_worker_timeout,
 )
 from .task import MatchTask, CompilationTask
 from .task import champion_compiled_path, match_path, clog_path
 from .worker import Worker
 
+# Size of the chunks used to write streamed match dumps.
+DUMP_CHUNK_SIZE = 64 * 1024
+
 
 class MasterNode(prologin.rpc.server.BaseRPCApp):
     def __init__(self, *args, config=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.config = config
         self.workers = {}
+        # Channels opened by workers, by (hostname, port).
+        self.channels = {}
         self.worker_tasks = []
         self.db = ConcoursQuery(config)
 
@@ -79,7 +83,8 @@ class MasterNode(prologin.rpc.server.BaseRPCApp):
         hostname, port, slots, max_slots = worker
         key = hostname, port
         if key not in self.workers:
-            w = Worker(hostname, port, slots, max_slots, self.config)
+            w = Worker(hostname, port, slots, max_slots, self.config,
+                       channel=self.channels.get(key))
             await self.register_worker(key, w)
         else:
             logging.debug("updating worker: %s:%s %s/%s",
@@ -96,9 +101,45 @@ class MasterNode(prologin.rpc.server.BaseRPCApp):
             self.redispatch_worker(self.workers[(hostname, port)])
         await self.update_worker(worker)
 
-    @prologin.rpc.remote_method
-    async def compilation_result(self, worker, cid, user, ret, b64compiled,
-                                 log):
+    @staticmethod
+    def channel_key(channel):
+        """Return the (hostname, port) key of the worker that opened
+        `channel`, or None if it does not come from a worker.
+        """
+        hostname = channel.params.get('hostname')
+        try:
+            port = int(channel.params.get('port'))
+        except (TypeError, ValueError):
+            return None
+        if not hostname:
+            return None
+        return hostname, port
+
+    def channel_opened(self, channel):
+        key = self.channel_key(channel)
+        if key is None:
+            logging.warning('ignoring channel from %s: not a worker',
+                            channel.peer)
+            return
+        logging.info('worker %s:%s opened a channel', *key)
+        self.channels[key] = channel
+        if key in self.workers:
+            self.workers[key].rpc.channel = channel
+
+    def channel_closed(self, channel):
+        key = self.channel_key(channel)
+        if key is None or self.channels.get(key) is not channel:
+            return
+        del self.channels[key]
+        # No need to wait for the heartbeat timeout: the worker is gone.
+        w = self.workers.get(key)
+        if w is not None and w.rpc.channel is channel:
+            masternode_worker_disconnect.inc()
+            logging.warning("channel closed for worker %s", w)
+            self.redispatch_worker(w)
+
+    @prologin.rpc.remote_method(max_concurrency=16, queue=64, retry_after=2)
+    async def compilation_result(self, worker, cid, user, ret, compiled, log):
         hostname, port, slots, max_slots = worker
         w = self.workers[(hostname, port)]
 
@@ -111,7 +152,7 @@ class MasterNode(prologin.rpc.server.BaseRPCApp):
         if ret:
             with open(champion_compiled_path(self.config, user, cid),
                       'wb') as f:
-                f.write(b64decode(b64compiled))
+                f.write(compiled)
         with open(clog_path(self.config, user, cid), 'w') as f:
             f.write(log)
         logging.info('compilation of champion %s: %s', cid, status)
@@ -119,9 +160,10 @@ class MasterNode(prologin.rpc.server.BaseRPCApp):
             'set_champion_status',
             {'champion_id': cid, 'champion_status': status})
 
-    @prologin.rpc.remote_method
-    async def match_done(self, worker, mid, result, dumper_stdout,
-                         server_stdout, players_stdout):
+    @prologin.rpc.remote_method(stream='dumper_stdout', max_concurrency=16,
+                                queue=64, retry_after=2)
+    async def match_done(self, worker, mid, result, server_stdout,
+                         players_stdout, dumper_stdout):
         hostname, port, slots, max_slots = worker
         w = self.workers[(hostname, port)]
 
@@ -146,7 +188,11 @@ class MasterNode(prologin.rpc.server.BaseRPCApp):
              open(serverpath, 'w') as fserver, \
              open(dumppath, 'wb') as fdump:
             fserver.write(server_stdout)
-            fdump.write(b64decode(dumper_stdout))
+            while True:
+                chunk = await dumper_stdout.read(DUMP_CHUNK_SIZE)
+                if not chunk:
+                    break
+                fdump.write(chunk)
 
         try:
             match_status = {'match_id': mid, 'match_status': 'done'}
@@ -253,7 +299,8 @@ class MasterNode(prologin.rpc.server.BaseRPCApp):
                                     'assuming it is empty', exc_info=1)
             for k, path in file_opts_paths.items():
                 try:
-                    file_opts[k] = b64encode(open(path, 'rb').read()).decode()
+                    with open(path, 'rb') as f:
+                        file_opts[k] = f.read()
                 except FileNotFoundError:
                     logging.warning('file for option %s not found: %s', k, path)
 
@@ -55,5 +55,9 @@ masternode_worker_timeout = Gauge(
     'masternode_worker_timeout',
     'Number of workers timeout')
 
+masternode_worker_disconnect = Counter(
+    'masternode_worker_disconnect',
+    'Number of workers whose channel was closed')
+
 def monitoring_start():
     start_http_server(9021)
@@ -23,8 +23,6 @@ import os
 import os.path
 import time
 
-from base64 import b64decode, b64encode
-
 
 def champion_path(config, user, cid):
     return os.path.join(config['contest']['directory'],
@@ -79,9 +77,8 @@ class CompilationTask(Task):
 
     async def execute(self, master, worker):
         super().execute()
-        ctgz = ''
         with open(self.champ_path, 'rb') as f:
-            ctgz = b64encode(f.read()).decode()
+            ctgz = f.read()
         await worker.rpc.compile_champion(self.user,
                 self.champ_id, ctgz)
 
@@ -100,9 +97,8 @@ class MatchTask(Task):
 
         for (cid, mpid, user) in players:
             cpath = champion_compiled_path(config, user, cid)
-            ctgz = ''
             with open(cpath, 'rb') as f:
-                ctgz = b64encode(f.read()).decode()
+                ctgz = f.read()
             self.players[mpid] = (cid, ctgz)
 
     @property
@@ -19,14 +19,15 @@
 # along with Prologin-SADM.  If not, see <http://www.gnu.org/licenses/>.
 
 import asyncio
-import prologin.rpc.client
+import prologin.rpc.channel
 import time
 
 from . import task
 
 
 class Worker(object):
-    def __init__(self, hostname, port, slots, max_slots, config):
+    def __init__(self, hostname, port, slots, max_slots, config,
+                 channel=None):
         self.hostname = hostname
         self.port = port
         self.slots = slots
@@ -34,9 +35,11 @@ class Worker(object):
         self.tasks = []
         self.keep_alive()
         self.config = config
-        self.rpc = prologin.rpc.client.Client("http://{}:{}/".format(
-            self.hostname, self.port),
-            secret=self.config['master']['shared_secret'].encode())
+        # Calls go through the channel opened by the worker, if any.
+        self.rpc = prologin.rpc.channel.ChannelClient(
+            "http://{}:{}/".format(self.hostname, self.port),
+            secret=self.config['master']['shared_secret'].encode(),
+            channel=channel)
 
     @property
     def usage(self):
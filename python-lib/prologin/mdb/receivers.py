@@ -18,13 +18,14 @@
 import logging
 import prologin.log
 import prologin.mdbsync.client
+import prologin.rpc.server
 import queue
 import threading
 
 from django.conf import settings
 from django.dispatch import receiver
 from django.db.models.signals import post_save, pre_delete
-from prologin.mdb.models import Machine
+from prologin.mdb.models import Machine, Switch
 
 prologin.log.setup_logging('mdb')
 
@@ -57,14 +58,23 @@ class UpdateSenderTask(threading.Thread):
 
 _update_sender = UpdateSenderTask()
 
+# Responses of the cacheable MDB methods. Changes made by other processes
+# (e.g. management commands) do not go through these receivers, hence the
+# short TTL.
+response_cache = prologin.rpc.server.ResponseCache(ttl=5)
+
 @receiver(post_save)
 def post_save_handler(sender, instance, created, *args, **kwargs):
+    if sender in (Machine, Switch):
+        response_cache.invalidate()
     if sender is not Machine:
         return
     _update_sender.send({ "type": "update", "data": instance.to_dict() })
 
 @receiver(pre_delete)
 def pre_delete_handler(sender, instance, *args, **kwargs):
+    if sender in (Machine, Switch):
+        response_cache.invalidate()
     if sender is not Machine:
         return
     _update_sender.send({ "type": "delete", "data": instance.to_dict() })
@@ -22,7 +22,12 @@ from prologin.utils.django import check_filter_fields
 
 
 class MDBServer(prologin.rpc.server.BaseRPCApp):
-    @prologin.rpc.remote_method(auth_required=False)
+    def __init__(self, *args, **kwargs):
+        super().__init__(
+            *args, response_cache=prologin.mdb.receivers.response_cache,
+            **kwargs)
+
+    @prologin.rpc.remote_method(auth_required=False, cacheable=True)
     async def query(self, **kwargs):
         """Query the MDB using the Django query syntax. The possible fields
         are:
@@ -43,7 +48,7 @@ class MDBServer(prologin.rpc.server.BaseRPCApp):
         machines = [m.to_dict() for m in machines]
         return machines
 
-    @prologin.rpc.remote_method(auth_required=False)
+    @prologin.rpc.remote_method(auth_required=False, cacheable=True)
     async def switches(self, **kwargs):
         """Query the MDB for switches using the Django query syntax. The
         possible fields are:
@@ -39,3 +39,10 @@ def connect(pub=False):
     logging.info('Creating MDBSync connection object: url=%s, can_pub=%s',
                  url, pub_secret is not None)
     return prologin.synchronisation.Client(url, 'mac', pub_secret, sub_secret)
+
+
+def connect_async():
+    """Return an AsyncClient subscribing to the MDBSync server."""
+    return prologin.synchronisation.AsyncClient(
+        SUB_CFG['url'], 'mac', SUB_CFG['shared_secret']
+    )
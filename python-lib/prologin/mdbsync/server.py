@@ -36,9 +36,9 @@ if 'shared_secret' not in SUB_CFG:
 
 
 class SyncServer(prologin.synchronisation.Server):
-    def __init__(self, pub_secret, sub_secret, port):
+    def __init__(self, pub_secret, sub_secret, port, **kwargs):
         super().__init__(
-            'mac', pub_secret, sub_secret, port, 'mdbsync'
+            'mac', pub_secret, sub_secret, port, 'mdbsync', **kwargs
         )
 
     def get_initial_backlog(self):
@@ -54,6 +54,7 @@ if __name__ == '__main__':
     server = SyncServer(
         PUB_CFG['shared_secret'],
         SUB_CFG['shared_secret'],
-        port
+        port,
+        **prologin.synchronisation.server_options(PUB_CFG)
     )
     server.start()
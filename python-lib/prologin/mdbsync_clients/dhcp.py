@@ -22,6 +22,7 @@ import logging
 import os
 import prologin.log
 import prologin.mdbsync.client
+import prologin.synchronisation
 
 
 def update_dhcp_config(machines, metadata):
@@ -47,4 +48,7 @@ def update_dhcp_config(machines, metadata):
 
 if __name__ == '__main__':
     prologin.log.setup_logging('mdbdhcp')
-    prologin.mdbsync.client.connect().poll_updates(update_dhcp_config)
+    prologin.mdbsync.client.connect().poll_updates(
+        update_dhcp_config, fields={'hostname', 'mac', 'ip'},
+        cache_path=prologin.synchronisation.cache_path('mdbsync'),
+        debounce=1)
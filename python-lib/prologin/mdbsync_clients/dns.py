@@ -22,6 +22,7 @@ import logging
 import os.path
 import prologin.log
 import prologin.mdbsync.client
+import prologin.synchronisation
 
 
 def build_zone(name, records):
@@ -123,4 +124,7 @@ def update_dns_config(machines_map, metadata):
 
 if __name__ == '__main__':
     prologin.log.setup_logging('mdbdns')
-    prologin.mdbsync.client.connect().poll_updates(update_dns_config)
+    prologin.mdbsync.client.connect().poll_updates(
+        update_dns_config, fields={'hostname', 'aliases', 'ip', 'mtype'},
+        cache_path=prologin.synchronisation.cache_path('mdbsync'),
+        debounce=1)
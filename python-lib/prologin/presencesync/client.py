@@ -91,3 +91,10 @@ def connect(pub=False):
     return Client(
         url, 'login', pub_secret, sub_secret
     )
+
+
+def connect_async():
+    """Return an AsyncClient subscribing to the PresenceSync server."""
+    return prologin.synchronisation.AsyncClient(
+        SUB_CFG['url'], 'login', SUB_CFG['shared_secret']
+    )
@@ -19,20 +19,20 @@ accept or deny connection requests from presencd daemons instances and mainain
 a list of logged users, taking care of timeouts thanks to heartbeats.
 """
 
+import aiohttp.web
 import collections
-import json
 import logging
+import prologin.aiohttpauth
 import prologin.config
+import prologin.jsoncodec
 import prologin.log
 import prologin.mdb.client
 import prologin.presencesync.client
 import prologin.synchronisation
-import prologin.tornadauth
 import prologin.udb.client
 import sys
 import threading
 import time
-import tornado.web
 
 from .monitoring import (
     presencesync_login_failed,
@@ -149,6 +149,10 @@ class TimeoutedPubSubQueue(prologin.synchronisation.BasePubSubQueue):
         if update_msg:
             self.post_updates(update_msg)
 
+    def prepare_backlog(self):
+        # Do not send (or cache) expired logins to new subscribers.
+        self.remove_and_publish_expired()
+
     def get_backlog_message(self):
         """Return an update message-formatted backlog.  Check for expired
         logins first.
@@ -291,49 +295,10 @@ class TimeoutedPubSubQueue(prologin.synchronisation.BasePubSubQueue):
         self.update_backlog(login, hostname)
 
 
-class GetListHandler(tornado.web.RequestHandler):
-    @prologin.tornadauth.signature_checked('sub_secret', check_msg=True)
-    def get(self, msg):
-        self.write(json.dumps(
-            self.application.pubsub_queue.get_list()
-        ))
-
-
-class LoginHandler(tornado.web.RequestHandler):
-    @prologin.tornadauth.signature_checked('pub_secret', check_msg=True)
-    def post(self, msg):
-        msg = json.loads(msg)
-        failure_reason = self.application.pubsub_queue.request_login(
-            msg['login'], msg['hostname']
-        )
-        if failure_reason:
-            self.set_status(423, 'Login refused')
-            self.write(failure_reason)
-        else:
-            self.set_status(200, 'OK')
-
-
-class HeartbeatHandler(tornado.web.RequestHandler):
-    @prologin.tornadauth.signature_checked('pub_secret', check_msg=True)
-    def post(self, msg):
-        msg = json.loads(msg)
-        self.application.pubsub_queue.update_backlog(
-            msg['login'], msg['hostname']
-        )
-        self.set_status(200, 'OK')
-
-
-class RemoveExpiredHandler(tornado.web.RequestHandler):
-    @prologin.tornadauth.signature_checked('pub_secret', check_msg=True)
-    def post(self, msg):
-        self.application.pubsub_queue.remove_and_publish_expired()
-        self.set_status(200, 'OK')
-
-
 class SyncServer(prologin.synchronisation.Server):
-    def __init__(self, pub_secret, sub_secret, port):
+    def __init__(self, pub_secret, sub_secret, port, **kwargs):
         super(SyncServer, self).__init__(
-            'login', pub_secret, sub_secret, port, 'presencesync'
+            'login', pub_secret, sub_secret, port, 'presencesync', **kwargs
         )
         self.start_ts = None
 
@@ -367,16 +332,44 @@ class SyncServer(prologin.synchronisation.Server):
             else:
                 time.sleep(TimeoutedPubSubQueue.TIMEOUT / 2)
 
-    def get_handlers(self):
-        # Override default handlers: direct updating is not allowed.
+    def get_routes(self):
+        # Override default routes: direct updating is not allowed.
         return [
-            (r'/poll', prologin.synchronisation.PollHandler),
-            (r'/get_list', GetListHandler),
-            (r'/login', LoginHandler),
-            (r'/heartbeat', HeartbeatHandler),
-            (r'/remove_expired', RemoveExpiredHandler),
+            ('GET', r'/poll', self.poll),
+            ('GET', r'/get_list', self.get_list),
+            ('POST', r'/login', self.login),
+            ('POST', r'/heartbeat', self.heartbeat),
+            ('POST', r'/remove_expired', self.remove_expired),
         ]
 
+    @prologin.aiohttpauth.signature_checked('sub_secret', check_msg=True)
+    async def get_list(self, request, msg):
+        return aiohttp.web.Response(text=prologin.jsoncodec.dumps(
+            self.pubsub_queue.get_list()
+        ))
+
+    @prologin.aiohttpauth.signature_checked('pub_secret', check_msg=True)
+    async def login(self, request, msg):
+        msg = prologin.jsoncodec.loads(msg)
+        failure_reason = self.pubsub_queue.request_login(
+            msg['login'], msg['hostname']
+        )
+        if failure_reason:
+            return aiohttp.web.Response(status=423, reason='Login refused',
+                                        text=failure_reason)
+        return aiohttp.web.Response()
+
+    @prologin.aiohttpauth.signature_checked('pub_secret', check_msg=True)
+    async def heartbeat(self, request, msg):
+        msg = prologin.jsoncodec.loads(msg)
+        self.pubsub_queue.update_backlog(msg['login'], msg['hostname'])
+        return aiohttp.web.Response()
+
+    @prologin.aiohttpauth.signature_checked('pub_secret', check_msg=True)
+    async def remove_expired(self, request, msg):
+        self.pubsub_queue.remove_and_publish_expired()
+        return aiohttp.web.Response()
+
     def create_pubsub_queue(self):
         """Initially, no user is logged. Heartbeats are trusted, so we can
         rebuild the state with them."""
@@ -395,6 +388,7 @@ if __name__ == '__main__':
     server = SyncServer(
         PUB_CFG['shared_secret'],
         SUB_CFG['shared_secret'],
-        port
+        port,
+        **prologin.synchronisation.server_options(PUB_CFG)
     )
     server.start()
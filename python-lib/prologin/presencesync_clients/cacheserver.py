@@ -4,10 +4,10 @@ import logging
 import sys
 import prologin.config
 import prologin.log
-import prologin.mdb.client
+import prologin.mdbsync.client
 import prologin.web
 import prologin.presencesync.client
-import prologin.udb.client
+import prologin.synchronisation
 import threading
 import tornado.web
 import tornado.ioloop
@@ -21,8 +21,7 @@ class WhoisHandler(tornado.web.RequestHandler):
         except tornado.web.MissingArgumentError:
             self.send_error(400)
             return
-        with self.application.lock:
-            login = self.application.ip_to_login.get(ipaddr, "")
+        login = self.application.whois(ipaddr)
         if not login:
             logging.warning("%s requested /whois for unknown IP %s",
                             self.request.remote_ip, ipaddr)
@@ -33,9 +32,22 @@ class WhoisHandler(tornado.web.RequestHandler):
 class PresenceCacheServer(prologin.web.TornadoApp):
     def __init__(self, port, app_name):
         super().__init__(self.get_handlers(), app_name)
-        self.ip_to_login = {}
+        # Kept up to date by the synchronisation clients.
+        self.machines = prologin.synchronisation.IndexedState(['ip'])
+        self.logins = prologin.synchronisation.IndexedState(['hostname'])
         self.port = port
-        self.lock = threading.Lock()
+
+    def whois(self, ip):
+        """Return the login of the user logged on the machine at `ip`, or
+        an empty string.
+        """
+        machine = self.machines.lookup('ip', ip)
+        if machine is None:
+            return ""
+        presence = self.logins.lookup('hostname', machine['hostname'])
+        if presence is None:
+            return ""
+        return presence['login']
 
     def get_handlers(self):
         """Return a list of URL/request handlers couples for this server."""
@@ -48,41 +60,26 @@ class PresenceCacheServer(prologin.web.TornadoApp):
         # NOTE: this threading stuff has seirl seal-of-approval: "It's fine
         # because it's not related to the server."
         # poll_updates() is rather intricate, it would be overkill
-        # to reimplement here.
-        def presencesync_daemon():
-            return prologin.presencesync.client.connect().poll_updates(
-                self.presencesync_callback)
-        thread = threading.Thread(target=presencesync_daemon)
-        thread.deamon = True  # exit along with main
+        # to reimplement here. Handlers only do single lookups in the
+        # records, which the clients update in place.
+        feeds = [
+            (prologin.presencesync.client.connect(), self.logins, None),
+            (prologin.mdbsync.client.connect(), self.machines,
+             {'hostname', 'ip'}),
+        ]
         self.listen(self.port)
-        thread.start()
+        for client, records, fields in feeds:
+            thread = threading.Thread(
+                target=client.poll_updates, args=(self.sync_callback,),
+                kwargs={'fields': fields, 'records': records},
+                daemon=True)  # exit along with main
+            thread.start()
         tornado.ioloop.IOLoop.instance().start()
 
-    def presencesync_callback(self, login_to_machine, updates_metadata):
-        mdb_machines = prologin.mdb.client.connect().query()  # get all machines
-
-        # Translate hostnames to IPs
-        ip_to_hostname = {m['ip']: m['hostname'] for m in mdb_machines}
-        # Translates logins to hostnames
-        hostname_to_login = {m['hostname']: login for login, m in login_to_machine.items()}
-
-        with self.lock:
-            # FIXME: self.ip_to_login may contain multiple similar logins
-            # eg. {1.2.3.4: fubar, 4.3.2.1: fubar}
-            # May not be a big deal though. We could clear the mapping before
-            # building it.
-            for ip, hostname in ip_to_hostname.items():
-                try:
-                    self.ip_to_login[ip] = hostname_to_login[hostname]
-                except KeyError:
-                    # Clear login for this IP as its hostname was not found
-                    # (eg. because the machine became free)
-                    self.ip_to_login.pop(ip, None)
-
-            length = len(self.ip_to_login)
-
-        logging.info("Received %d logins, %d hostnames. Cache has %d mappings.",
-                     len(login_to_machine), len(mdb_machines), length)
+    def sync_callback(self, records, updates_metadata):
+        logging.info("Received %d updates. Cache has %d logins and %d "
+                     "machines.", len(updates_metadata), len(self.logins),
+                     len(self.machines))
 
 
 if __name__ == '__main__':
@@ -2,12 +2,12 @@
 
 import asyncio
 import logging
-import functools
 import prologin.config
 import prologin.log
 import prologin.mdb.client
 import prologin.mdbsync.client
 import prologin.presencesync.client
+import prologin.synchronisation
 import prologin.udb.client
 import prologin.udbsync.client
 import subprocess
@@ -16,7 +16,8 @@ import threading
 CFG = prologin.config.load('presencesync_firewall')
 
 
-mdb_machines = {}
+# Records of each feed, kept up to date by the synchronisation clients.
+mdb_machines = prologin.synchronisation.IndexedState(['hostname'])
 udb_users = {}
 presence_data = {}
 
@@ -43,10 +44,9 @@ def update_firewall():
     # Translate hostnames to ip
     allowed_ips = set()
     for hostname in allowed_hostnames:
-        for machine in mdb_machines.values():
-            if hostname == machine['hostname']:
-                allowed_ips.add(machine['ip'])
-                break  # IP found
+        machine = mdb_machines.lookup('hostname', hostname)
+        if machine is not None:
+            allowed_ips.add(machine['ip'])
 
     # Add organizers machines
     for machine in mdb_machines.values():
@@ -62,27 +62,24 @@ def update_firewall():
                     'allowed-internet-access', shell=True)
 
 
-async def poll_all():
-    mdbsync_client = prologin.mdbsync.client.connect()
-    udbsync_client = prologin.udbsync.client.connect()
-    presencesync_client = prologin.presencesync.client.connect()
-
-    loop = asyncio.get_event_loop()
-
-    tasks = []
-
-    def add_task(client, dict_to_update):
-        def cb(values, meta):
-            dict_to_update.clear()
-            dict_to_update.update(values)
-            loop.call_soon_threadsafe(update_firewall)
-        tasks.append(loop.run_in_executor(None, client.poll_updates, cb))
+async def follow(client, name, records, fields=None):
+    cache_path = prologin.synchronisation.cache_path(name)
+    async for _ in client.subscribe(fields=fields, cache_path=cache_path,
+                                    records=records):
+        update_firewall()
 
-    add_task(mdbsync_client, mdb_machines)
-    add_task(udbsync_client, udb_users)
-    add_task(presencesync_client, presence_data)
 
-    await asyncio.wait(tasks)
+async def poll_all():
+    mdbsync_client = prologin.mdbsync.client.connect_async()
+    udbsync_client = prologin.udbsync.client.connect_async()
+    presencesync_client = prologin.presencesync.client.connect_async()
+
+    await asyncio.wait([
+        follow(mdbsync_client, 'mdbsync', mdb_machines,
+               {'hostname', 'ip', 'mtype'}),
+        follow(udbsync_client, 'udbsync', udb_users, {'group'}),
+        follow(presencesync_client, 'presencesync', presence_data),
+    ])
 
 
 if __name__ == '__main__':
@@ -6,6 +6,7 @@ import prologin.config
 import prologin.log
 import prologin.mdbsync.client
 import prologin.presencesync.client
+import prologin.synchronisation
 import prologin.udbsync.client
 import subprocess
 import xml.etree.ElementTree as ET
@@ -95,9 +96,10 @@ def fill_machine(text, login=None, group=""):
         tspan.set('style', style)
 
 
-mdb_machines = {}
+# Records of each feed, kept up to date by the synchronisation clients.
+mdb_machines = prologin.synchronisation.IndexedState(['hostname'])
 udb_users = {}
-presence_data = {}
+presence_data = prologin.synchronisation.IndexedState(['hostname'])
 ping_status = {}
 
 
@@ -105,11 +107,6 @@ def generate(map_pattern, output):
     """Write the SVG user map into the `output` using the `map_pattern`
     readable file and the `logins` -> hostname mapping.
     """
-    host_to_login = {
-        entry['hostname']: entry['login']
-        for entry in presence_data.values()
-    }
-
     tree = ET.parse(map_pattern)
     for g in tree.getroot().iter(G_TAG):
         if not len(g) or g[0].tag != RECT_TAG or g[1].tag != TEXT_TAG:
@@ -122,24 +119,19 @@ def generate(map_pattern, output):
             text[1].tag == TSPAN_TAG
         ):
             machine_name = text[0].text
-            login = host_to_login.get(machine_name, None)
+            presence = presence_data.lookup('hostname', machine_name)
+            login = presence['login'] if presence is not None else None
 
             group = "user"  # default group
-            # Search user group
-            for udb_user in udb_users.values():
-                if udb_user['login'] == login:
-                    group = udb_user['group']
-                    break
+            udb_user = udb_users.get(login)
+            if udb_user is not None:
+                group = udb_user['group']
 
             status = ping_status.get(machine_name, True)
 
-            faulty = False
-            registered = False
-            for machine in mdb_machines.values():
-                if machine['hostname'] == machine_name:
-                    faulty = machine['is_faulty']
-                    registered = True
-                    break
+            machine = mdb_machines.lookup('hostname', machine_name)
+            registered = machine is not None
+            faulty = registered and machine['is_faulty']
 
             fill_machine(text, login, group)
             fill_rect(rect, status, registered, faulty)
@@ -167,7 +159,7 @@ async def ping_machine(hostname):
     return hostname, (await proc.wait() == 0)
 
 
-async def update_ping(loop):
+async def update_ping():
     while True:
         await asyncio.sleep(5)
 
@@ -186,33 +178,30 @@ async def update_ping(loop):
             if new_ping_status != ping_status:
                 ping_status.clear()
                 ping_status.update(new_ping_status)
-                loop.call_soon_threadsafe(update_map)
+                update_map()
         except:
             logging.exception('An error while pinging the machines')
 
 
-async def poll_all():
-    udbsync_client = prologin.udbsync.client.connect()
-    mdbsync_client = prologin.mdbsync.client.connect()
-    presencesync_client = prologin.presencesync.client.connect()
-
-    loop = asyncio.get_event_loop()
-
-    tasks = []
-
-    def add_task(client, dict_to_update):
-        def cb(values, meta):
-            dict_to_update.clear()
-            dict_to_update.update(values)
-            loop.call_soon_threadsafe(update_map)
-        tasks.append(loop.run_in_executor(None, client.poll_updates, cb))
+async def follow(client, name, records, fields=None):
+    cache_path = prologin.synchronisation.cache_path(name)
+    async for _ in client.subscribe(fields=fields, cache_path=cache_path,
+                                    records=records):
+        update_map()
 
-    add_task(mdbsync_client, mdb_machines)
-    add_task(udbsync_client, udb_users)
-    add_task(presencesync_client, presence_data)
-    tasks.append(update_ping(loop))
 
-    await asyncio.wait(tasks)
+async def poll_all():
+    udbsync_client = prologin.udbsync.client.connect_async()
+    mdbsync_client = prologin.mdbsync.client.connect_async()
+    presencesync_client = prologin.presencesync.client.connect_async()
+
+    await asyncio.wait([
+        follow(mdbsync_client, 'mdbsync', mdb_machines,
+               {'hostname', 'is_faulty'}),
+        follow(udbsync_client, 'udbsync', udb_users, {'group'}),
+        follow(presencesync_client, 'presencesync', presence_data),
+        update_ping(),
+    ])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,333 @@
+# This file is part of Prologin-SADM.
+#
+# Prologin-SADM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Prologin-SADM is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Prologin-SADM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Persistent bidirectional channels between RPC applications.
+
+A channel is a WebSocket opened by a client to the /channel route of an RPC
+application. Once it is open, both ends can call the remote methods of the
+other one: calls and their results are sent as framed messages, without
+the cost of a new HTTP request, and each end notices immediately when the
+other one goes away.
+
+The client authenticates once, when opening the channel, using a timeauth
+token in the X-RPC-Token header. Calls sent through the channel are then
+trusted. Frames are encoded using JSON (text frames) or msgpack (binary
+frames): the server picks the encoding from the Accept header of the
+handshake and the client answers with the encoding of the server frames.
+
+Both ends ping each other, and close the channel if the other one does not
+answer: calls do not wait forever on a connection that silently died.
+Streamed arguments are not sent through channels but as regular HTTP calls,
+so that they are never held in memory.
+"""
+
+import aiohttp
+import aiohttp.web
+import asyncio
+import inspect
+import logging
+import prologin.timeauth
+
+from urllib.parse import urlencode, urljoin
+
+from . import client
+from . import encoding
+from . import monitoring
+
+TOKEN_HEADER = 'X-RPC-Token'
+
+# Message authenticated by the handshake token.
+TOKEN_MESSAGE = 'channel'
+
+# Number of seconds between two WebSocket pings. The channel is closed if
+# the other end does not answer a ping within half this delay.
+HEARTBEAT = 10
+
+# Number of seconds a call waits for its result before the channel is
+# considered dead.
+CALL_TIMEOUT = 60
+
+
+class BytesStream:
+    """Reader for streamed arguments that were sent through a channel, with
+    the same interface as the StreamReader used for HTTP calls.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    async def read(self, size=-1):
+        if size < 0:
+            size = len(self.data) - self.position
+        chunk = self.data[self.position:self.position + size]
+        self.position += len(chunk)
+        return chunk
+
+
+class Channel:
+    """One end of a channel.
+
+    Incoming calls are run using `dispatch(method_name, args, kwargs)`, a
+    coroutine function. Outgoing calls are made with `call`, and fail after
+    `timeout` seconds. `params` are the parameters the client sent when
+    opening the channel.
+    """
+
+    def __init__(self, ws, dispatch, content_type=encoding.JSON, params=None,
+                 peer=None, session=None, timeout=CALL_TIMEOUT):
+        self.ws = ws
+        self.dispatch = dispatch
+        self.content_type = content_type
+        self.params = params or {}
+        self.peer = peer
+        # Client session owning the WebSocket, on the client end.
+        self.session = session
+        self.timeout = timeout
+        self.pending = {}
+        self.last_id = 0
+        self.closed = False
+
+    def __repr__(self):
+        return '<Channel: {}>'.format(self.peer)
+
+    async def send(self, message):
+        data = encoding.encode(message, self.content_type)
+        if self.content_type == encoding.MSGPACK:
+            sent = self.ws.send_bytes(data)
+        else:
+            sent = self.ws.send_str(data.decode())
+        if inspect.isawaitable(sent):
+            await sent
+
+    async def call(self, method, args, kwargs):
+        """Call the remote `method` at the other end of the channel and
+        return its result. Raise a RemoteError if it raised, or a
+        ConnectionResetError if the channel is closed before it returns.
+
+        If the result does not come within the channel timeout, the other
+        end is deemed unresponsive: the channel is closed and all its pending
+        calls fail.
+        """
+        if self.closed:
+            raise ConnectionResetError('{!r} is closed'.format(self))
+
+        self.last_id += 1
+        call_id = self.last_id
+        future = asyncio.get_event_loop().create_future()
+        self.pending[call_id] = future
+        try:
+            try:
+                await self.send({
+                    'type': 'call',
+                    'id': call_id,
+                    'method': method,
+                    'args': list(args),
+                    'kwargs': kwargs,
+                })
+            except (TypeError, ValueError):
+                raise ValueError('non serializable argument types')
+            except RuntimeError as exn:
+                # The WebSocket is closing.
+                raise ConnectionResetError(str(exn)) from exn
+            try:
+                return (await asyncio.wait_for(future, self.timeout))
+            except asyncio.TimeoutError:
+                logging.warning('%r: %s timed out, closing the channel',
+                                self, method)
+                self._abort()
+                raise ConnectionResetError('{!r}: {} timed out'.format(
+                    self, method))
+        finally:
+            self.pending.pop(call_id, None)
+
+    async def run(self):
+        """Process incoming messages until the channel is closed."""
+        monitoring.rpc_channels.inc()
+        try:
+            async for msg in self.ws:
+                if msg.type == aiohttp.WSMsgType.TEXT:
+                    body, content_type = msg.data.encode(), encoding.JSON
+                elif msg.type == aiohttp.WSMsgType.BINARY:
+                    body, content_type = msg.data, encoding.MSGPACK
+                else:
+                    break
+                try:
+                    self._receive(encoding.decode(body, content_type))
+                except (encoding.DecodeError, KeyError, TypeError) as exn:
+                    logging.warning('%r: invalid message: %s', self, exn)
+        finally:
+            monitoring.rpc_channels.dec()
+            self.closed = True
+            self._fail_pending()
+            if self.session is not None:
+                self.session.close()
+
+    async def close(self):
+        """Close the channel. `run` returns once it is closed."""
+        self.closed = True
+        await self.ws.close()
+
+    def _abort(self):
+        """Fail the pending calls and close the channel in the background."""
+        self.closed = True
+        self._fail_pending()
+        asyncio.ensure_future(self.ws.close())
+
+    def _fail_pending(self):
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionResetError(
+                    '{!r} was closed'.format(self)))
+
+    def _receive(self, message):
+        if not isinstance(message, dict):
+            raise TypeError('{!r} is not an object'.format(message))
+        if message['type'] == 'call':
+            # The call task needs both to answer.
+            if 'id' not in message or 'method' not in message:
+                raise KeyError('calls need an id and a method')
+            asyncio.ensure_future(self._handle_call(message))
+            return
+
+        future = self.pending.get(message['id'])
+        if future is None or future.done():
+            return
+        if message['type'] == 'result':
+            future.set_result(message['data'])
+        elif message.get('retry_after') is not None:
+            future.set_exception(client.ServerBusy(
+                message['exn_type'], message['exn_message'],
+                message['retry_after']))
+        else:
+            future.set_exception(client.RemoteError(
+                message['exn_type'], message['exn_message']))
+
+    async def _handle_call(self, message):
+        try:
+            result = await self.dispatch(message['method'],
+                                         message.get('args', []),
+                                         message.get('kwargs', {}))
+            reply = {'type': 'result', 'data': result}
+        except Exception as exn:
+            reply = self._exception_message(exn)
+        reply['id'] = message['id']
+
+        try:
+            try:
+                await self.send(reply)
+            except (TypeError, ValueError):
+                reply = self._exception_message(ValueError(
+                    'The remote method returned something not serializable'))
+                reply['id'] = message['id']
+                await self.send(reply)
+        except RuntimeError:
+            logging.warning('%r closed, cannot answer %s', self,
+                            message['method'])
+
+    @staticmethod
+    def _exception_message(exn):
+        return {
+            'type': 'exception',
+            'exn_type': type(exn).__name__,
+            'exn_message': str(exn),
+            'retry_after': getattr(exn, 'retry_after', None),
+        }
+
+
+async def serve(request):
+    """aiohttp handler opening the server end of a channel to the RPC
+    application of the request.
+    """
+    app = request.app
+    if app.secret is not None:
+        token = request.headers.get(TOKEN_HEADER)
+        if not app.token_verifier.check(token, TOKEN_MESSAGE):
+            raise aiohttp.web.HTTPForbidden()
+
+    ws = aiohttp.web.WebSocketResponse(heartbeat=HEARTBEAT)
+    await ws.prepare(request)
+
+    rpc_object = app.rpc_object
+    peername = request.transport.get_extra_info('peername')
+    channel = Channel(ws, rpc_object.dispatch_call,
+                      encoding.negotiate(request.headers.get('Accept')),
+                      params=dict(request.rel_url.query), peer=peername)
+    # Let the client know which encoding we picked.
+    await channel.send({'type': 'hello'})
+
+    rpc_object.channel_opened(channel)
+    try:
+        await channel.run()
+    finally:
+        rpc_object.channel_closed(channel)
+    return ws
+
+
+async def connect(base_url, secret, dispatch, params=None,
+                  heartbeat=HEARTBEAT):
+    """Open a channel to the RPC application at `base_url`, running the
+    calls it receives with `dispatch` and pinging it every `heartbeat`
+    seconds. Raise a ConnectionError if it cannot be opened. Call `run` on
+    the returned channel to process messages.
+    """
+    url = urljoin(base_url, 'channel')
+    if params:
+        url += '?' + urlencode(params)
+    headers = {'Accept': encoding.accept_header()}
+    if secret:
+        headers[TOKEN_HEADER] = prologin.timeauth.generate_token(
+            secret, TOKEN_MESSAGE)
+
+    session = client.session_pool.create_session()
+    try:
+        ws = await session.ws_connect(url, headers=headers,
+                                      heartbeat=heartbeat)
+        hello = await ws.receive()
+    except aiohttp.ClientError as exn:
+        session.close()
+        raise ConnectionError('cannot open a channel to {}: {}'.format(
+            base_url, exn)) from exn
+
+    if hello.type == aiohttp.WSMsgType.TEXT:
+        content_type = encoding.JSON
+    elif hello.type == aiohttp.WSMsgType.BINARY:
+        content_type = encoding.MSGPACK
+    else:
+        session.close()
+        raise ConnectionError('{} closed the channel'.format(base_url))
+
+    return Channel(ws, dispatch, content_type, params=params,
+                   peer=client.SessionPool.peer(base_url), session=session)
+
+
+class ChannelClient(client.Client):
+    """RPC client sending its calls through `channel` while it is open, and
+    as regular HTTP calls to `base_url` otherwise.
+
+    Calls with streamed arguments are always sent as HTTP calls, so that
+    the arguments are streamed instead of being read in memory.
+    """
+
+    def __init__(self, base_url, secret=None, channel=None, **kwargs):
+        super().__init__(base_url, secret, **kwargs)
+        self.channel = channel
+
+    async def _call_method(self, method, args, kwargs):
+        channel = self.channel
+        if (channel is None or channel.closed or
+                any(client.is_stream(value) for value in kwargs.values())):
+            return (await super()._call_method(method, args, kwargs))
+        return (await channel.call(method, args, kwargs))
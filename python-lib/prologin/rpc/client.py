@@ -13,14 +13,24 @@
 
 import asyncio
 import aiohttp
-import json
+import inspect
 import prologin.timeauth
+import random
 import socket
+import threading
+import time
 import urllib.request
 import logging
 
 from contextlib import closing
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlsplit
+
+from . import encoding
+from . import monitoring
+
+# Size of the chunks read from streamed file objects.
+STREAM_CHUNK_SIZE = 64 * 1024
+
 
 class BaseError(Exception):
     """Base class for all exceptions here."""
@@ -38,27 +48,288 @@ class RemoteError(BaseError):
         super(RemoteError, self).__init__(type, message)
 
 
+class CircuitOpenError(ConnectionError):
+    """Raised instead of calling a peer that is known to be down. It is a
+    socket.error, so callers handle it like a connection failure.
+    """
+    pass
+
+
+class ServerBusy(RemoteError):
+    """Raised when the server rejected the call because it has too many
+    pending calls. `retry_after` is the delay it asks to wait before
+    retrying, in seconds.
+    """
+    def __init__(self, type, message, retry_after):
+        super(ServerBusy, self).__init__(type, message)
+        self.retry_after = retry_after
+
+
+def is_stream(value):
+    """Return whether `value` must be sent as a streamed argument: binary
+    file objects and async iterators of bytes are.
+    """
+    return hasattr(value, 'read') or hasattr(value, '__aiter__')
+
+
+def _rewind_points(kwargs):
+    """Return the current position of seekable streamed arguments, so that
+    they can be sent again when a call is retried.
+    """
+    return {
+        name: value.tell() for name, value in kwargs.items()
+        if is_stream(value) and getattr(value, 'seekable', lambda: False)()
+    }
+
+
+async def _write_chunk(writer, chunk):
+    # aiohttp only returns something to wait for when its buffer is full.
+    drain = writer.write(chunk)
+    if inspect.isawaitable(drain):
+        await drain
+
+
+def backoff_delay(attempt, base, maximum=None):
+    """Return how long to wait before the retry number `attempt` (starting
+    at 0): the delay doubles at each attempt from `base`, up to `maximum`,
+    and half of it is random so that clients that failed together do not
+    retry together.
+    """
+    delay = base * 2 ** attempt
+    if maximum is not None:
+        delay = min(delay, maximum)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+@aiohttp.streamer
+async def _stream_body(writer, message, source):
+    await _write_chunk(writer, message)
+    if hasattr(source, '__aiter__'):
+        async for chunk in source:
+            await _write_chunk(writer, chunk)
+    else:
+        while True:
+            chunk = source.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            await _write_chunk(writer, chunk)
+
+
+class SessionPool:
+    """Pool of long-lived HTTP sessions, one per (event loop, peer).
+
+    Sessions keep their TCP connections alive between calls, so that hot
+    paths such as heartbeats do not pay for a TCP handshake and a DNS lookup
+    on each call. Sessions are bound to the event loop they were created in,
+    hence the loop being part of the pool key.
+    """
+
+    def __init__(self, limit=100, limit_per_host=8, keepalive_timeout=30):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def peer(base_url):
+        """Return the part of `base_url` that identifies a remote peer."""
+        url = urlsplit(base_url)
+        return '{}://{}'.format(url.scheme, url.netloc)
+
+    def create_session(self, loop=None):
+        """Return a brand new session that is not tracked by the pool."""
+        loop = loop or asyncio.get_event_loop()
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            loop=loop)
+        return aiohttp.ClientSession(connector=connector, loop=loop)
+
+    def get(self, base_url, loop=None):
+        """Return the pooled session to use for `base_url`, creating it if
+        needed.
+        """
+        loop = loop or asyncio.get_event_loop()
+        peer = self.peer(base_url)
+        key = (loop, peer)
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is not None and not session.closed:
+                monitoring.rpc_session_pool_hit.labels(peer=peer).inc()
+                return session
+            monitoring.rpc_session_pool_miss.labels(peer=peer).inc()
+            session = self.create_session(loop)
+            self.sessions[key] = session
+            return session
+
+    def close(self, loop=None):
+        """Close all the sessions bound to `loop`, or all the sessions if
+        `loop` is None.
+        """
+        with self.lock:
+            for key in list(self.sessions):
+                if loop is None or key[0] is loop:
+                    self.sessions.pop(key).close()
+
+
+class CircuitBreaker:
+    """Circuit breaker for a remote peer.
+
+    After `failure_threshold` consecutive connection failures, the circuit
+    opens: calls fail fast with CircuitOpenError instead of waiting for the
+    peer. After `reset_timeout` seconds, a single call is let through
+    (half-open state): the circuit closes if it succeeds, and opens again if
+    it fails.
+    """
+
+    # Values of the rpc_circuit_state gauge.
+    CLOSED = 0
+    OPEN = 1
+    HALF_OPEN = 2
+
+    def __init__(self, peer, failure_threshold=5, reset_timeout=10):
+        self.peer = peer
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+        self._set_state(self.CLOSED)
+
+    def _set_state(self, state):
+        self.state = state
+        monitoring.rpc_circuit_state.labels(peer=self.peer).set(state)
+
+    def check(self):
+        """Raise CircuitOpenError if calls to the peer must fail fast."""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return
+            # Let this call probe the peer. In the half-open state, this
+            # means the previous probe never completed (e.g. cancelled).
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.opened_at = time.monotonic()
+                self._set_state(self.HALF_OPEN)
+                return
+            raise CircuitOpenError('{} is down'.format(self.peer))
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            if self.state != self.CLOSED:
+                logging.info('<%s> is back up', self.peer)
+                self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if (self.state == self.HALF_OPEN or
+                    (self.state == self.CLOSED and
+                     self.failures >= self.failure_threshold)):
+                logging.warning('<%s> is down, failing fast for %ss',
+                                self.peer, self.reset_timeout)
+                self.opened_at = time.monotonic()
+                self._set_state(self.OPEN)
+
+
+class CircuitBreakers:
+    """Registry of circuit breakers, one per peer."""
+
+    def __init__(self, failure_threshold=5, reset_timeout=10):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def get(self, base_url):
+        """Return the circuit breaker of the peer of `base_url`."""
+        peer = SessionPool.peer(base_url)
+        with self.lock:
+            breaker = self.breakers.get(peer)
+            if breaker is None:
+                breaker = CircuitBreaker(peer, self.failure_threshold,
+                                         self.reset_timeout)
+                self.breakers[peer] = breaker
+            return breaker
+
+
+# Pool used by clients that do not own a session.
+session_pool = SessionPool()
+
+# Circuit breakers shared by all clients.
+circuit_breakers = CircuitBreakers()
+
+# Content type to use to send requests to each peer. Peers are sent JSON until
+# they prove they understand something better.
+peer_encodings = {}
+
+
 class Client:
-    """RPC client: connect to a server and perform remote calls."""
+    """RPC client: connect to a server and perform remote calls.
+
+    Calls use a session from `pool` (the global pool by default). Clients can
+    also be used as async context managers, in which case they own a private
+    session for the duration of the block:
 
-    def __init__(self, base_url, secret=None):
+        async with Client(url) as client:
+            await client.heartbeat()
+    """
+
+    def __init__(self, base_url, secret=None, pool=None, breakers=None):
         self.base_url = base_url
         self.secret = secret
+        self.pool = pool or session_pool
+        self.breakers = breakers or circuit_breakers
+        self.session = None
+
+    async def __aenter__(self):
+        self.session = self.pool.create_session()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.session.close()
+        self.session = None
 
-    def _handle_exception(self, data):
+    def _get_session(self):
+        if self.session is not None:
+            return self.session
+        return self.pool.get(self.base_url)
+
+    def _handle_exception(self, data, req):
         """Handle an exception from a remote call."""
+        if req.status == 503 and 'Retry-After' in req.headers:
+            try:
+                retry_after = float(req.headers['Retry-After'])
+            except ValueError:
+                retry_after = 1
+            raise ServerBusy(data['exn_type'], data['exn_message'],
+                             retry_after)
         raise RemoteError(data['exn_type'], data['exn_message'])
 
     async def _call_method(self, method, args, kwargs):
         """Call the remote `method` passing `args` and `kwargs` to it.
 
-        `args` must be a JSON-serializable list of positional arguments while
-        `kwargs` must be a JSON-serializable dictionary of keyword arguments.
+        `args` must be a serializable list of positional arguments while
+        `kwargs` must be a serializable dictionary of keyword arguments.
+        `bytes` values are sent as binary data when the peer supports it.
+
+        At most one keyword argument can be a binary file object or an async
+        iterator of bytes: it is then streamed in the request body. The
+        remote method must declare it with `remote_method(stream=...)`.
 
         Depending on what happens in the remote method, return a result, or
         raise a RemoteError. Raise an InternalError for anything else.
         """
 
+        streams = [(k, v) for k, v in kwargs.items() if is_stream(v)]
+        if len(streams) > 1:
+            raise ValueError('cannot stream more than one argument')
+        stream = streams[0] if streams else None
+        if stream is not None:
+            kwargs = {k: v for k, v in kwargs.items() if k != stream[0]}
+
         # Serialize arguments and send the request...
         arguments = {
             'args': args,
@@ -69,24 +340,123 @@ class Client:
         if self.secret:
             arguments['hmac'] = prologin.timeauth.generate_token(self.secret,
                                                                  method)
+        return (await self._post('call/{}'.format(method), arguments,
+                                 stream=stream))
+
+    async def batch(self, calls, concurrent=True):
+        """Perform several remote calls in a single request.
+
+        `calls` is an iterable of (method, args, kwargs) tuples. Unless
+        `concurrent` is false, the server runs them concurrently. Return the
+        list of results, in the same order as `calls`. A call that raised
+        gets a RemoteError instance (returned, not raised) as a result.
+        """
+        batch_calls = []
+        for method, args, kwargs in calls:
+            call = {
+                'method': method,
+                'args': list(args),
+                'kwargs': kwargs,
+            }
+            if self.secret:
+                call['hmac'] = prologin.timeauth.generate_token(self.secret,
+                                                                method)
+            batch_calls.append(call)
+
+        return (await self._post('batch', {
+            'calls': batch_calls,
+            'concurrent': concurrent,
+        }))
+
+    async def _post(self, path, arguments, stream=None):
+        peer = self.pool.peer(self.base_url)
+        content_type = peer_encodings.get(peer, encoding.JSON)
+        req, body = await self._send(path, arguments, content_type, stream)
+        if content_type != encoding.JSON and self._rejects_encoding(req, body):
+            # The peer no longer understands `content_type`, e.g. it was
+            # downgraded: go back to JSON. Streams cannot be sent twice.
+            peer_encodings.pop(peer, None)
+            if stream is None:
+                req, body = await self._send(path, arguments, encoding.JSON)
+        return self._request_work(req, body)
+
+    async def _send(self, path, arguments, content_type, stream=None):
+        """Send `arguments` encoded using `content_type` to `path`, and
+        return the response and its body.
+        """
+        peer = self.pool.peer(self.base_url)
         try:
-            req_data = json.dumps(arguments)
+            data = encoding.encode(arguments, content_type)
         except (TypeError, ValueError):
             raise ValueError('non serializable argument types')
+        labels = {'method': path.rsplit('/', 1)[-1], 'peer': peer}
+        monitoring.rpc_call_out_request_bytes.labels(**labels).observe(
+            len(data))
+
+        url = urljoin(self.base_url, path)
+        headers = {
+            'Content-Type': content_type,
+            'Accept': encoding.accept_header(),
+        }
+        if stream is not None:
+            name, source = stream
+            headers.update({
+                'Content-Type': 'application/octet-stream',
+                encoding.STREAM_HEADER: name,
+                encoding.TYPE_HEADER: content_type,
+                encoding.LENGTH_HEADER: str(len(data)),
+            })
+            data = _stream_body(data, source)
 
-        url = urljoin(self.base_url, 'call/{}'.format(method))
-        data = '{}\n'.format(req_data).encode('ascii')
+        breaker = self.breakers.get(self.base_url)
+        start = time.monotonic()
+        try:
+            breaker.check()
+            session = self._get_session()
+            async with session.post(url, data=data, headers=headers) as req:
+                breaker.record_success()
+                body = await req.read()
+                monitoring.rpc_call_out_response_bytes.labels(
+                    **labels).observe(len(body))
+                return req, body
+        except Exception as exn:
+            monitoring.rpc_call_out_failures.labels(
+                error=type(exn).__name__, **labels).inc()
+            if (isinstance(exn, socket.error) and
+                    not isinstance(exn, CircuitOpenError)):
+                breaker.record_failure()
+            raise
+        finally:
+            monitoring.rpc_call_out.labels(**labels).observe(
+                time.monotonic() - start)
 
-        # FIXME(seirl): use a global session and async with?
-        # This would require to have client as a context manager :/
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, data=data) as req:
-                return (await self._request_work(req))
+    @staticmethod
+    def _rejects_encoding(req, body):
+        """Return whether the response `req` tells that the peer could not
+        decode the request message.
+        """
+        if req.status == 415:
+            return True
+        if (req.status != 400 or
+                req.content_type not in (encoding.JSON, encoding.MSGPACK)):
+            return False
+        try:
+            result = encoding.decode(body, req.content_type)
+            return result.get('exn_type') == 'DecodeError'
+        except (encoding.DecodeError, AttributeError):
+            return False
+
+    def _request_work(self, req, body):
+        if req.content_type in (encoding.JSON, encoding.MSGPACK):
+            # Remember what the peer answers with, so that the next requests
+            # are sent using the same encoding.
+            peer_encodings[self.pool.peer(self.base_url)] = req.content_type
 
-    async def _request_work(self, req):
-        if req.headers['Content-Type'] == 'application/json':
             # The remote call returned: we can have a result or an exception.
-            result = await req.json()
+            try:
+                result = encoding.decode(body, req.content_type)
+            except encoding.DecodeError as exn:
+                raise InternalError('Invalid response: {}'.format(exn))
 
             if result['type'] == 'result':
                 # There is nothing more to do than returning the actual
@@ -95,7 +465,15 @@ class Client:
 
             elif result['type'] == 'exception':
                 # Just raise a RemoteError with interesting data.
-                self._handle_exception(result)
+                self._handle_exception(result, req)
+
+            elif result['type'] == 'batch':
+                # Unpack each result, keeping exceptions as values.
+                return [
+                    r['data'] if r['type'] == 'result'
+                    else RemoteError(r['exn_type'], r['exn_message'])
+                    for r in result['data']
+                ]
 
             else:
                 # There should not be any other possibility.
@@ -104,35 +482,102 @@ class Client:
                 )
         else:
             # Something went wrong before reaching the remote procedure...
-            raise InternalError(req.text)
+            raise InternalError(body.decode(errors='replace'))
 
     def __getattr__(self, method):
         """Return a callable to invoke a remote procedure."""
-        async def proxy(*args, max_retries=0, retry_delay=10, **kwargs):
+        async def proxy(*args, max_retries=0, retry_delay=10,
+                        retry_max_delay=300, **kwargs):
+            """Call the remote method, retrying up to `max_retries` times
+            if the peer is down or busy. Retries back off exponentially from
+            `retry_delay` up to `retry_max_delay` seconds.
+            """
+            rewind_points = _rewind_points(kwargs)
+            peer = self.pool.peer(self.base_url)
             for i in range(max_retries + 1):
                 try:
                     return (await self._call_method(method, args, kwargs))
                 except socket.error:
                     if i < max_retries:
+                        delay = backoff_delay(i, retry_delay, retry_max_delay)
                         logging.warning('<%s> down, cannot call %s. '
-                                        'Retrying in %ss...', self.base_url,
-                                        method, retry_delay)
-                        await asyncio.sleep(retry_delay)
+                                        'Retrying in %.1fs...', self.base_url,
+                                        method, delay)
+                        await asyncio.sleep(delay)
                     else:
                         raise
+                except ServerBusy as exn:
+                    if i < max_retries:
+                        # Wait at least as long as the server asked.
+                        delay = max(exn.retry_after, backoff_delay(
+                            i, exn.retry_after, retry_max_delay))
+                        logging.warning('<%s> busy, cannot call %s. '
+                                        'Retrying in %.1fs...', self.base_url,
+                                        method, delay)
+                        await asyncio.sleep(delay)
+                    else:
+                        raise
+                monitoring.rpc_call_retries.labels(method=method,
+                                                   peer=peer).inc()
+                for name, position in rewind_points.items():
+                    kwargs[name].seek(position)
 
         return proxy
 
 
+class LoopThread(threading.Thread):
+    """Background thread running an event loop forever. Synchronous clients
+    submit their calls to it, so that they share its pooled sessions instead
+    of setting up a new loop and new connections for each call.
+    """
+
+    def __init__(self):
+        super().__init__(name='rpc-client-loop', daemon=True)
+        self.loop = asyncio.new_event_loop()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def run_coroutine(self, coro):
+        """Run `coro` in the loop and wait for its result. Thread-safe."""
+        if threading.current_thread() is self:
+            raise RuntimeError('cannot wait for a call from the loop thread')
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+
+_loop_thread = None
+_loop_thread_lock = threading.Lock()
+
+
+def get_loop_thread():
+    """Return the loop thread shared by all synchronous clients, starting it
+    if needed (including in processes forked after it was started).
+    """
+    global _loop_thread
+    with _loop_thread_lock:
+        if _loop_thread is None or not _loop_thread.is_alive():
+            _loop_thread = LoopThread()
+            _loop_thread.start()
+        return _loop_thread
+
+
 class SyncClient(Client):
+    """Blocking RPC client. Calls can be made from any thread: they all run
+    in the shared loop thread.
+    """
+
+    def _run(self, coro):
+        return get_loop_thread().run_coroutine(coro)
+
+    def batch(self, *args, **kwargs):
+        return self._run(super().batch(*args, **kwargs))
+
     def __getattr__(self, method):
         coro = super().__getattr__(method)
 
         def proxy(*args, **kwargs):
-            loop = asyncio.new_event_loop()
-            res = loop.run_until_complete(coro(*args, **kwargs))
-            loop.close()
-            return res
+            return self._run(coro(*args, **kwargs))
 
         return proxy
 
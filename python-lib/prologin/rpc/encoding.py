@@ -0,0 +1,105 @@
+# This file is part of Prologin-SADM.
+#
+# Prologin-SADM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Prologin-SADM is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Prologin-SADM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Encodings for RPC messages.
+
+Peers negotiate the encoding using the Content-Type and Accept headers. When
+msgpack is available on both sides, messages are sent as msgpack and `bytes`
+values travel as raw binary strings. Otherwise, messages are sent as JSON and
+`bytes` values are wrapped in a {"__bytes__": "<base64>"} object.
+"""
+
+import base64
+import prologin.jsoncodec
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+
+# Headers of calls that stream an argument: the body is made of the encoded
+# call message (whose type and length are given by headers) followed by the
+# raw bytes of the streamed argument, whose name is in STREAM_HEADER.
+STREAM_HEADER = 'X-RPC-Stream'
+TYPE_HEADER = 'X-RPC-Message-Type'
+LENGTH_HEADER = 'X-RPC-Message-Length'
+
+
+class DecodeError(ValueError):
+    """Raised when a message cannot be decoded."""
+    pass
+
+
+def supported():
+    """Return the content types we can handle, the preferred one first."""
+    if msgpack is not None:
+        return [MSGPACK, JSON]
+    return [JSON]
+
+
+def accept_header():
+    """Return the Accept header value to send to peers."""
+    return ', '.join(supported())
+
+
+def negotiate(accept):
+    """Return the best content type to answer a peer that sent `accept` as
+    its Accept header. Default to JSON, which every peer understands.
+    """
+    if accept:
+        accepted = {t.split(';')[0].strip() for t in accept.split(',')}
+        for content_type in supported():
+            if content_type in accepted:
+                return content_type
+    return JSON
+
+
+def _json_default(obj):
+    if isinstance(obj, (bytes, bytearray)):
+        return {'__bytes__': base64.b64encode(obj).decode('ascii')}
+    raise TypeError('{!r} is not JSON serializable'.format(obj))
+
+
+def _json_object_hook(obj):
+    if len(obj) == 1 and '__bytes__' in obj:
+        return base64.b64decode(obj['__bytes__'])
+    return obj
+
+
+def encode(data, content_type=JSON):
+    """Encode `data` to bytes using `content_type`. Raise a TypeError or a
+    ValueError if `data` is not serializable.
+    """
+    if content_type == MSGPACK:
+        return msgpack.packb(data, use_bin_type=True)
+    return prologin.jsoncodec.dumpb(data, default=_json_default) + b'\n'
+
+
+def decode(body, content_type=JSON):
+    """Decode `body` (bytes) that was encoded using `content_type`."""
+    try:
+        if content_type == MSGPACK:
+            if msgpack is None:
+                raise ValueError('msgpack is not available')
+            return msgpack.unpackb(body, raw=False)
+        # Only walk the decoded message when it may contain bytes.
+        object_hook = _json_object_hook if b'__bytes__' in body else None
+        return prologin.jsoncodec.loads(body, object_hook=object_hook)
+    except Exception as exn:
+        raise DecodeError(str(exn)) from exn
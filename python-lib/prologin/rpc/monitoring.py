@@ -18,7 +18,8 @@
 
 from functools import wraps
 
-from prometheus_client import start_http_server, Summary
+from prometheus_client import (start_http_server, Counter, Gauge, Histogram,
+                               Summary)
 
 
 rpc_call_in = Summary(
@@ -29,15 +30,97 @@ rpc_call_in = Summary(
 
 def _observe_rpc_call_in(f):
     @wraps(f)
-    async def _wrapper(self):
+    async def _wrapper(self, *args, **kwargs):
         with rpc_call_in.labels(method=self.method_name).time():
-            return (await f(self))
+            return (await f(self, *args, **kwargs))
 
     return _wrapper
 
 
-rpc_call_out = Summary(
+rpc_call_in_phase = Summary(
+        'rpc_call_in_phase',
+        'Summary of the time spent in each phase of the rpc calls received: '
+        'read, decode, auth, execute and encode',
+        ['method', 'phase'])
+
+
+def observe_rpc_call_in_phase(method, phase):
+    """Return a context manager timing `phase` of a call to `method`."""
+    return rpc_call_in_phase.labels(method=method, phase=phase).time()
+
+
+rpc_channels = Gauge(
+        'rpc_channels',
+        'Number of open rpc channels')
+
+rpc_queue_depth = Gauge(
+        'rpc_queue_depth',
+        'Number of rpc calls waiting for their turn',
+        ['method'])
+
+rpc_rejected = Counter(
+        'rpc_rejected',
+        'Number of rpc calls rejected because of too many pending calls',
+        ['method'])
+
+
+rpc_cache_hit = Counter(
+        'rpc_cache_hit',
+        'Number of rpc calls answered from the response cache',
+        ['method'])
+
+rpc_cache_miss = Counter(
+        'rpc_cache_miss',
+        'Number of cacheable rpc calls that were not in the response cache',
+        ['method'])
+
+
+# Bucket upper bounds of the message size histograms, in bytes.
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304,
+                16777216, float('inf'))
+
+rpc_call_out = Histogram(
         'rpc_call_out',
-        'Summary of the rpc calls sent')
+        'Histogram of the duration of the rpc calls sent',
+        ['method', 'peer'])
+
+rpc_call_out_request_bytes = Histogram(
+        'rpc_call_out_request_bytes',
+        'Histogram of the size of the rpc call messages sent '
+        '(streamed arguments excluded)',
+        ['method', 'peer'],
+        buckets=SIZE_BUCKETS)
+
+rpc_call_out_response_bytes = Histogram(
+        'rpc_call_out_response_bytes',
+        'Histogram of the size of the rpc responses received',
+        ['method', 'peer'],
+        buckets=SIZE_BUCKETS)
+
+rpc_call_out_failures = Counter(
+        'rpc_call_out_failures',
+        'Number of rpc calls sent that failed, by exception type',
+        ['method', 'peer', 'error'])
+
+rpc_call_retries = Counter(
+        'rpc_call_retries',
+        'Number of rpc calls retried because the peer was down or busy',
+        ['method', 'peer'])
+
+rpc_circuit_state = Gauge(
+        'rpc_circuit_state',
+        'State of the circuit breaker of each peer '
+        '(0: closed, 1: open, 2: half-open)',
+        ['peer'])
+
+rpc_session_pool_hit = Counter(
+        'rpc_session_pool_hit',
+        'Number of rpc calls that reused a pooled HTTP session',
+        ['peer'])
+
+rpc_session_pool_miss = Counter(
+        'rpc_session_pool_miss',
+        'Number of rpc calls that had to create a new HTTP session',
+        ['peer'])
 
 # Monitoring is started by the application using the rpc library
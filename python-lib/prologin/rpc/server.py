@@ -12,17 +12,27 @@
 # along with Prologin-SADM.  If not, see <http://www.gnu.org/licenses/>.
 
 import aiohttp.web
+import asyncio
+import collections
 import functools
 import inspect
-import json
 import logging
 import sys
+import threading
+import time
 import traceback
 
+import prologin.jsoncodec
+import prologin.timeauth
 import prologin.web
 
+from . import channel
+from . import encoding
 from . import monitoring
 
+# Maximum number of calls in a batch.
+MAX_BATCH_SIZE = 100
+
 
 class MethodError(Exception):
     """Exception used to notice the remote callers that the requested method
@@ -45,12 +55,44 @@ class MissingToken(Exception):
     pass
 
 
-def remote_method(func=None, *, auth_required=True):
-    """Decorator for methods to be callable remotely."""
+class ServerBusy(Exception):
+    """Exception used to notice the remote callers that the method has too
+    many pending calls and that they should retry later.
+    """
+    pass
+
+
+def remote_method(func=None, *, auth_required=True, stream=None,
+                  max_concurrency=None, queue=0, retry_after=1,
+                  cacheable=False):
+    """Decorator for methods to be callable remotely.
+
+    If `stream` is the name of a keyword argument, callers can send its value
+    as a byte stream. The method then receives an aiohttp StreamReader fed
+    from the request body: read chunks with `await stream.read(size)` until
+    it returns b''. The stream must be consumed before the method returns.
+
+    If `max_concurrency` is not None, at most that many calls run at once
+    and at most `queue` calls wait for their turn. Other calls are rejected
+    with a 503 error asking to retry after `retry_after` seconds.
+
+    If `cacheable` is True, the method must only depend on its arguments and
+    on data whose changes invalidate the application response cache: its
+    encoded responses are then cached and served without calling it.
+    """
     if func is None:
-        return functools.partial(remote_method, auth_required=auth_required)
+        return functools.partial(remote_method, auth_required=auth_required,
+                                 stream=stream,
+                                 max_concurrency=max_concurrency,
+                                 queue=queue, retry_after=retry_after,
+                                 cacheable=cacheable)
     func.remote_method = True
     func.auth_required = auth_required
+    func.stream = stream
+    func.max_concurrency = max_concurrency
+    func.queue = queue
+    func.retry_after = retry_after
+    func.cacheable = cacheable
     return func
 
 
@@ -79,11 +121,148 @@ class MethodCollection(type):
         cls.REMOTE_METHODS = remote_methods
 
 
+class Admission:
+    """Admission control for a remote method: let at most `max_concurrency`
+    calls run at once and at most `queue` calls wait for their turn. Use it
+    as an async context manager around calls: it raises ServerBusy if the
+    call has to be rejected.
+    """
+
+    def __init__(self, method_name, max_concurrency, queue, retry_after,
+                 loop=None):
+        self.method_name = method_name
+        self.queue = queue
+        self.retry_after = retry_after
+        self.semaphore = asyncio.Semaphore(max_concurrency, loop=loop)
+        self.waiting = 0
+
+    async def __aenter__(self):
+        if self.semaphore.locked() and self.waiting >= self.queue:
+            monitoring.rpc_rejected.labels(method=self.method_name).inc()
+            raise ServerBusy('{} has too many pending calls'.format(
+                self.method_name))
+
+        self.waiting += 1
+        monitoring.rpc_queue_depth.labels(method=self.method_name).set(
+            self.waiting)
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+            monitoring.rpc_queue_depth.labels(method=self.method_name).set(
+                self.waiting)
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.semaphore.release()
+
+
+class ResponseCache:
+    """Cache of the encoded responses of cacheable remote methods, keyed by
+    method name, arguments and encoding. It keeps at most `size` responses,
+    evicting the least recently used ones, and each response for at most
+    `ttl` seconds if `ttl` is not None.
+
+    Call `invalidate` whenever the data returned by cacheable methods may
+    have changed. It is safe to call from any thread, e.g. from Django
+    signal receivers.
+    """
+
+    def __init__(self, size=1024, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        # Bumped by each invalidation, so that responses computed from data
+        # that changed during the call are not stored.
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(method_name, method, data, content_type):
+        """Return the cache key of a call, or None if its arguments cannot
+        be canonicalized.
+
+        Arguments are bound to the parameters of `method`, the remote method
+        bound to the RPC object, so that calls passing the same values
+        positionally, by keyword or by default share their key.
+        """
+        try:
+            bound = inspect.signature(method).bind(*data['args'],
+                                                   **data['kwargs'])
+        except TypeError:
+            return None
+        bound.apply_defaults()
+        arguments = []
+        for name, value in bound.arguments.items():
+            kind = bound.signature.parameters[name].kind
+            if kind == inspect.Parameter.VAR_KEYWORD:
+                value = sorted(value.items())
+            arguments.append([name, value])
+        try:
+            arguments = prologin.jsoncodec.dumps(arguments)
+        except prologin.jsoncodec.EncodeError:
+            return None
+        return (method_name, arguments, content_type)
+
+    def get(self, key):
+        """Return the cached response body for `key`, or None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            body, expires = entry
+            if expires is not None and expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return body
+
+    def put(self, key, body, generation):
+        """Store `body` for `key`, unless the cache was invalidated since
+        `generation` was read.
+        """
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[key] = (body, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self):
+        """Drop all the cached responses."""
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+
+class CallError(Exception):
+    """Exception used internally to abort a remote call: `data` is the
+    exception message to send back to the caller, and `http_error` the HTTP
+    error (with extra `headers`) to use when the call is not part of a batch.
+    """
+    def __init__(self, data, http_error, headers=None):
+        super().__init__(data['exn_type'], data['exn_message'])
+        self.data = data
+        self.http_error = http_error
+        self.headers = headers
+
+    def to_http_error(self, content_type=encoding.JSON):
+        """Return the HTTP error to raise to abort a regular call."""
+        return self.http_error(body=encoding.encode(self.data, content_type),
+                               content_type=content_type,
+                               headers=self.headers)
+
+
 class RemoteCallHandler:
-    def __init__(self, request):
+    def __init__(self, request, method_name=None):
         self.request = request
         self.secret = self.request.app.secret
-        self.method_name = request.match_info['name']
+        self.token_verifier = self.request.app.token_verifier
+        self.method_name = method_name or request.match_info['name']
+        self.content_type = encoding.negotiate(request.headers.get('Accept'))
+        # (argument name, reader) for calls that send a streamed argument.
+        self.stream = None
 
     @property
     def rpc_object(self):
@@ -93,21 +272,108 @@ class RemoteCallHandler:
     @monitoring._observe_rpc_call_in
     async def __call__(self):
         data = {'args': [], 'kwargs': {}}
-        if self.request.method == 'POST':
-            try:
-                data.update(await self.request.json())
-            except json.decoder.JSONDecodeError as exn:
-                self._raise_exception(exn)
+        try:
+            if self.request.method == 'POST':
+                data.update(await self._read_data())
+
+            method = await self._prepare(data)
+
+            cache = self.request.app.response_cache
+            cache_key = None
+            if method.cacheable and cache is not None and self.stream is None:
+                cache_key = cache.key(self.method_name,
+                                      method.__get__(self.rpc_object), data,
+                                      self.content_type)
+            if cache_key is not None:
+                body = cache.get(cache_key)
+                if body is not None:
+                    monitoring.rpc_cache_hit.labels(
+                        method=self.method_name).inc()
+                    return aiohttp.web.Response(
+                        body=body, content_type=self.content_type)
+                monitoring.rpc_cache_miss.labels(
+                    method=self.method_name).inc()
+                generation = cache.generation
+
+            result = await self._call_method(method, data)
+        except CallError as exn:
+            raise exn.to_http_error(self.content_type)
+
+        response = await self._send_result_data(result)
+        if cache_key is not None:
+            cache.put(cache_key, response.body, generation)
+        return response
 
+    @monitoring._observe_rpc_call_in
+    async def run_batched(self, data):
+        """Run the call described by `data` as part of a batch: return the
+        result message, or the exception message if the call failed.
+        """
+        data = dict({'args': [], 'kwargs': {}}, **data)
+        try:
+            return {'type': 'result', 'data': (await self._run(data))}
+        except CallError as exn:
+            return exn.data
+
+    def _phase(self, phase):
+        return monitoring.observe_rpc_call_in_phase(self.method_name, phase)
+
+    async def _read_data(self):
+        stream_name = self.request.headers.get(encoding.STREAM_HEADER)
+        with self._phase('read'):
+            if stream_name is None:
+                body = await self.request.read()
+                content_type = self.request.content_type
+            else:
+                # The body starts with the call message, followed by the raw
+                # stream that is left to the remote method.
+                try:
+                    length = int(self.request.headers[encoding.LENGTH_HEADER])
+                    body = await self.request.content.readexactly(length)
+                except (KeyError, ValueError,
+                        asyncio.IncompleteReadError) as exn:
+                    self._raise_exception(
+                        exn, http_error=aiohttp.web.HTTPBadRequest)
+                content_type = self.request.headers.get(encoding.TYPE_HEADER,
+                                                        encoding.JSON)
+                self.stream = (stream_name, self.request.content)
+
+        if (content_type == encoding.MSGPACK and
+                content_type not in encoding.supported()):
+            self._raise_exception(
+                encoding.DecodeError('msgpack is not available'),
+                http_error=aiohttp.web.HTTPUnsupportedMediaType)
+        try:
+            with self._phase('decode'):
+                return encoding.decode(body, content_type)
+        except encoding.DecodeError as exn:
+            self._raise_exception(exn, http_error=aiohttp.web.HTTPBadRequest)
+
+    async def _run(self, data):
+        method = await self._prepare(data)
+        return (await self._call_method(method, data))
+
+    async def _prepare(self, data):
+        """Check that the call described by `data` is allowed and return the
+        method to call.
+        """
         self._log_call(data)
 
         method = await self._get_method()
         if method.auth_required:
-            await self._check_secret(data)
+            with self._phase('auth'):
+                await self._check_secret(data)
 
-        result = await self._call_method(method, data)
+        if self.stream is not None:
+            name, reader = self.stream
+            if method.stream != name:
+                self._raise_exception(
+                    TypeError('{} cannot stream argument {}'.format(
+                        self.method_name, name)),
+                    http_error=aiohttp.web.HTTPBadRequest)
+            data['kwargs'][name] = reader
 
-        return (await self._send_result_data(result))
+        return method
 
     def _log_call(self, data):
         peername = self.request.transport.get_extra_info('peername')
@@ -128,16 +394,14 @@ class RemoteCallHandler:
                 self._raise_exception(MissingToken(self.method_name),
                                       http_error=aiohttp.web.HTTPBadRequest)
             token = data['hmac']
-            r = prologin.timeauth.check_token(token, self.secret,
-                                              self.method_name)
-            if not r:
+            if not self.token_verifier.check(token, self.method_name):
                 self._raise_exception(BadToken(self.method_name),
                                       http_error=aiohttp.web.HTTPForbidden)
 
     async def _get_method(self):
         try:
             return self.rpc_object.REMOTE_METHODS[self.method_name]
-        except KeyError:
+        except (KeyError, TypeError):
             self._raise_exception(MethodError(self.method_name),
                                   http_error=aiohttp.web.HTTPNotFound)
 
@@ -145,38 +409,154 @@ class RemoteCallHandler:
         args = data['args']
         kwargs = data['kwargs']
 
+        admission = self.request.app.admissions.get(self.method_name)
+        if admission is not None:
+            try:
+                async with admission:
+                    return (await self._call_method_unchecked(method, args,
+                                                              kwargs))
+            except ServerBusy as exn:
+                self._raise_exception(
+                    exn, http_error=aiohttp.web.HTTPServiceUnavailable,
+                    headers={'Retry-After': str(admission.retry_after)})
+        return (await self._call_method_unchecked(method, args, kwargs))
+
+    async def _call_method_unchecked(self, method, args, kwargs):
         try:
-            return (await method(self.rpc_object, *args, **kwargs))
+            with self._phase('execute'):
+                return (await method(self.rpc_object, *args, **kwargs))
         except Exception as exn:
             logging.exception('Remote method %s raised:', self.method_name)
             tb = sys.exc_info()[2]
             self._raise_exception(exn, tb)
 
-    async def _send_json(self, data):
-        return aiohttp.web.Response(body=json.dumps(data).encode() + b'\n',
-                                    content_type='application/json')
+    async def _send_data(self, data):
+        with self._phase('encode'):
+            body = encoding.encode(data, self.content_type)
+        return aiohttp.web.Response(body=body, content_type=self.content_type)
 
-    def _raise_exception(self, exn, tb=None,
-                         http_error=aiohttp.web.HTTPInternalServerError):
-        data = {
+    @staticmethod
+    def _exception_message(exn, tb=None):
+        return {
             'type': 'exception',
             'exn_type': type(exn).__name__,
             'exn_message': str(exn),
             'exn_traceback': traceback.format_tb(tb),
         }
-        body = json.dumps(data).encode() + b'\n'
-        raise http_error(body=body, content_type='application/json')
+
+    def _raise_exception(self, exn, tb=None,
+                         http_error=aiohttp.web.HTTPInternalServerError,
+                         headers=None):
+        raise CallError(self._exception_message(exn, tb), http_error, headers)
 
     async def _send_result_data(self, data):
         try:
-            return (await self._send_json({
+            return (await self._send_data({
                 'type': 'result',
                 'data': data,
             }))
         except (TypeError, ValueError):
-            self._raise_exception(
-                ValueError('The remote method returned something not JSON'),
-            )
+            try:
+                self._raise_exception(
+                    ValueError('The remote method returned something not '
+                               'serializable'),
+                )
+            except CallError as exn:
+                raise exn.to_http_error(self.content_type)
+
+
+class BatchCallHandler(RemoteCallHandler):
+    """Run several remote calls sent in a single request.
+
+    The request holds a list of calls, each one being a dictionary with the
+    `method` name, its `args`, `kwargs` and its own `hmac` token. Unless
+    `concurrent` is false, calls are run concurrently. The response holds
+    the list of result or exception messages, in the same order as calls.
+    Batches of more than MAX_BATCH_SIZE calls are rejected.
+    """
+
+    def __init__(self, request):
+        super().__init__(request, method_name='batch')
+
+    async def __call__(self):
+        data = {'calls': [], 'concurrent': True}
+        try:
+            batch = await self._read_data()
+            if not isinstance(batch, dict):
+                self._raise_exception(ValueError('the batch is not an object'),
+                                      http_error=aiohttp.web.HTTPBadRequest)
+            data.update(batch)
+            if not isinstance(data['calls'], list):
+                self._raise_exception(ValueError('calls is not a list'),
+                                      http_error=aiohttp.web.HTTPBadRequest)
+            if len(data['calls']) > MAX_BATCH_SIZE:
+                self._raise_exception(
+                    ValueError('more than {} calls in the batch'.format(
+                        MAX_BATCH_SIZE)),
+                    http_error=aiohttp.web.HTTPBadRequest)
+        except CallError as exn:
+            raise exn.to_http_error(self.content_type)
+
+        handlers = []
+        for call in data['calls']:
+            error = self._check_call(call)
+            if error is None:
+                handlers.append(RemoteCallHandler(
+                    self.request, call['method']).run_batched(call))
+            else:
+                handlers.append(self._malformed_call(error))
+        if data['concurrent']:
+            results = await asyncio.gather(*handlers)
+        else:
+            results = [(await handler) for handler in handlers]
+
+        return (await self._send_result_data_list(results))
+
+    @staticmethod
+    def _check_call(call):
+        """Return a ValueError describing what is wrong with `call`, or None
+        if it is well-formed.
+        """
+        if not isinstance(call, dict):
+            return ValueError('the call is not an object')
+        if not all(isinstance(key, str) for key in call):
+            return ValueError('the call has non-string keys')
+        if not isinstance(call.get('method'), str):
+            return ValueError('the call has no method name')
+        if not isinstance(call.get('args', []), list):
+            return ValueError('the call args are not a list')
+        kwargs = call.get('kwargs', {})
+        if (not isinstance(kwargs, dict) or
+                not all(isinstance(key, str) for key in kwargs)):
+            return ValueError('the call kwargs are not an object')
+        return None
+
+    async def _malformed_call(self, exn):
+        return self._exception_message(exn)
+
+    async def _send_result_data_list(self, results):
+        try:
+            return (await self._send_data({
+                'type': 'batch',
+                'data': results,
+            }))
+        except (TypeError, ValueError):
+            # Report the culprit calls and keep the others.
+            for i, result in enumerate(results):
+                try:
+                    encoding.encode(result, self.content_type)
+                except (TypeError, ValueError):
+                    results[i] = {
+                        'type': 'exception',
+                        'exn_type': 'ValueError',
+                        'exn_message': 'The remote method returned '
+                                       'something not serializable',
+                        'exn_traceback': [],
+                    }
+            return (await self._send_data({
+                'type': 'batch',
+                'data': results,
+            }))
 
 
 class BaseRPCApp(prologin.web.AiohttpApp, metaclass=MethodCollection):
@@ -186,12 +566,69 @@ class BaseRPCApp(prologin.web.AiohttpApp, metaclass=MethodCollection):
     decorator and instanciate me!
     """
 
-    def __init__(self, app_name, secret=None, **kwargs):
+    def __init__(self, app_name, secret=None, response_cache=None, **kwargs):
         async def handler(request):
             return (await RemoteCallHandler(request)())
 
+        async def batch_handler(request):
+            return (await BatchCallHandler(request)())
+
         super().__init__([
             ('*', r'/call/{name:[0-9a-zA-Z_]+}', handler),
+            ('POST', r'/batch', batch_handler),
+            ('GET', r'/channel', channel.serve),
         ], app_name, **kwargs)
         self.app.secret = secret
+        self.app.token_verifier = (
+            prologin.timeauth.get_verifier(secret)
+            if secret is not None else None)
         self.app.rpc_object = self
+        # Cache for the responses of cacheable methods: pass your own to
+        # invalidate it when the underlying data changes.
+        self.app.response_cache = (response_cache
+                                   if response_cache is not None
+                                   else ResponseCache())
+        self.app.admissions = {
+            name: Admission(name, method.max_concurrency, method.queue,
+                            method.retry_after, loop=self.loop)
+            for name, method in self.REMOTE_METHODS.items()
+            if method.max_concurrency is not None
+        }
+
+    async def dispatch_call(self, method_name, args, kwargs):
+        """Run a call received through a channel. Channels are authenticated
+        when they are opened, so their calls are not.
+        """
+        try:
+            method = self.REMOTE_METHODS[method_name]
+        except KeyError:
+            raise MethodError(method_name)
+
+        if isinstance(kwargs.get(method.stream), bytes):
+            kwargs[method.stream] = channel.BytesStream(kwargs[method.stream])
+
+        admission = self.app.admissions.get(method_name)
+        if admission is None:
+            return (await self._dispatch_call_unchecked(method, args, kwargs))
+        try:
+            async with admission:
+                return (await self._dispatch_call_unchecked(method, args,
+                                                            kwargs))
+        except ServerBusy as exn:
+            exn.retry_after = admission.retry_after
+            raise
+
+    async def _dispatch_call_unchecked(self, method, args, kwargs):
+        try:
+            return (await method(self, *args, **kwargs))
+        except Exception:
+            logging.exception('Remote method %s raised:', method.__name__)
+            raise
+
+    def channel_opened(self, channel):
+        """Called when a client opens a channel to this application."""
+        pass
+
+    def channel_closed(self, channel):
+        """Called when a channel opened by a client is closed."""
+        pass
@@ -0,0 +1,1346 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Association Prologin <info@prologin.org>
+#
+# Prologin-SADM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Prologin-SADM is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Prologin-SADM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Synchronisation client/server library: sends updates to clients via long
+polling connections.  Uses aiohttp streaming responses to be able to support an
+arbitrary number of clients.
+"""
+
+
+import aiohttp
+import aiohttp.web
+import asyncio
+import collections
+import itertools
+import logging
+import os
+import prologin.aiohttpauth
+import prologin.jsoncodec
+import prologin.rpc.client
+import prologin.timeauth
+import prologin.web
+import prologin.webapi
+import threading
+import time
+import urllib.parse
+import urllib.request
+import uuid
+import zlib
+
+from .snapshot import SnapshotStore, open_private
+from .monitoring import (
+    sync_coalesced,
+    sync_slow_disconnects,
+    sync_subscribers,
+)
+
+# Number of published updates kept to let subscribers resynchronise
+# incrementally after a reconnection.
+JOURNAL_SIZE = 4096
+
+# Headers of poll responses: whether the first message is the whole backlog
+# ('full') or only the updates published since the requested position
+# ('incremental'), and the position of the subscriber after this message.
+RESYNC_HEADER = 'X-Sync-Resync'
+SEQ_HEADER = 'X-Sync-Seq'
+
+# Headers negotiating the compression of poll responses. HTTP clients such as
+# aiohttp send Accept-Encoding and decode Content-Encoding on their own, so
+# the standard headers are not used. With 'deflate', each message is sent as
+# an independent zlib stream, compressed once for all subscribers.
+ACCEPT_ENCODING_HEADER = 'X-Sync-Accept-Encoding'
+ENCODING_HEADER = 'X-Sync-Encoding'
+COMPRESSION_LEVEL = 6
+
+# Maximum number of bytes read at once from poll responses by clients.
+READ_SIZE = 64 * 1024
+
+# Minimum number of seconds between two writes of a client cache.
+CACHE_INTERVAL = 5
+
+# Number of compressed messages kept by a queue, so that messages sent to
+# several subscribers are compressed once.
+COMPRESSED_CACHE_SIZE = 16
+
+# Pool of the HTTP sessions used by AsyncClient. Subscriptions hold their
+# connection as long as they run, hence no per-host limit.
+session_pool = prologin.rpc.client.SessionPool(limit=0, limit_per_host=0)
+
+# Number of bytes that can be queued for a subscriber while it is still
+# receiving previous messages. Past this mark, queued updates are coalesced.
+HIGH_WATER_MARK = 4 * 1024 * 1024
+
+# Number of seconds a subscriber can stay past the high-water mark before it
+# is disconnected.
+SLOW_TIMEOUT = 30
+
+
+def apply_updates(pk, backlog, updates, watch=None):
+    """Update `backlog` with `updates` using `pk` as primary key for records.
+
+    Return metadata about what have been updated using an encoding like:
+        {'obj1': 'updated', 'obj3': 'deleted', 'obj6': 'created'}
+    The previous example means: the entity whose primary key is 'obj1' have
+    been updated, 'obj6' have been created, ... Note that deletion and creation
+    of entities *always* result in returned metadata, whatever `watch`
+    contains.
+
+    If `watch` is not None, it must be a set of field names. In this case,
+    returned metadata includes only entities whose changes target fields in
+    `watch`.
+
+    For instance:
+    >>> apply_updates('k', {1: {'k': 1, 'v': 2}},
+                      [{'type': 'update', 'data': {'k': 1, 'v': 3}}])
+    {1: 'updated'}
+    >>> apply_updates('k', {
+                          1: {'k': 1, 'v': 2, 'w': 1},
+                          2: {'k': 2, 'v': 3, 'w': 4}
+                      },
+                      [
+                          {'type': 'update', 'data': {'k': 1, 'v': 5, 'w': 6}}
+                          {'type': 'update', 'data': {'k': 1, 'v': 7, 'w': 4}}
+                      ],
+                      watch={'w'})
+    {1: 'updated'}
+    """
+    updates_metadata = {}
+
+    for update in updates:
+
+        data = update['data']
+        key = data[pk]
+
+        if update['type'] == 'update':
+            # Add key to watched updates if any watched field changes.
+            try:
+                old_data = backlog[key]
+            except KeyError:
+                # The update must be watched if it creates a new record.
+                updates_metadata[key] = 'created'
+            else:
+                # The update must be watched if all fields are updates or if at
+                # least one watched field has changed.
+                if watch is None or any(
+                    data[field] != old_data[field] for field in watch
+                ):
+                    updates_metadata[key] = 'updated'
+
+            backlog[key] = data
+
+        elif update['type'] == 'delete':
+            if backlog.pop(key, None) is None:
+                logging.error('removing unexisting data')
+            else:
+                # All deletions are watched.
+                updates_metadata[key] = 'deleted'
+
+        else:
+            logging.error('invalid update type: %s', update['type'])
+
+    return updates_metadata
+
+def diff_states(pk, old, new, watch=None):
+    """Return the metadata (see `apply_updates`) of the changes that turn
+    the `old` mapping of records into `new`.
+    """
+    updates_metadata = {}
+    for key, data in new.items():
+        try:
+            old_data = old[key]
+        except KeyError:
+            updates_metadata[key] = 'created'
+            continue
+        if watch is None:
+            changed = data != old_data
+        else:
+            changed = any(data.get(f) != old_data.get(f) for f in watch)
+        if changed:
+            updates_metadata[key] = 'updated'
+    for key in old.keys() - new.keys():
+        updates_metadata[key] = 'deleted'
+    return updates_metadata
+
+
+# Kind of change resulting from two successive changes of a record, see
+# `merge_updates_metadata`. None means that there is no change at all.
+MERGED_CHANGES = {
+    ('created', 'updated'): 'created',
+    ('created', 'deleted'): None,
+    ('updated', 'updated'): 'updated',
+    ('updated', 'deleted'): 'deleted',
+    ('deleted', 'created'): 'updated',
+}
+
+
+def merge_updates_metadata(metadata, new_metadata):
+    """Merge `new_metadata` (see `apply_updates`) into `metadata`, the
+    metadata of the changes that happened before.
+
+    For instance, a record that was created then updated is 'created', and
+    a record that was created then deleted is not changed at all.
+    """
+    for key, change in new_metadata.items():
+        previous = metadata.get(key)
+        if previous is None:
+            metadata[key] = change
+            continue
+        merged = MERGED_CHANGES.get((previous, change), change)
+        if merged is None:
+            del metadata[key]
+        else:
+            metadata[key] = merged
+    return metadata
+
+
+class IndexedState(dict):
+    """Mapping of records by primary key that maintains secondary indexes
+    on the unique fields in `indexes`, to look records up in constant time.
+
+    Use it as the records of a subscriber (see `Client.poll_updates`) or as
+    the backlog of `apply_updates`: indexes are updated along with the
+    mapping.
+
+    >>> state = IndexedState(['hostname'])
+    >>> state['00:11'] = {'mac': '00:11', 'hostname': 'pas-r01p01'}
+    >>> state.lookup('hostname', 'pas-r01p01')
+    {'mac': '00:11', 'hostname': 'pas-r01p01'}
+    """
+
+    def __init__(self, indexes=()):
+        super().__init__()
+        # Mapping field -> value -> primary key.
+        self.indexes = {field: {} for field in indexes}
+
+    def lookup(self, field, value, default=None):
+        """Return the record whose `field` is `value`, or `default`."""
+        key = self.indexes[field].get(value)
+        if key is None:
+            return default
+        return self.get(key, default)
+
+    def _index(self, key, record):
+        for field, index in self.indexes.items():
+            if field in record:
+                index[record[field]] = key
+
+    def _unindex(self, key, record):
+        for field, index in self.indexes.items():
+            # Another record may have taken the value since.
+            if field in record and index.get(record[field]) == key:
+                del index[record[field]]
+
+    def __setitem__(self, key, record):
+        old_record = self.get(key)
+        if old_record is not None:
+            self._unindex(key, old_record)
+        super().__setitem__(key, record)
+        self._index(key, record)
+
+    def __delitem__(self, key):
+        record = self[key]
+        super().__delitem__(key)
+        self._unindex(key, record)
+
+    def pop(self, key, *default):
+        if key not in self:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        record = self[key]
+        del self[key]
+        return record
+
+    def popitem(self):
+        key, record = super().popitem()
+        self._unindex(key, record)
+        return key, record
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, record in dict(*args, **kwargs).items():
+            self[key] = record
+
+    def clear(self):
+        super().clear()
+        for index in self.indexes.values():
+            index.clear()
+
+
+def items_to_updates(items):
+    return [
+        {'type': 'update', 'data': item}
+        for item in items
+    ]
+
+
+def encode_message(message):
+    """Encode an update message as sent to subscribers: a line of JSON."""
+    return prologin.jsoncodec.dumpb(message) + b'\n'
+
+
+class MessageReader:
+    """Split the body of a poll response into encoded messages, inflating
+    it first if its `encoding` (see ENCODING_HEADER) is 'deflate'.
+    """
+
+    def __init__(self, encoding=None):
+        self.compressed = encoding == 'deflate'
+        self.decompressor = zlib.decompressobj()
+        # Chunks of the message being received.
+        self.partial = []
+
+    def inflate(self, data):
+        chunks = []
+        while data:
+            chunks.append(self.decompressor.decompress(data))
+            if not self.decompressor.eof:
+                break
+            # The next message starts a new zlib stream.
+            data = self.decompressor.unused_data
+            self.decompressor = zlib.decompressobj()
+        return b''.join(chunks)
+
+    def feed(self, data):
+        """Return the list of messages completed by `data`."""
+        if self.compressed:
+            data = self.inflate(data)
+        if b'\n' not in data:
+            if data:
+                self.partial.append(data)
+            return []
+        lines = data.split(b'\n')
+        lines[0] = b''.join(self.partial) + lines[0]
+        last = lines.pop()
+        self.partial = [last] if last else []
+        return [line for line in lines if line]
+
+
+def coalesce_messages(pk, messages):
+    """Merge encoded update `messages` into a single encoded message that
+    keeps only the last update of each record, using `pk` as primary key.
+    """
+    latest = collections.OrderedDict()
+    for msg in messages:
+        for update in prologin.jsoncodec.loads(msg):
+            key = update['data'][pk]
+            # Keep updates in the order of their last occurrence.
+            latest.pop(key, None)
+            latest[key] = update
+    return encode_message(list(latest.values()))
+
+
+# Previous version of a record that the queue does not track.
+UNKNOWN = object()
+
+
+class Subscription:
+    """Filter applied by the server to the updates sent to a subscriber.
+
+    `where` maps field names to the value records must have to be sent.
+    Values are compared to the string form of record fields, so that they
+    can be given as query parameters. `fields` is the set of fields to send
+    (the primary key is always sent), or None to send every field.
+
+    Updates are filtered using the previous version of each record: a record
+    that leaves the filter is sent as deleted, and an update that changes
+    none of the sent fields of a record is not sent at all.
+    """
+
+    def __init__(self, pk, where=None, fields=None):
+        self.pk = pk
+        self.where = dict(where or {})
+        self.fields = None if fields is None else set(fields) | {pk}
+        # Subscribers with equal keys share encoded messages.
+        self.key = (tuple(sorted(self.where.items())),
+                    None if self.fields is None else tuple(sorted(self.fields)))
+
+    @classmethod
+    def from_arguments(cls, pk, where, fields):
+        """Build a subscription from query arguments: a list of
+        "field=value" strings and a comma-separated list of fields. Return
+        None if there is nothing to filter. Raise a ValueError if arguments
+        are invalid.
+        """
+        conditions = {}
+        for condition in where:
+            field, sep, value = condition.partition('=')
+            if not sep or not field:
+                raise ValueError('invalid condition: {!r}'.format(condition))
+            conditions[field] = value
+        if fields is not None:
+            fields = [f.strip() for f in fields.split(',') if f.strip()]
+        if not conditions and fields is None:
+            return None
+        return cls(pk, conditions, fields)
+
+    def matches(self, record):
+        """Return whether `record` (None for a deleted one) is sent."""
+        if record is None:
+            return False
+        return all(str(record.get(field)) == value
+                   for field, value in self.where.items())
+
+    def project(self, record):
+        if self.fields is None:
+            return record
+        return {f: v for f, v in record.items() if f in self.fields}
+
+    def filter_updates(self, entries):
+        """Return the updates to send for `entries`, a sequence of
+        (update, previous record) couples. The previous record is None for
+        new records and UNKNOWN if the queue does not track it.
+        """
+        updates = []
+        for update, previous in entries:
+            data = update['data']
+            record = data if update['type'] == 'update' else None
+            was_sent = previous is UNKNOWN or self.matches(previous)
+            if self.matches(record):
+                sent = self.project(record)
+                if (was_sent and previous is not UNKNOWN
+                        and self.project(previous) == sent):
+                    continue
+                filtered = {'type': 'update', 'data': sent}
+            elif was_sent:
+                filtered = {'type': 'delete', 'data': {self.pk: data[self.pk]}}
+            else:
+                continue
+            if 'seq' in update:
+                filtered['seq'] = update['seq']
+            updates.append(filtered)
+        return updates
+
+
+class BasePubSubQueue:
+    """Maintain a backlog of updates. Used by the server.
+
+    This is a base abstract class. It define common utilities, let
+    subclasses implement required methods and let them add other methods.
+
+    Each published update gets a sequence number, and the last
+    `journal_size` ones are kept in a journal. Subscribers that reconnect
+    with the position ("epoch:seq") they reached get only the updates they
+    missed, as long as they are still in the journal. The epoch identifies
+    the queue, so that positions from another server run are not used.
+
+    Messages are encoded once per subscription (see Subscription), whatever
+    the number of subscribers, and the encoded backlog is cached until the
+    next update is published: the backlog message must not change unless
+    updates are published.
+    """
+    def __init__(self, journal_size=JOURNAL_SIZE):
+        # Mapping callback -> Subscription, or None for unfiltered ones.
+        self.subscribers = {}
+        self.epoch = uuid.uuid4().hex
+        self.seq = 0
+        # (update, previous record) couples, see Subscription.filter_updates.
+        self.journal = collections.deque(maxlen=journal_size)
+        # (seq, encoded backlog message) or None.
+        self.backlog_cache = None
+        # Mapping subscription key -> (seq, encoded backlog message).
+        self.filtered_backlog_cache = {}
+        # Mapping id(message) -> (message, compressed message).
+        self.compressed_cache = collections.OrderedDict()
+
+    def get_backlog_message(self):
+        """Return the backlog that is sent to new subscribers as a JSON object.
+        """
+        raise NotImplementedError()
+
+    def prepare_backlog(self):
+        """Called before the backlog is sent to a new subscriber: subclasses
+        can publish pending updates here.
+        """
+        pass
+
+    def encode_backlog(self):
+        """Return the encoded backlog message. Subclasses can override this
+        to avoid encoding the whole backlog each time it changes.
+        """
+        return encode_message(self.get_backlog_message())
+
+    def encoded_backlog(self):
+        """Return the encoded backlog message, using the cached one if no
+        update was published since it was encoded.
+        """
+        self.prepare_backlog()
+        if self.backlog_cache is None or self.backlog_cache[0] != self.seq:
+            self.backlog_cache = (self.seq, self.encode_backlog())
+        return self.backlog_cache[1]
+
+    def compressed(self, msg):
+        """Return `msg` compressed as an independent zlib stream. Recently
+        sent messages are compressed only once.
+        """
+        cached = self.compressed_cache.get(id(msg))
+        if cached is not None and cached[0] is msg:
+            self.compressed_cache.move_to_end(id(msg))
+            return cached[1]
+        compressed = zlib.compress(msg, COMPRESSION_LEVEL)
+        # Keep a reference to `msg` so that its id is not reused.
+        self.compressed_cache[id(msg)] = (msg, compressed)
+        if len(self.compressed_cache) > COMPRESSED_CACHE_SIZE:
+            self.compressed_cache.popitem(last=False)
+        return compressed
+
+    def encoded_filtered_backlog(self, subscription):
+        """Return the encoded backlog message for `subscription`, using the
+        cached one if no update was published since it was encoded.
+        """
+        self.prepare_backlog()
+        cached = self.filtered_backlog_cache.get(subscription.key)
+        if cached is None or cached[0] != self.seq:
+            updates = subscription.filter_updates(
+                (update, None) for update in self.get_backlog_message())
+            cached = (self.seq, encode_message(updates))
+            self.filtered_backlog_cache[subscription.key] = cached
+        return cached[1]
+
+    def position(self):
+        """Return the current position in the stream of updates."""
+        return '{}:{}'.format(self.epoch, self.seq)
+
+    def updates_since(self, since):
+        """Return the list of (update, previous record) couples published
+        after the `since` position, or None if some of them are not in the
+        journal anymore or if `since` is not a position of this queue.
+        """
+        try:
+            epoch, seq = since.split(':')
+            seq = int(seq)
+        except (AttributeError, ValueError):
+            return None
+        if epoch != self.epoch or not 0 <= seq <= self.seq:
+            return None
+        if seq == self.seq:
+            return []
+        if not self.journal or self.journal[0][0]['seq'] > seq + 1:
+            return None
+        start = seq + 1 - self.journal[0][0]['seq']
+        return list(itertools.islice(self.journal, start, None))
+
+    def post_updates(self, update_msg, previous=None):
+        """Publish an update message to all subscribers. `previous` is the
+        list of the previous versions of the updated records (see
+        Subscription.filter_updates), if the queue tracks them.
+        """
+        if previous is None:
+            previous = [UNKNOWN] * len(update_msg)
+        published = []
+        entries = []
+        for update, old in zip(update_msg, previous):
+            self.seq += 1
+            update = dict(update, seq=self.seq)
+            self.journal.append((update, old))
+            published.append(update)
+            entries.append((update, old))
+        logging.info('sending update message: %s', published)
+        msg = encode_message(published)
+        filtered = {}
+        # Slow subscribers may be unregistered by their callback.
+        for callback, subscription in list(self.subscribers.items()):
+            if subscription is None:
+                callback(msg)
+                continue
+            if subscription.key not in filtered:
+                updates = subscription.filter_updates(entries)
+                filtered[subscription.key] = (encode_message(updates)
+                                              if updates else None)
+            if filtered[subscription.key] is not None:
+                callback(filtered[subscription.key])
+
+    def first_message(self, since=None, subscription=None):
+        """Return the first message to send to a new subscriber that reached
+        the `since` position (None for new subscribers), as a
+        (resync, position, encoded message) tuple: see RESYNC_HEADER and
+        SEQ_HEADER. The message is None if the subscriber missed nothing.
+        """
+        entries = self.updates_since(since) if since is not None else None
+        if entries is None:
+            resync = 'full'
+            if subscription is None:
+                msg = self.encoded_backlog()
+            else:
+                msg = self.encoded_filtered_backlog(subscription)
+        else:
+            resync = 'incremental'
+            if subscription is None:
+                updates = [update for update, _ in entries]
+            else:
+                updates = subscription.filter_updates(entries)
+            msg = encode_message(updates) if updates else None
+        # Building the backlog may publish updates: get the position last.
+        return resync, self.position(), msg
+
+    def add_subscriber(self, callback, subscription=None):
+        """Invoke `callback` for each update message published from now,
+        filtered using `subscription` if it is not None.
+        """
+        self.subscribers[callback] = subscription
+        sync_subscribers.set(len(self.subscribers))
+        logging.info('added a new subscriber, count is now %d', len(self.subscribers))
+
+    def register_subscriber(self, callback, since=None, subscription=None):
+        """Register a new subscriber to the queue.  `callback` will be invoked
+        for each published update message, starting with the first message
+        (see `first_message`). Return the resync kind and the position.
+        """
+        logging.info('new subscriber arrived, sending the backlog')
+        resync, position, msg = self.first_message(since, subscription)
+        if msg is not None:
+            callback(msg)
+        self.add_subscriber(callback, subscription)
+        return resync, position
+
+    def unregister_subscriber(self, callback):
+        """Remove a subscriber from the queue."""
+        self.subscribers.pop(callback, None)
+        sync_subscribers.set(len(self.subscribers))
+        logging.info('removed a subscriber, count is now %d', len(self.subscribers))
+
+class DefaultPubSubQueue(BasePubSubQueue):
+    """Maintain a backlog of updates for records with a field that is unique.
+    """
+
+    def __init__(self, pk, initial_backlog, store=None):
+        """If `store` is not None, it is a SnapshotStore where the backlog
+        is saved, starting with `initial_backlog`.
+        """
+        super(DefaultPubSubQueue, self).__init__()
+        self.pk = pk
+        self.backlog = {}
+        # Encoded update for each record of the backlog, so that only the
+        # records that changed are encoded again to build the backlog message.
+        self.encoded_items = {}
+        # Nobody is subscribed yet: there is nothing to publish.
+        self._apply(items_to_updates(initial_backlog))
+        self.store = store
+        if store is not None:
+            store.write_snapshot(self.backlog.values())
+
+    def get_backlog_message(self):
+        return items_to_updates(self.backlog.values())
+
+    def encode_backlog(self):
+        return b'[' + b','.join(self.encoded_items.values()) + b']\n'
+
+    def _apply(self, updates):
+        apply_updates(self.pk, self.backlog, updates)
+        for update in updates:
+            key = update['data'][self.pk]
+            if key in self.backlog:
+                self.encoded_items[key] = prologin.jsoncodec.dumpb(
+                    {'type': 'update', 'data': self.backlog[key]})
+            else:
+                self.encoded_items.pop(key, None)
+
+    #
+    # Public interface
+    #
+
+    def apply_updates(self, updates):
+        """Apply `updates` to the backlog and publish the corresponding update
+        message.
+        """
+        previous = []
+        current = {}
+        for update in updates:
+            key = update['data'][self.pk]
+            previous.append(current[key] if key in current
+                            else self.backlog.get(key))
+            current[key] = (update['data'] if update['type'] == 'update'
+                            else None)
+        self._apply(updates)
+        if self.store is not None:
+            self.store.append(updates, self.backlog)
+        self.post_updates(updates, previous)
+
+    def reconcile(self, items, since_seq):
+        """Publish the updates that turn the backlog into `items`, the
+        records of the data source as they were when the queue was at
+        `since_seq`. Records updated since then are left untouched, as
+        `items` may not include their changes.
+        """
+        touched = {update['data'][self.pk] for update, _ in self.journal
+                   if update['seq'] > since_seq}
+        items = {item[self.pk]: item for item in items}
+        updates = [{'type': 'update', 'data': item}
+                   for key, item in items.items()
+                   if key not in touched and self.backlog.get(key) != item]
+        updates += [{'type': 'delete', 'data': data}
+                    for key, data in self.backlog.items()
+                    if key not in touched and key not in items]
+        logging.info('reconciled the backlog: %d differences', len(updates))
+        if updates:
+            self.apply_updates(updates)
+
+
+class PollHandler:
+    """Send update messages to a subscriber, for as long as it is connected.
+
+    Only one batch of writes is drained at a time: messages published
+    meanwhile are queued. When more than the server's `high_water_mark`
+    bytes are queued, the queued updates are coalesced by primary key.
+    Subscribers that stay past the mark for `slow_timeout` seconds, or that
+    are still past it once updates are coalesced, are disconnected.
+    """
+
+    def __init__(self, server, request):
+        self.server = server
+        self.request = request
+        self.queue = server.pubsub_queue
+        self.response = aiohttp.web.StreamResponse()
+        self.compress = False
+        self.pending = []
+        self.pending_size = 0
+        self.flushing = False
+        # Set when there are pending messages to send.
+        self.wakeup = asyncio.Event()
+        # Time at which the subscriber went past the high-water mark.
+        self.slow_since = None
+
+    async def __call__(self):
+        try:
+            subscription = Subscription.from_arguments(
+                self.server.pk, self.request.query.getall('where', []),
+                self.request.query.get('fields'))
+        except ValueError as e:
+            raise aiohttp.web.HTTPBadRequest(text=str(e))
+        resync, position, message = self.queue.first_message(
+            self.request.query.get('since'), subscription)
+        self.response.headers[RESYNC_HEADER] = resync
+        self.response.headers[SEQ_HEADER] = position
+        accepted = self.request.headers.get(ACCEPT_ENCODING_HEADER, '')
+        if 'deflate' in (e.strip() for e in accepted.split(',')):
+            self.compress = True
+            self.response.headers[ENCODING_HEADER] = 'deflate'
+        # Subscribe before yielding to the loop, so that no update published
+        # after the first message is missed.
+        if message is not None:
+            self.message_callback(message)
+        self.queue.add_subscriber(self.message_callback, subscription)
+        try:
+            await self.response.prepare(self.request)
+            # Send the headers, even if nothing was missed.
+            await self.response.drain()
+            while True:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                await self.send()
+        finally:
+            # The handler is cancelled when the subscriber disconnects.
+            self.queue.unregister_subscriber(self.message_callback)
+
+    def message_callback(self, msg):
+        self.pending.append(msg)
+        self.pending_size += len(msg)
+        self.wakeup.set()
+        if self.flushing and self.pending_size > self.server.high_water_mark:
+            self.on_behind()
+
+    async def send(self):
+        msgs = self.pending
+        self.pending = []
+        self.pending_size = 0
+        # Messages are shared between subscribers: write them as-is, or
+        # compressed by the queue.
+        self.flushing = True
+        for msg in msgs:
+            if self.compress:
+                msg = self.queue.compressed(msg)
+            self.response.write(msg)
+        await self.response.drain()
+        self.flushing = False
+        if not self.pending:
+            self.slow_since = None
+
+    def on_behind(self):
+        now = time.monotonic()
+        if self.slow_since is None:
+            self.slow_since = now
+        elif now - self.slow_since > self.server.slow_timeout:
+            self.disconnect('behind for more than {}s'.format(
+                self.server.slow_timeout))
+            return
+
+        self.pending = [coalesce_messages(self.server.pk, self.pending)]
+        self.pending_size = len(self.pending[0])
+        sync_coalesced.inc()
+        if self.pending_size > self.server.high_water_mark:
+            self.disconnect('{} bytes queued after coalescing'.format(
+                self.pending_size))
+
+    def disconnect(self, reason):
+        transport = self.request.transport
+        logging.warning('disconnecting slow subscriber %s: %s',
+                        transport and transport.get_extra_info('peername'),
+                        reason)
+        sync_slow_disconnects.inc()
+        self.queue.unregister_subscriber(self.message_callback)
+        self.pending = []
+        self.pending_size = 0
+        # Do not wait for the queued data to be flushed.
+        if transport is not None:
+            transport.abort()
+
+
+def cache_path(name, cache_dir=None):
+    """Return the path of the client cache file for `name` in `cache_dir`,
+    which defaults to the state directory systemd gives to the service
+    ($STATE_DIRECTORY). Return None if there is no such directory.
+    """
+    cache_dir = cache_dir or os.environ.get('STATE_DIRECTORY')
+    if not cache_dir:
+        return None
+    # systemd gives a colon-separated list if there are several directories.
+    return os.path.join(cache_dir.split(':')[0], name + '.json')
+
+
+def server_options(cfg):
+    """Return the Server keyword arguments that are set in the `cfg`
+    configuration.
+    """
+    return {key: cfg[key]
+            for key in ('high_water_mark', 'slow_timeout', 'snapshot_path')
+            if key in cfg}
+
+
+class Server(prologin.web.AiohttpApp):
+    """Synchronisation server. Users must derive from this class and implement
+    required methods.
+
+    The server can run on its own (see `start`), or share the process and
+    the event loop of another aiohttp application (see `mount`).
+    """
+
+    def __init__(self, pk, pub_secret, sub_secret, port, app_name,
+                 high_water_mark=HIGH_WATER_MARK, slow_timeout=SLOW_TIMEOUT,
+                 snapshot_path=None, loop=None):
+        """The `shared_secret` is used to restrict clients that can add
+        updates. See PollHandler for `high_water_mark` and `slow_timeout`.
+
+        If `snapshot_path` is not None, the backlog is saved there (see
+        SnapshotStore). After a restart, subscribers are then served from
+        the saved backlog while it is reconciled with the initial backlog in
+        the background.
+        """
+        super().__init__(self.get_routes(), app_name, loop=loop)
+        self.pk = pk
+        self.port = port
+        self.high_water_mark = high_water_mark
+        self.slow_timeout = slow_timeout
+        self.snapshot_path = snapshot_path
+        self.pub_secret = pub_secret.encode('utf-8')
+        self.sub_secret = sub_secret.encode('utf-8')
+        self.pubsub_queue = self.create_pubsub_queue()
+
+    def start(self):
+        """Run the server."""
+        self.sync_store()
+        self.run(port=self.port)
+
+    def mount(self, app):
+        """Serve the routes of this server from `app`, another AiohttpApp
+        (e.g. a RPC application), in its event loop. Run `app` instead of
+        starting this server.
+        """
+        for route in self.get_routes():
+            app.app.router.add_route(*route)
+        self.loop = app.loop
+        self.sync_store()
+
+    def sync_store(self):
+        """Sync the store of the backlog, if any, every `sync_interval`
+        seconds.
+        """
+        store = getattr(self.pubsub_queue, 'store', None)
+        if store is not None:
+            store.sync()
+            self.loop.call_later(store.sync_interval, self.sync_store)
+
+    def get_routes(self):
+        """Return a list of (HTTP method, path, handler) routes for this
+        server.
+        """
+        return [
+            ('GET', r'/poll', self.poll),
+            ('POST', r'/update', self.update),
+        ]
+
+    @prologin.aiohttpauth.signature_checked('sub_secret')
+    async def poll(self, request, msg):
+        return (await PollHandler(self, request)())
+
+    @prologin.aiohttpauth.signature_checked('pub_secret', check_msg=True)
+    async def update(self, request, msg):
+        self.pubsub_queue.apply_updates(prologin.jsoncodec.loads(msg))
+        return aiohttp.web.Response()
+
+    def create_pubsub_queue(self):
+        """Create and return a brand new pubsub queue, taking care of filling
+        it with an initial backlog.
+
+        Override this method if you want to have a custom pubsub queue.
+        """
+        store = None
+        if self.snapshot_path is not None:
+            store = SnapshotStore(self.snapshot_path, self.pk)
+            records = store.load()
+            if records is not None:
+                logging.info('loaded %d records from %s', len(records),
+                             self.snapshot_path)
+                queue = DefaultPubSubQueue(self.pk, records.values(), store)
+                threading.Thread(target=self.reconcile_backlog,
+                                 args=(queue, queue.seq), daemon=True).start()
+                return queue
+        return DefaultPubSubQueue(self.pk, self.fetch_initial_backlog(), store)
+
+    def fetch_initial_backlog(self):
+        """Return the initial backlog, retrying until it can be fetched."""
+        while True:
+            try:
+                return self.get_initial_backlog()
+            except Exception as e:
+                logging.exception('unable to get the backlog, retrying in 2s: '
+                                  '%s: %s', type(e).__name__, e)
+                time.sleep(2)
+
+    def reconcile_backlog(self, queue, since_seq):
+        """Fetch the initial backlog and reconcile `queue` with it. Run in a
+        thread, so that the server can serve subscribers meanwhile.
+        """
+        backlog = self.fetch_initial_backlog()
+        self.loop.call_soon_threadsafe(queue.reconcile, backlog, since_seq)
+
+    def get_initial_backlog(self):
+        """Return the initial state of updates as a list.
+
+        Users must give an implementation for this method.
+        """
+        raise NotImplementedError()
+
+
+class SubscriberState:
+    """State of a subscriber across reconnections: the up-to-date mapping
+    of `records` (primary key -> record) and the position reached in the
+    stream of updates. See `apply_updates` for `watch` and
+    `Client.poll_updates` for `where` and `fields`.
+
+    If `cache_path` is not None, the records and the position are saved
+    there (at most every CACHE_INTERVAL seconds), so that the next run can
+    start from them.
+
+    `records` is the mapping to keep records in (e.g. an IndexedState), a
+    new dict by default.
+    """
+
+    def __init__(self, pk, watch=None, where=None, fields=None,
+                 cache_path=None, records=None):
+        self.pk = pk
+        self.watch = watch
+        self.subscription = Client.subscription_params(where, fields)
+        self.records = {} if records is None else records
+        self.position = None
+        self.full = True
+        self.cache_path = cache_path
+        self.cache_saved = 0
+        self.cache_dirty = False
+
+    def poll_params(self, sub_secret):
+        """Return the query parameters of the next /poll request."""
+        params = {
+            'data': '{}',
+            'hmac': prologin.timeauth.generate_token(sub_secret),
+        }
+        params.update(self.subscription)
+        if self.position is not None:
+            params['since'] = self.position
+        return params
+
+    def load_cache(self):
+        """Load the records and the position saved in the cache. Return the
+        metadata of the loaded records, or None if there is no cache for
+        this subscription.
+        """
+        if self.cache_path is None:
+            return None
+        try:
+            with open(self.cache_path, 'rb') as f:
+                cache = prologin.jsoncodec.loads(f.read())
+            if cache['subscription'] != self.subscription:
+                logging.info('ignoring the cache %s of another subscription',
+                             self.cache_path)
+                return None
+            records = {r[self.pk]: r for r in cache['records']}
+        except FileNotFoundError:
+            return None
+        except (OSError, KeyError, TypeError,
+                prologin.jsoncodec.DecodeError) as e:
+            logging.warning('ignoring the invalid cache %s: %s',
+                            self.cache_path, e)
+            return None
+        updates_metadata = diff_states(self.pk, self.records, records,
+                                       self.watch)
+        self.records.clear()
+        self.records.update(records)
+        self.position = cache['position']
+        logging.info('loaded %d records from the cache %s', len(records),
+                     self.cache_path)
+        return updates_metadata
+
+    def save_cache(self, force=False):
+        """Save the records and the position in the cache, unless it was
+        saved less than CACHE_INTERVAL seconds ago and `force` is False.
+        """
+        if self.cache_path is None:
+            return
+        now = time.monotonic()
+        if not force and now - self.cache_saved < CACHE_INTERVAL:
+            self.cache_dirty = True
+            return
+        tmp_path = self.cache_path + '.tmp'
+        try:
+            with open_private(tmp_path) as f:
+                f.write(prologin.jsoncodec.dumpb({
+                    'subscription': self.subscription,
+                    'position': self.position,
+                    'records': list(self.records.values()),
+                }))
+            os.rename(tmp_path, self.cache_path)
+        except OSError as e:
+            logging.error('cannot save the cache %s: %s', self.cache_path, e)
+        self.cache_saved = now
+        self.cache_dirty = False
+
+    def flush_cache(self):
+        """Save the cache if it was not saved since the last change."""
+        if self.cache_dirty:
+            self.save_cache(force=True)
+
+    def connected(self, headers):
+        """Prepare for the messages of a /poll response with `headers`."""
+        self.full = headers.get(RESYNC_HEADER, 'full') == 'full'
+        self.position = headers.get(SEQ_HEADER)
+
+    def receive(self, updates):
+        """Apply a received update message to `records` and return the
+        metadata of the changes.
+        """
+        if self.full:
+            # Turn the whole backlog into changes to what we already know.
+            new_records = {}
+            apply_updates(self.pk, new_records, updates)
+            updates_metadata = diff_states(self.pk, self.records,
+                                           new_records, self.watch)
+            self.records.clear()
+            self.records.update(new_records)
+            self.full = False
+        else:
+            updates_metadata = apply_updates(self.pk, self.records, updates,
+                                             self.watch)
+        self.position = Client.advance_position(self.position, updates)
+        self.save_cache()
+        return updates_metadata
+
+
+class DebouncedDelivery:
+    """Call `callback` once per burst of updates: when no update was
+    received for `debounce` seconds, or at most `max_latency` seconds after
+    the first update of the burst. The metadata of the updates of a burst
+    are merged (see `merge_updates_metadata`).
+
+    Updates are added from the thread that receives them, while `run` calls
+    `callback` from another one. Both hold `lock` while using the records.
+    """
+
+    def __init__(self, callback, debounce, max_latency=None):
+        self.callback = callback
+        self.debounce = debounce
+        self.max_latency = max_latency
+        self.lock = threading.Condition()
+        self.pending = None
+        self.first = None
+        self.last = None
+
+    def add(self, updates_metadata):
+        """Add the metadata of received updates. `lock` must be held."""
+        now = time.monotonic()
+        if self.pending is None:
+            self.pending = {}
+            self.first = now
+        merge_updates_metadata(self.pending, updates_metadata)
+        self.last = now
+        self.lock.notify()
+
+    def deadline(self):
+        deadline = self.last + self.debounce
+        if self.max_latency is not None:
+            deadline = min(deadline, self.first + self.max_latency)
+        return deadline
+
+    def run(self, records):
+        """Deliver bursts of updates to `records` forever."""
+        with self.lock:
+            while True:
+                if self.pending is None:
+                    self.lock.wait()
+                    continue
+                timeout = self.deadline() - time.monotonic()
+                if timeout > 0:
+                    self.lock.wait(timeout)
+                    continue
+                updates_metadata, self.pending = self.pending, None
+                try:
+                    self.callback(records, updates_metadata)
+                except Exception as e:
+                    logging.exception('error in the synchronisation client '
+                                      'callback: %s', e)
+
+
+class Client(prologin.webapi.Client):
+    """Synchronisation client."""
+
+    def __init__(self, url, pk, pub_secret=None, sub_secret=None):
+        super(Client, self).__init__(url)
+        self.pk = pk
+        self.pub_secret = pub_secret and pub_secret.encode('utf-8')
+        self.sub_secret = sub_secret.encode('utf-8')
+
+    def send_update(self, update):
+        self.send_updates([update])
+
+    def send_updates(self, updates):
+        if self.pub_secret is None:
+            raise ValueError("No secret provided, can't send update")
+
+        r = self.send_request('/update', self.pub_secret, updates)
+        if r.status_code != 200:
+            raise RuntimeError("Unable to post an update")
+
+    @staticmethod
+    def subscription_params(where=None, fields=None):
+        """Return the /poll query parameters for a subscription filtered
+        using `where` and `fields` (see Subscription).
+        """
+        params = {}
+        if where:
+            params['where'] = ['{}={}'.format(field, value)
+                               for field, value in sorted(where.items())]
+        if fields is not None:
+            params['fields'] = ','.join(sorted(fields))
+        return params
+
+    def poll_updates(self, callback, watch=None, retry_delay=1,
+                     retry_max_delay=60, where=None, fields=None,
+                     compress=True, cache_path=None, debounce=0,
+                     max_latency=5, records=None):
+        """Call `callback` for each set of updates.
+
+        `callback` is called with an iterable that contain an up-to-date
+        mapping of records (primary_key -> record), and with a mapping: primary
+        key changed -> kind of update, for all records than has watched
+        changes. Note that the callback is invoked even if the watched list of
+        changes is empty. See `updated_backlog` for the meaning of `watch` and
+        for returned watched changes.
+
+        When the connection is lost, reconnect with an exponential backoff
+        from `retry_delay` up to `retry_max_delay` seconds, asking only for
+        the updates that were missed.
+
+        If `where` or `fields` are given, the server only sends the records
+        whose fields have the values in `where`, and only their `fields`
+        (see Subscription). `watch` must then be a subset of `fields`.
+
+        If `compress` is True, ask the server to compress messages.
+
+        If `cache_path` is not None, the last known records are kept there
+        (see SubscriberState). On startup, `callback` is then called with
+        the cached records right away, before connecting to the server.
+
+        If `debounce` is not zero, `callback` is called once per burst of
+        updates instead of once per received message, with the merged
+        metadata of the burst: see DebouncedDelivery for `debounce` and
+        `max_latency`. Updates are then received in a separate thread.
+
+        `records` is the mapping passed to `callback`, that is updated in
+        place: give an IndexedState to look records up by other fields.
+        """
+
+        if self.pk is None:
+            raise ValueError('No primary key field name specified')
+        if self.sub_secret is None:
+            raise ValueError('No subscriber shared secret specified')
+
+        state = SubscriberState(self.pk, watch, where, fields, cache_path,
+                                records)
+        updates_metadata = state.load_cache()
+        if updates_metadata is not None:
+            try:
+                callback(state.records, updates_metadata)
+            except Exception as e:
+                logging.exception('error in the synchronisation client '
+                                  'callback: %s', e)
+
+        if not debounce:
+            def on_updates(updates):
+                updates_metadata = state.receive(updates)
+                try:
+                    callback(state.records, updates_metadata)
+                except Exception as e:
+                    logging.exception('error in the synchronisation client '
+                                      'callback: %s', e)
+
+            return self.receive_updates(state, on_updates, retry_delay,
+                                        retry_max_delay, compress)
+
+        delivery = DebouncedDelivery(callback, debounce, max_latency)
+
+        def on_updates(updates):
+            with delivery.lock:
+                delivery.add(state.receive(updates))
+
+        threading.Thread(target=self.receive_updates,
+                         args=(state, on_updates, retry_delay,
+                               retry_max_delay, compress),
+                         daemon=True).start()
+        delivery.run(state.records)
+
+    def receive_updates(self, state, on_updates, retry_delay,
+                        retry_max_delay, compress):
+        """Call `on_updates` for each update message received by the
+        subscriber whose state is `state`, reconnecting forever. See
+        `poll_updates` for the other arguments.
+        """
+        attempt = 0
+        while True:
+            params = state.poll_params(self.sub_secret)
+            poll_url = urllib.parse.urljoin(
+                self.url, '/poll?%s' % urllib.parse.urlencode(params,
+                                                              doseq=True))
+            headers = {ACCEPT_ENCODING_HEADER: 'deflate'} if compress else {}
+            try:
+                request = urllib.request.Request(poll_url, headers=headers)
+                with urllib.request.urlopen(request) as resp:
+                    attempt = 0
+                    state.connected(resp.headers)
+                    reader = MessageReader(resp.headers.get(ENCODING_HEADER))
+                    while True:
+                        chunk = resp.read1(READ_SIZE)
+                        if not chunk:
+                            raise ConnectionError('connection closed by the '
+                                                  'server')
+                        for l in reader.feed(chunk):
+                            on_updates(prologin.jsoncodec.loads(l))
+            except Exception as e:
+                logging.exception('connection synchronisation server lost: '
+                                  '%s (url: %s)', e, poll_url)
+
+            state.flush_cache()
+            delay = prologin.rpc.client.backoff_delay(attempt, retry_delay,
+                                                      retry_max_delay)
+            attempt += 1
+            logging.warning('reconnecting to the synchronisation server in '
+                            '%.1fs', delay)
+            time.sleep(delay)
+
+    @staticmethod
+    def advance_position(position, updates):
+        """Return the position reached after receiving `updates`."""
+        if position is None:
+            return None
+        seqs = [u['seq'] for u in updates if 'seq' in u]
+        if not seqs:
+            return position
+        epoch, _ = position.split(':')
+        return '{}:{}'.format(epoch, max(seqs))
+
+
+class AsyncClient:
+    """Asynchronous synchronisation client, for asyncio applications.
+
+    Any number of subscriptions can run concurrently on the same event loop.
+    They share the HTTP sessions of `pool`.
+    """
+
+    def __init__(self, url, pk, sub_secret, pool=None):
+        self.url = url
+        self.pk = pk
+        self.sub_secret = sub_secret.encode('utf-8')
+        self.pool = pool or session_pool
+
+    async def subscribe(self, watch=None, where=None, fields=None,
+                        retry_delay=1, retry_max_delay=60, compress=True,
+                        cache_path=None, records=None):
+        """Yield a (records, updates metadata) couple for each set of
+        updates, like the arguments of the `Client.poll_updates` callback.
+
+        `records` is updated in place. When the connection is lost,
+        reconnect with an exponential backoff from `retry_delay` up to
+        `retry_max_delay` seconds, asking only for the updates that were
+        missed. See `Client.poll_updates` for `watch`, `where`, `fields`,
+        `compress`, `cache_path` and `records`.
+        """
+        state = SubscriberState(self.pk, watch, where, fields, cache_path,
+                                records)
+        updates_metadata = state.load_cache()
+        if updates_metadata is not None:
+            yield state.records, updates_metadata
+        attempt = 0
+        while True:
+            params = state.poll_params(self.sub_secret)
+            poll_url = urllib.parse.urljoin(
+                self.url, '/poll?%s' % urllib.parse.urlencode(params,
+                                                              doseq=True))
+            headers = {ACCEPT_ENCODING_HEADER: 'deflate'} if compress else {}
+            try:
+                session = self.pool.get(self.url)
+                # Updates are streamed for as long as we are subscribed.
+                async with session.get(poll_url, headers=headers,
+                                       timeout=None) as resp:
+                    if resp.status != 200:
+                        raise ConnectionError('HTTP error {}'.format(
+                            resp.status))
+                    attempt = 0
+                    state.connected(resp.headers)
+                    reader = MessageReader(resp.headers.get(ENCODING_HEADER))
+                    while True:
+                        chunk = await resp.content.readany()
+                        if not chunk:
+                            raise ConnectionError('connection closed by the '
+                                                  'server')
+                        for l in reader.feed(chunk):
+                            updates = prologin.jsoncodec.loads(l)
+                            updates_metadata = state.receive(updates)
+                            yield state.records, updates_metadata
+            except asyncio.CancelledError:
+                raise
+            except (aiohttp.ClientError, ConnectionError, asyncio.TimeoutError,
+                    prologin.jsoncodec.DecodeError, zlib.error) as e:
+                logging.error('connection synchronisation server lost: '
+                              '%s (url: %s)', e, self.url)
+
+            state.flush_cache()
+            delay = prologin.rpc.client.backoff_delay(attempt, retry_delay,
+                                                      retry_max_delay)
+            attempt += 1
+            logging.warning('reconnecting to the synchronisation server in '
+                            '%.1fs', delay)
+            await asyncio.sleep(delay)
@@ -0,0 +1,28 @@
+# This file is part of Prologin-SADM.
+#
+# Prologin-SADM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Prologin-SADM is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Prologin-SADM.  If not, see <http://www.gnu.org/licenses/>.
+
+from prometheus_client import Counter, Gauge
+
+sync_subscribers = Gauge(
+    'sync_subscribers',
+    'Number of subscribers connected to the synchronisation server')
+
+sync_coalesced = Counter(
+    'sync_coalesced',
+    'Number of times the queued updates of a slow subscriber were coalesced')
+
+sync_slow_disconnects = Counter(
+    'sync_slow_disconnects',
+    'Number of subscribers disconnected because they were too slow')
@@ -0,0 +1,153 @@
+# This file is part of Prologin-SADM.
+#
+# Prologin-SADM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Prologin-SADM is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Prologin-SADM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""On-disk copy of the backlog of a synchronisation server, so that it can
+serve subscribers right after a restart, before its data source answers.
+
+The store is made of two JSONL files: a snapshot of the records, written
+atomically, and a journal of the updates applied since the snapshot, which
+is appended to and fsynced in batches. The journal is folded into a new
+snapshot once it is long enough.
+"""
+
+import logging
+import os
+import prologin.jsoncodec
+import time
+
+# Number of journaled updates after which a new snapshot is written.
+COMPACT_AFTER = 10000
+
+# Maximum number of seconds journaled updates can stay unsynced.
+SYNC_INTERVAL = 1
+
+
+def open_private(path, mode='wb'):
+    """Open `path` for writing (`mode` is 'wb' or 'ab') so that only its
+    owner can read it: records may hold secrets such as passwords.
+    """
+    flags = os.O_WRONLY | os.O_CREAT
+    flags |= os.O_APPEND if mode == 'ab' else os.O_TRUNC
+    fd = os.open(path, flags, 0o600)
+    try:
+        # The file may predate this function.
+        os.fchmod(fd, 0o600)
+        return os.fdopen(fd, mode)
+    except BaseException:
+        os.close(fd)
+        raise
+
+
+class SnapshotStore:
+    """Snapshot and journal of records whose primary key is `pk`, stored
+    at `path` and `path`.journal.
+    """
+
+    def __init__(self, path, pk, compact_after=COMPACT_AFTER,
+                 sync_interval=SYNC_INTERVAL):
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.pk = pk
+        self.compact_after = compact_after
+        self.sync_interval = sync_interval
+        self.journal = None
+        self.journal_length = 0
+        self.unsynced = False
+        self.last_sync = time.monotonic()
+
+    def load(self):
+        """Return the stored mapping of records (primary key -> record), or
+        None if there is no snapshot.
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                records = {}
+                for line in f:
+                    record = prologin.jsoncodec.loads(line)
+                    records[record[self.pk]] = record
+        except FileNotFoundError:
+            return None
+
+        self.journal_length = 0
+        try:
+            with open(self.journal_path, 'rb') as f:
+                for line in f:
+                    try:
+                        update = prologin.jsoncodec.loads(line)
+                    except prologin.jsoncodec.DecodeError:
+                        # The last line may be partially written.
+                        logging.warning('ignoring the end of the truncated '
+                                        'journal %s', self.journal_path)
+                        break
+                    key = update['data'][self.pk]
+                    if update['type'] == 'update':
+                        records[key] = update['data']
+                    else:
+                        records.pop(key, None)
+                    self.journal_length += 1
+        except FileNotFoundError:
+            pass
+        return records
+
+    def write_snapshot(self, records):
+        """Atomically replace the snapshot with `records` (an iterable of
+        records) and empty the journal.
+        """
+        tmp_path = self.path + '.tmp'
+        with open_private(tmp_path) as f:
+            for record in records:
+                f.write(prologin.jsoncodec.dumpb(record) + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = open_private(self.journal_path)
+        self.journal_length = 0
+        self.unsynced = False
+
+    def append(self, updates, records):
+        """Journal `updates`, that turned the backlog into `records` (a
+        mapping). Write a new snapshot if the journal is long enough.
+        """
+        if self.journal is None:
+            self.journal = open_private(self.journal_path, 'ab')
+        self.journal.write(b''.join(
+            prologin.jsoncodec.dumpb({'type': u['type'], 'data': u['data']})
+            + b'\n' for u in updates))
+        self.journal_length += len(updates)
+        self.unsynced = True
+
+        if self.journal_length >= self.compact_after:
+            self.write_snapshot(records.values())
+        elif time.monotonic() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        """Flush the journaled updates to the disk."""
+        self.last_sync = time.monotonic()
+        if not self.unsynced:
+            return
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.unsynced = False
+
+    def close(self):
+        """Sync and close the journal."""
+        if self.journal is not None:
+            self.sync()
+            self.journal.close()
+            self.journal = None
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+
+import unittest
+
+import prologin.jsoncodec
+
+
+class JSONCodecTest(unittest.TestCase):
+    def test_roundtrip(self):
+        obj = {'hostname': 'pasteur-r01p01', 'rfs': 0, 'aliases': [],
+               'is_faulty': False, 'nested': [{'a': None, 'b': 1.5}]}
+        self.assertEqual(
+            prologin.jsoncodec.loads(prologin.jsoncodec.dumps(obj)), obj)
+        self.assertEqual(
+            prologin.jsoncodec.loads(prologin.jsoncodec.dumpb(obj)), obj)
+
+    def test_float_precision(self):
+        value = 1.0000000000000002
+        self.assertEqual(prologin.jsoncodec.loads(
+            prologin.jsoncodec.dumps([value])), [value])
+
+    def test_non_str_keys(self):
+        self.assertEqual(
+            prologin.jsoncodec.loads(prologin.jsoncodec.dumps({1: 'a'})),
+            {'1': 'a'})
+
+    def test_default(self):
+        self.assertEqual(
+            prologin.jsoncodec.loads(prologin.jsoncodec.dumps(
+                {'s': {3, 4}}, default=sorted)),
+            {'s': [3, 4]})
+
+    def test_object_hook(self):
+        def hook(d):
+            return d.get('v', d)
+        self.assertEqual(
+            prologin.jsoncodec.loads('[{"v": 1}, {"a": {"v": 2}}]',
+                                     object_hook=hook),
+            [1, {'a': 2}])
+
+    def test_errors(self):
+        with self.assertRaises(prologin.jsoncodec.EncodeError):
+            prologin.jsoncodec.dumps({'o': object()})
+        with self.assertRaises(prologin.jsoncodec.DecodeError):
+            prologin.jsoncodec.loads('{not json')
@@ -3,13 +3,18 @@
 
 import asyncio
 import contextlib
+import io
 import logging
+import requests
 import socket
 import threading
 import time
 import unittest
+import unittest.mock
 
+import prologin.rpc.channel
 import prologin.rpc.client
+import prologin.rpc.encoding
 import prologin.rpc.server
 
 
@@ -52,6 +57,33 @@ class RPCServer(prologin.rpc.server.BaseRPCApp):
     async def public_hello(self):
         return 'hello'
 
+    @prologin.rpc.remote_method(max_concurrency=1, queue=0, retry_after=0.1)
+    async def sleep_alone(self, duration):
+        await asyncio.sleep(duration)
+        return duration
+
+    @prologin.rpc.remote_method(stream='data')
+    async def read_stream(self, prefix, data):
+        content = b''
+        while True:
+            chunk = await data.read(1024)
+            if not chunk:
+                break
+            content += chunk
+        return prefix + content
+
+    @prologin.rpc.remote_method
+    async def call_back(self, method):
+        return (await self.channel.call(method, [], {}))
+
+    def channel_opened(self, channel):
+        self.channel = channel
+
+    @prologin.rpc.remote_method(cacheable=True)
+    async def count_calls(self, name):
+        self.calls = getattr(self, 'calls', 0) + 1
+        return [name, self.calls]
+
 
 
 URL = 'http://127.0.0.1:42545'
@@ -105,6 +137,32 @@ class RPCTest(unittest.TestCase):
         res = self.c.return_args_kwargs(1, 'c', kw1='a', kw2=None)
         self.assertEqual(res, [[1, 'c'], {'kw1': 'a', 'kw2': None}])
 
+    def test_stream_file(self):
+        data = bytes(range(256)) * 1000
+        self.assertEqual(self.c.read_stream(b'>', data=io.BytesIO(data)),
+                         b'>' + data)
+
+    def test_stream_undeclared(self):
+        with self.assertRaises(prologin.rpc.client.RemoteError) as e:
+            self.c.return_input(inp=io.BytesIO(b'data'))
+        self.assertEqual(e.exception.type, 'TypeError')
+
+    def test_cacheable(self):
+        first = self.c.count_calls('a')
+        self.assertEqual(self.c.count_calls('a'), first)
+        self.assertEqual(self.c.count_calls(name='a'), first)
+        other = self.c.count_calls('b')
+        self.assertEqual(other, ['b', first[1] + 1])
+
+        self.s.app.app.response_cache.invalidate()
+        self.assertEqual(self.c.count_calls('a'), ['a', first[1] + 2])
+
+    def test_bytes(self):
+        data = bytes(range(256))
+        self.assertEqual(self.c.return_input(data), data)
+        self.assertEqual(self.c.return_input({'nested': [data]}),
+                         {'nested': [data]})
+
     def test_missing_method(self):
         with self.assertRaises(prologin.rpc.client.RemoteError) as e:
             self.c.missing_method()
@@ -116,6 +174,91 @@ class RPCTest(unittest.TestCase):
         self.assertEqual(e.exception.type, 'ValueError')
         self.assertEqual(e.exception.message, 'Monde de merde.')
 
+    def test_batch(self):
+        res = self.c.batch([
+            ('return_number', (), {}),
+            ('return_input', ('prologin',), {}),
+            ('return_args_kwargs', (1, 'c'), {'kw1': 'a'}),
+        ])
+        self.assertEqual(res, [
+            42,
+            'prologin',
+            [[1, 'c'], {'kw1': 'a', 'kw2': None}],
+        ])
+
+    def test_batch_sequential(self):
+        res = self.c.batch([('return_number', (), {})] * 3, concurrent=False)
+        self.assertEqual(res, [42, 42, 42])
+
+    def test_batch_exceptions(self):
+        number, missing, error = self.c.batch([
+            ('return_number', (), {}),
+            ('missing_method', (), {}),
+            ('raises_valueerror', (), {}),
+        ])
+        self.assertEqual(number, 42)
+        self.assertIsInstance(missing, prologin.rpc.client.RemoteError)
+        self.assertEqual(missing.type, 'MethodError')
+        self.assertIsInstance(error, prologin.rpc.client.RemoteError)
+        self.assertEqual(error.type, 'ValueError')
+
+    @unittest.skipIf(prologin.rpc.encoding.msgpack is None,
+                     'msgpack is not installed')
+    def test_peer_downgraded(self):
+        peer = prologin.rpc.client.SessionPool.peer(URL)
+        self.addCleanup(prologin.rpc.client.peer_encodings.pop, peer, None)
+        prologin.rpc.client.peer_encodings[peer] = (
+            prologin.rpc.encoding.MSGPACK)
+        # The server no longer understands msgpack.
+        with unittest.mock.patch('prologin.rpc.encoding.supported',
+                                 return_value=[prologin.rpc.encoding.JSON]):
+            self.assertEqual(self.c.return_number(), 42)
+        self.assertEqual(prologin.rpc.client.peer_encodings[peer],
+                         prologin.rpc.encoding.JSON)
+
+    def test_batch_malformed(self):
+        too_many = [{'method': 'return_number'}] * (
+            prologin.rpc.server.MAX_BATCH_SIZE + 1)
+        for batch in ([], {'calls': 'return_number'}, {'calls': too_many}):
+            r = requests.post(URL + '/batch', json=batch)
+            self.assertEqual(r.status_code, 400)
+            self.assertEqual(r.json()['exn_type'], 'ValueError')
+
+    def test_batch_malformed_calls(self):
+        r = requests.post(URL + '/batch', json={'calls': [
+            42,
+            {'args': []},
+            {'method': 'return_input', 'args': 'prologin'},
+            {'method': 'return_input', 'args': ['prologin']},
+        ]})
+        self.assertEqual(r.status_code, 200)
+        results = r.json()['data']
+        for result in results[:3]:
+            self.assertEqual(result['type'], 'exception')
+            self.assertEqual(result['exn_type'], 'ValueError')
+        self.assertEqual(results[3], {'type': 'result', 'data': 'prologin'})
+
+    @unittest.skipIf(prologin.rpc.encoding.msgpack is None,
+                     'msgpack is not installed')
+    def test_batch_non_str_keys(self):
+        calls = [
+            {'method': 'return_number', 1: 2},
+            {'method': 'return_input', 'kwargs': {1: 'prologin'}},
+            {'method': 'return_number'},
+        ]
+        r = requests.post(
+            URL + '/batch',
+            data=prologin.rpc.encoding.encode(
+                {'calls': calls}, prologin.rpc.encoding.MSGPACK),
+            headers={'Content-Type': prologin.rpc.encoding.MSGPACK,
+                     'Accept': prologin.rpc.encoding.MSGPACK})
+        self.assertEqual(r.status_code, 200)
+        results = prologin.rpc.encoding.decode(
+            r.content, prologin.rpc.encoding.MSGPACK)['data']
+        for result in results[:2]:
+            self.assertEqual(result['exn_type'], 'ValueError')
+        self.assertEqual(results[2], {'type': 'result', 'data': 42})
+
 
 class RPCAsyncTest(unittest.TestCase):
 
@@ -135,6 +278,139 @@ class RPCAsyncTest(unittest.TestCase):
         loop = asyncio.get_event_loop()
         self.assertEqual(loop.run_until_complete(self.c.return_number()), 42)
 
+    def test_async_stream_iterator(self):
+        async def chunks():
+            for i in range(10):
+                yield bytes([i]) * 100
+
+        loop = asyncio.get_event_loop()
+        res = loop.run_until_complete(
+            self.c.read_stream(b'', data=chunks()))
+        self.assertEqual(res, b''.join(bytes([i]) * 100 for i in range(10)))
+
+    def test_async_busy(self):
+        async def late_call(**kwargs):
+            await asyncio.sleep(0.1)
+            return (await self.c.sleep_alone(0, **kwargs))
+
+        async def calls():
+            return (await asyncio.gather(
+                self.c.sleep_alone(0.5),
+                late_call(),
+                return_exceptions=True))
+
+        loop = asyncio.get_event_loop()
+        slow, rejected = loop.run_until_complete(calls())
+        self.assertEqual(slow, 0.5)
+        self.assertIsInstance(rejected, prologin.rpc.client.ServerBusy)
+        self.assertEqual(rejected.retry_after, 0.1)
+
+    def test_async_busy_retry(self):
+        async def late_call(**kwargs):
+            await asyncio.sleep(0.1)
+            return (await self.c.sleep_alone(0, **kwargs))
+
+        async def calls():
+            return (await asyncio.gather(
+                self.c.sleep_alone(0.3),
+                late_call(max_retries=10)))
+
+        loop = asyncio.get_event_loop()
+        self.assertEqual(loop.run_until_complete(calls()), [0.3, 0])
+
+    def test_async_session_reused(self):
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(self.c.return_number())
+        session = self.c.pool.get(URL)
+        loop.run_until_complete(self.c.return_number())
+        self.assertIs(self.c.pool.get(URL), session)
+
+    def test_async_context_manager(self):
+        async def call():
+            async with prologin.rpc.client.Client(URL) as c:
+                self.assertIsNotNone(c.session)
+                return (await c.return_number())
+
+        loop = asyncio.get_event_loop()
+        self.assertEqual(loop.run_until_complete(call()), 42)
+
+
+class RPCChannelTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.s = RPCServerInstance()
+        cls.s.start()
+        time.sleep(1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.s.stop()
+        time.sleep(0.5)
+
+    def run_with_channel(self, func):
+        async def dispatch(method, args, kwargs):
+            if method == 'ping':
+                return 'pong'
+            raise ValueError(method)
+
+        async def run():
+            channel = await prologin.rpc.channel.connect(URL, None, dispatch)
+            task = asyncio.ensure_future(channel.run())
+            try:
+                c = prologin.rpc.channel.ChannelClient(URL, channel=channel)
+                return (await func(c))
+            finally:
+                await channel.close()
+                await task
+
+        return asyncio.get_event_loop().run_until_complete(run())
+
+    def test_channel_call(self):
+        async def call(c):
+            return (await c.return_input({'nested': [b'bytes']}))
+        self.assertEqual(self.run_with_channel(call), {'nested': [b'bytes']})
+
+    def test_channel_exception(self):
+        async def call(c):
+            with self.assertRaises(prologin.rpc.client.RemoteError) as e:
+                await c.raises_valueerror()
+            return e.exception.type
+        self.assertEqual(self.run_with_channel(call), 'ValueError')
+
+    def test_channel_stream(self):
+        async def call(c):
+            return (await c.read_stream(b'>', data=io.BytesIO(b'data')))
+        self.assertEqual(self.run_with_channel(call), b'>data')
+
+    def test_channel_call_back(self):
+        async def call(c):
+            pong = await c.call_back('ping')
+            with self.assertRaises(prologin.rpc.client.RemoteError):
+                await c.call_back('missing')
+            return pong
+        self.assertEqual(self.run_with_channel(call), 'pong')
+
+    def test_channel_malformed_message(self):
+        async def call(c):
+            for frame in ('[1]', '{"type": "call"}', '42'):
+                await c.channel.ws.send_str(frame)
+            return (await c.return_number())
+        self.assertEqual(self.run_with_channel(call), 42)
+
+    def test_channel_timeout(self):
+        async def call(c):
+            c.channel.timeout = 0.1
+            with self.assertRaises(ConnectionResetError):
+                await c.sleep_alone(1)
+            return c.channel.closed
+        self.assertTrue(self.run_with_channel(call))
+
+    def test_channel_closed_fallback(self):
+        async def call(c):
+            await c.channel.close()
+            return (await c.return_number())
+        self.assertEqual(self.run_with_channel(call), 42)
+
 
 class RPCSecretTest(unittest.TestCase):
     GOOD_SECRET = b'secret42'
@@ -149,6 +425,7 @@ class RPCSecretTest(unittest.TestCase):
     @classmethod
     def tearDownClass(cls):
         cls.s.stop()
+        time.sleep(0.5)
 
     def test_good_secret(self):
         c = prologin.rpc.client.SyncClient(URL, secret=self.GOOD_SECRET)
@@ -160,6 +437,14 @@ class RPCSecretTest(unittest.TestCase):
             c.return_number()
         self.assertEqual(e.exception.type, 'BadToken')
 
+    def test_channel_bad_secret(self):
+        async def dispatch(method, args, kwargs):
+            pass
+
+        with self.assertRaises(ConnectionError):
+            asyncio.get_event_loop().run_until_complete(
+                prologin.rpc.channel.connect(URL, self.BAD_SECRET, dispatch))
+
     def test_missing_secret(self):
         c = prologin.rpc.client.SyncClient(URL)
         with self.assertRaises(prologin.rpc.client.RemoteError) as e:
@@ -178,6 +463,85 @@ class RPCSecretTest(unittest.TestCase):
         c = prologin.rpc.client.SyncClient(URL)
         self.assertEqual(c.public_hello(), 'hello')
 
+    def test_batch_secret(self):
+        c = prologin.rpc.client.SyncClient(URL, secret=self.GOOD_SECRET)
+        self.assertEqual(c.batch([('return_number', (), {}),
+                                  ('public_hello', (), {})]),
+                         [42, 'hello'])
+
+    def test_batch_bad_secret(self):
+        c = prologin.rpc.client.SyncClient(URL, secret=self.BAD_SECRET)
+        number, hello = c.batch([('return_number', (), {}),
+                                 ('public_hello', (), {})])
+        self.assertEqual(number.type, 'BadToken')
+        self.assertEqual(hello, 'hello')
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def key(self, *args, **kwargs):
+        def method(a, b=1, *rest, c=2, **options):
+            pass
+        return prologin.rpc.server.ResponseCache.key(
+            'method', method, {'args': list(args), 'kwargs': kwargs},
+            'application/json')
+
+    def test_key_canonical(self):
+        self.assertEqual(self.key(0), self.key(a=0))
+        self.assertEqual(self.key(0), self.key(0, 1, c=2))
+        self.assertEqual(self.key(0, x=1, y=2), self.key(0, y=2, x=1))
+        self.assertNotEqual(self.key(0), self.key(0, 2))
+        self.assertNotEqual(self.key(0), self.key(0, 1, 2))
+
+    def test_key_uncacheable(self):
+        self.assertIsNone(self.key())
+        self.assertIsNone(self.key(0, d=object()))
+
+
+class BackoffTest(unittest.TestCase):
+    def test_backoff_delay(self):
+        for attempt, low, high in [(0, 0.5, 1), (1, 1, 2), (2, 2, 4),
+                                   (10, 2.5, 5)]:
+            for _ in range(100):
+                delay = prologin.rpc.client.backoff_delay(attempt, 1, 5)
+                self.assertTrue(low <= delay <= high)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.breaker = prologin.rpc.client.CircuitBreaker(
+            'http://test', failure_threshold=2, reset_timeout=0.1)
+
+    def test_opens_after_failures(self):
+        self.breaker.record_failure()
+        self.breaker.check()
+        self.breaker.record_failure()
+        with self.assertRaises(socket.error):
+            self.breaker.check()
+
+    def test_success_resets_failures(self):
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.breaker.check()
+
+    def test_half_open(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        time.sleep(0.1)
+        self.breaker.check()  # The probe goes through...
+        with self.assertRaises(prologin.rpc.client.CircuitOpenError):
+            self.breaker.check()  # ...but not the other calls.
+
+        self.breaker.record_failure()
+        with self.assertRaises(prologin.rpc.client.CircuitOpenError):
+            self.breaker.check()
+
+        time.sleep(0.1)
+        self.breaker.check()
+        self.breaker.record_success()
+        self.breaker.check()
+        self.breaker.check()
+
 
 @unittest.skip("FIXME: Race conditions, address already in use")
 class RPCRetryTest(unittest.TestCase):
@@ -186,7 +550,7 @@ class RPCRetryTest(unittest.TestCase):
         s.start()
         c = prologin.rpc.client.SyncClient(URL)
         with disable_logging():
-            self.assertEqual(c.return_number(max_retries=1, retry_delay=2), 42)
+            self.assertEqual(c.return_number(max_retries=1, retry_delay=3), 42)
         s.stop()
 
     def test_retry_notenough(self):
@@ -0,0 +1,492 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+
+import asyncio
+import json
+import os.path
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+
+import prologin.jsoncodec
+import prologin.rpc.client
+import prologin.rpc.server
+import prologin.synchronisation
+
+
+def update(k, v):
+    return {'type': 'update', 'data': {'k': k, 'v': v}}
+
+
+class PubSubQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.queue = prologin.synchronisation.DefaultPubSubQueue(
+            'k', [{'k': 1, 'v': 1}])
+        self.queue.journal = self.queue.journal.__class__(maxlen=3)
+        self.messages = []
+        self.queue.add_subscriber(
+            lambda msg: self.messages.append(json.loads(msg)))
+
+    def test_sequence_numbers(self):
+        self.queue.apply_updates([update(1, 2), update(2, 1)])
+        self.queue.apply_updates([update(2, 2)])
+        self.assertEqual([[u['seq'] for u in m] for m in self.messages],
+                         [[1, 2], [3]])
+        self.assertEqual(self.queue.position(),
+                         '{}:3'.format(self.queue.epoch))
+
+    def test_incremental(self):
+        since = self.queue.position()
+        self.queue.apply_updates([update(1, 2)])
+        self.queue.apply_updates([update(2, 1)])
+        resync, position, message = self.queue.first_message(since)
+        self.assertEqual(resync, 'incremental')
+        self.assertEqual(position, self.queue.position())
+        self.assertEqual([u['data'] for u in json.loads(message)],
+                         [{'k': 1, 'v': 2}, {'k': 2, 'v': 1}])
+
+        resync, _, message = self.queue.first_message(position)
+        self.assertEqual((resync, message), ('incremental', None))
+
+    def test_full(self):
+        since = self.queue.position()
+        self.queue.apply_updates([update(i, i) for i in range(4)])
+        resync, _, message = self.queue.first_message(since)
+        self.assertEqual(resync, 'full')
+        self.assertEqual(len(json.loads(message)), 4)
+
+        for bad in (None, 'nope', 'other:0',
+                    '{}:42'.format(self.queue.epoch)):
+            self.assertEqual(self.queue.first_message(bad)[0], 'full')
+
+
+    def test_encoded_once(self):
+        first, second = [], []
+        self.queue.add_subscriber(lambda msg: first.append(msg))
+        self.queue.add_subscriber(lambda msg: second.append(msg))
+        self.queue.apply_updates([update(1, 2)])
+        self.assertIs(first[0], second[0])
+        self.assertTrue(first[0].endswith(b'\n'))
+
+    def test_backlog_cache(self):
+        backlog = self.queue.encoded_backlog()
+        self.assertIs(self.queue.encoded_backlog(), backlog)
+        self.queue.apply_updates([update(2, 1), update(1, 3)])
+        self.queue.apply_updates([{'type': 'delete', 'data': {'k': 2}}])
+        backlog = self.queue.encoded_backlog()
+        self.assertEqual(
+            json.loads(backlog),
+            [{'type': 'update', 'data': {'k': 1, 'v': 3}}])
+        self.assertEqual(
+            json.loads(backlog),
+            json.loads(prologin.synchronisation.encode_message(
+                self.queue.get_backlog_message())))
+
+
+class SubscriptionTest(unittest.TestCase):
+    def setUp(self):
+        self.queue = prologin.synchronisation.DefaultPubSubQueue('k', [
+            {'k': 1, 'v': 1, 't': 'a'},
+            {'k': 2, 'v': 1, 't': 'b'},
+        ])
+        self.subscription = prologin.synchronisation.Subscription(
+            'k', where={'t': 'a'}, fields={'t'})
+        self.messages = []
+        self.queue.add_subscriber(
+            lambda msg: self.messages.append(json.loads(msg)),
+            self.subscription)
+
+    def test_from_arguments(self):
+        from_arguments = prologin.synchronisation.Subscription.from_arguments
+        self.assertIsNone(from_arguments('k', [], None))
+        subscription = from_arguments('k', ['t=a', 'v=1'], 'v, w')
+        self.assertEqual(subscription.where, {'t': 'a', 'v': '1'})
+        self.assertEqual(subscription.fields, {'k', 'v', 'w'})
+        with self.assertRaises(ValueError):
+            from_arguments('k', ['t'], None)
+
+    def test_backlog(self):
+        _, _, message = self.queue.first_message(None, self.subscription)
+        self.assertEqual(json.loads(message),
+                         [{'type': 'update', 'data': {'k': 1, 't': 'a'}}])
+
+    def test_updates(self):
+        self.queue.apply_updates([
+            {'type': 'update', 'data': {'k': 1, 'v': 2, 't': 'a'}},
+            {'type': 'update', 'data': {'k': 2, 'v': 2, 't': 'b'}},
+        ])
+        self.assertEqual(self.messages, [])
+
+        self.queue.apply_updates([
+            {'type': 'update', 'data': {'k': 2, 'v': 2, 't': 'a'}},
+            {'type': 'update', 'data': {'k': 1, 'v': 2, 't': 'b'}},
+        ])
+        self.assertEqual(self.messages, [[
+            {'type': 'update', 'data': {'k': 2, 't': 'a'}, 'seq': 3},
+            {'type': 'delete', 'data': {'k': 1}, 'seq': 4},
+        ]])
+
+    def test_incremental(self):
+        since = self.queue.position()
+        self.queue.apply_updates([
+            {'type': 'update', 'data': {'k': 3, 'v': 1, 't': 'a'}},
+            {'type': 'delete', 'data': {'k': 3}},
+            {'type': 'delete', 'data': {'k': 2}},
+        ])
+        _, _, message = self.queue.first_message(since, self.subscription)
+        self.assertEqual(json.loads(message), [
+            {'type': 'update', 'data': {'k': 3, 't': 'a'}, 'seq': 1},
+            {'type': 'delete', 'data': {'k': 3}, 'seq': 2},
+        ])
+
+
+class CompressionTest(unittest.TestCase):
+    def test_compressed_once(self):
+        queue = prologin.synchronisation.DefaultPubSubQueue('k', [])
+        msg = prologin.synchronisation.encode_message([update(1, 1)])
+        compressed = queue.compressed(msg)
+        self.assertIs(queue.compressed(msg), compressed)
+        self.assertEqual(zlib.decompress(compressed), msg)
+
+    def test_message_reader(self):
+        messages = [prologin.synchronisation.encode_message([update(i, i)])
+                    for i in range(3)]
+        for encoding, body in [
+                (None, b''.join(messages)),
+                ('deflate', b''.join(zlib.compress(m) for m in messages))]:
+            reader = prologin.synchronisation.MessageReader(encoding)
+            received = []
+            for i in range(0, len(body), 7):
+                received.extend(reader.feed(body[i:i + 7]))
+            self.assertEqual([m + b'\n' for m in received], messages)
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'backlog.jsonl')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def store(self, **kwargs):
+        return prologin.synchronisation.SnapshotStore(self.path, 'k', **kwargs)
+
+    def test_no_snapshot(self):
+        self.assertIsNone(self.store().load())
+
+    def test_journal(self):
+        queue = prologin.synchronisation.DefaultPubSubQueue(
+            'k', [{'k': 1, 'v': 1}, {'k': 2, 'v': 1}], self.store())
+        queue.apply_updates([update(1, 2), update(3, 1)])
+        queue.apply_updates([{'type': 'delete', 'data': {'k': 2}}])
+        queue.store.close()
+        # Simulate a crash in the middle of a write.
+        with open(self.path + '.journal', 'ab') as f:
+            f.write(b'{"type": "upd')
+
+        store = self.store()
+        self.assertEqual(store.load(), queue.backlog)
+        self.assertEqual(store.journal_length, 3)
+
+    def test_compact(self):
+        queue = prologin.synchronisation.DefaultPubSubQueue(
+            'k', [], self.store(compact_after=2))
+        queue.apply_updates([update(1, 1), update(2, 1)])
+        queue.apply_updates([update(1, 2)])
+        queue.store.close()
+        self.assertEqual(os.path.getsize(self.path + '.journal'),
+                         len(prologin.jsoncodec.dumpb(update(1, 2)) + b'\n'))
+        self.assertEqual(self.store().load(), queue.backlog)
+
+    def test_private(self):
+        # Files left by a previous version are made private too.
+        with open(self.path + '.journal', 'wb'):
+            pass
+        os.chmod(self.path + '.journal', 0o644)
+        queue = prologin.synchronisation.DefaultPubSubQueue(
+            'k', [], self.store(compact_after=2))
+        queue.apply_updates([update(1, 1)])
+        self.assertEqual(os.stat(self.path + '.journal').st_mode & 0o777,
+                         0o600)
+        queue.apply_updates([update(2, 1)])
+        queue.store.close()
+        for path in (self.path, self.path + '.journal'):
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+
+    def test_reconcile(self):
+        queue = prologin.synchronisation.DefaultPubSubQueue(
+            'k', [{'k': 1, 'v': 1}, {'k': 2, 'v': 1}, {'k': 3, 'v': 1}])
+        since_seq = queue.seq
+        # Published while the data source was queried.
+        queue.apply_updates([update(3, 2)])
+        queue.reconcile([{'k': 1, 'v': 1}, {'k': 3, 'v': 1},
+                         {'k': 4, 'v': 1}], since_seq)
+        self.assertEqual(queue.backlog, {1: {'k': 1, 'v': 1},
+                                         3: {'k': 3, 'v': 2},
+                                         4: {'k': 4, 'v': 1}})
+
+
+class DebounceTest(unittest.TestCase):
+    def test_merge_updates_metadata(self):
+        merge = prologin.synchronisation.merge_updates_metadata
+        metadata = {1: 'created', 2: 'created', 3: 'updated', 4: 'deleted',
+                    5: 'updated'}
+        self.assertEqual(merge(metadata, {1: 'updated', 2: 'deleted',
+                                          3: 'deleted', 4: 'created',
+                                          6: 'created'}),
+                         {1: 'created', 3: 'deleted', 4: 'updated',
+                          5: 'updated', 6: 'created'})
+
+    def test_debounced_delivery(self):
+        calls = []
+        delivery = prologin.synchronisation.DebouncedDelivery(
+            lambda records, metadata: calls.append(dict(metadata)),
+            debounce=0.05, max_latency=0.2)
+        threading.Thread(target=delivery.run, args=({},),
+                         daemon=True).start()
+
+        def add(metadata):
+            with delivery.lock:
+                delivery.add(metadata)
+
+        add({1: 'created'})
+        add({1: 'updated', 2: 'created'})
+        time.sleep(0.15)
+        self.assertEqual(calls, [{1: 'created', 2: 'created'}])
+
+        # A continuous stream of updates is delivered after max_latency.
+        for i in range(10):
+            add({i: 'updated'})
+            time.sleep(0.03)
+        self.assertGreaterEqual(len(calls), 2)
+        self.assertEqual(calls[1], {i: 'updated' for i in range(len(calls[1]))})
+
+
+class IndexedStateTest(unittest.TestCase):
+    def test_apply_updates(self):
+        state = prologin.synchronisation.IndexedState(['h', 'ip'])
+        prologin.synchronisation.apply_updates('k', state, [
+            {'type': 'update', 'data': {'k': 1, 'h': 'a', 'ip': '1'}},
+            {'type': 'update', 'data': {'k': 2, 'h': 'b', 'ip': '2'}},
+            {'type': 'update', 'data': {'k': 1, 'h': 'c', 'ip': '1'}},
+            {'type': 'delete', 'data': {'k': 2}},
+        ])
+        self.assertEqual(state.lookup('h', 'c'), {'k': 1, 'h': 'c', 'ip': '1'})
+        self.assertIs(state.lookup('ip', '1'), state[1])
+        self.assertIsNone(state.lookup('h', 'a'))
+        self.assertIsNone(state.lookup('h', 'b'))
+        self.assertEqual(state.indexes, {'h': {'c': 1}, 'ip': {'1': 1}})
+
+    def test_mapping_methods(self):
+        state = prologin.synchronisation.IndexedState(['h'])
+        state.update({1: {'h': 'a'}, 2: {'h': 'b'}})
+        # A record taking the value of another one.
+        state[3] = {'h': 'a'}
+        del state[1]
+        self.assertEqual(state.lookup('h', 'a'), {'h': 'a'})
+        self.assertEqual(state.pop(3), {'h': 'a'})
+        self.assertIsNone(state.pop(3, None))
+        self.assertEqual(state.indexes, {'h': {'b': 2}})
+        state.clear()
+        self.assertEqual(state.indexes, {'h': {}})
+
+    def test_subscriber_records(self):
+        records = prologin.synchronisation.IndexedState(['v'])
+        state = prologin.synchronisation.SubscriberState('k', records=records)
+        state.connected({'X-Sync-Resync': 'full', 'X-Sync-Seq': 'e:0'})
+        state.receive([update(1, 'x')])
+        self.assertIs(state.records, records)
+        self.assertEqual(records.lookup('v', 'x'), {'k': 1, 'v': 'x'})
+
+
+class CoalesceTest(unittest.TestCase):
+    def test_coalesce_messages(self):
+        encode = prologin.synchronisation.encode_message
+        messages = [
+            encode([dict(update(1, 1), seq=1), dict(update(2, 1), seq=2)]),
+            encode([{'type': 'delete', 'data': {'k': 2}, 'seq': 3}]),
+            encode([dict(update(1, 2), seq=4), dict(update(3, 1), seq=5)]),
+        ]
+        msg = prologin.synchronisation.coalesce_messages('k', messages)
+        self.assertTrue(msg.endswith(b'\n'))
+        self.assertEqual(json.loads(msg), [
+            {'type': 'delete', 'data': {'k': 2}, 'seq': 3},
+            dict(update(1, 2), seq=4),
+            dict(update(3, 1), seq=5),
+        ])
+
+
+class ClientStateTest(unittest.TestCase):
+    def test_diff_states(self):
+        old = {1: {'k': 1, 'v': 1, 'w': 1}, 2: {'k': 2, 'v': 1, 'w': 1},
+               3: {'k': 3, 'v': 1, 'w': 1}}
+        new = {1: {'k': 1, 'v': 1, 'w': 1}, 2: {'k': 2, 'v': 2, 'w': 1},
+               4: {'k': 4, 'v': 1, 'w': 1}}
+        diff = prologin.synchronisation.diff_states
+        self.assertEqual(diff('k', old, new),
+                         {2: 'updated', 3: 'deleted', 4: 'created'})
+        self.assertEqual(diff('k', old, new, watch={'w'}),
+                         {3: 'deleted', 4: 'created'})
+
+    def test_subscriber_state(self):
+        state = prologin.synchronisation.SubscriberState('k')
+        state.connected({'X-Sync-Resync': 'full', 'X-Sync-Seq': 'e:1'})
+        self.assertEqual(state.receive([update(1, 1), update(2, 1)]),
+                         {1: 'created', 2: 'created'})
+        state.connected({'X-Sync-Resync': 'incremental',
+                         'X-Sync-Seq': 'e:1'})
+        self.assertEqual(state.receive([dict(update(2, 2), seq=2)]),
+                         {2: 'updated'})
+        self.assertEqual(state.position, 'e:2')
+        self.assertEqual(state.poll_params(b'secret')['since'], 'e:2')
+        state.connected({'X-Sync-Resync': 'full', 'X-Sync-Seq': 'e:5'})
+        self.assertEqual(state.receive([update(2, 2)]), {1: 'deleted'})
+        self.assertEqual(state.records, {2: {'k': 2, 'v': 2}})
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            path = prologin.synchronisation.cache_path('test', cache_dir)
+            state = prologin.synchronisation.SubscriberState(
+                'k', fields={'v'}, cache_path=path)
+            self.assertIsNone(state.load_cache())
+            state.connected({'X-Sync-Resync': 'full', 'X-Sync-Seq': 'e:1'})
+            state.receive([update(1, 1), update(2, 1)])
+            # Saved at most every CACHE_INTERVAL seconds.
+            state.receive([dict(update(2, 2), seq=2)])
+            state.flush_cache()
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+
+            cached = prologin.synchronisation.SubscriberState(
+                'k', fields={'v'}, cache_path=path)
+            self.assertEqual(cached.load_cache(),
+                             {1: 'created', 2: 'created'})
+            self.assertEqual(cached.records, state.records)
+            self.assertEqual(cached.position, 'e:2')
+
+            other = prologin.synchronisation.SubscriberState(
+                'k', cache_path=path)
+            self.assertIsNone(other.load_cache())
+
+    def test_advance_position(self):
+        advance = prologin.synchronisation.Client.advance_position
+        self.assertEqual(advance('e:3', [{'seq': 4}, {'seq': 5}]), 'e:5')
+        self.assertEqual(advance('e:3', [{'type': 'update'}]), 'e:3')
+        self.assertIsNone(advance(None, [{'seq': 4}]))
+
+
+URL = 'http://127.0.0.1:42546'
+
+
+class SyncServer(prologin.synchronisation.Server):
+    def __init__(self, port, loop):
+        super().__init__('k', 'pub', 'sub', port, 'test-sync', loop=loop)
+
+    def get_initial_backlog(self):
+        return [{'k': 1, 'v': 1}]
+
+
+class RPCServer(prologin.rpc.server.BaseRPCApp):
+    def __init__(self, sync_server, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sync_server = sync_server
+
+    @prologin.rpc.remote_method(auth_required=False)
+    async def query(self):
+        return list(self.sync_server.pubsub_queue.backlog.values())
+
+
+class SyncServerInstance(threading.Thread):
+    """Run a synchronisation server, or a RPC server it is mounted on."""
+
+    def __init__(self, port=42546, mount=False):
+        super().__init__()
+        self.port = port
+        self.mount = mount
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.server = SyncServer(self.port, self.loop)
+        if self.mount:
+            app = RPCServer(self.server, 'test-rpc', loop=self.loop)
+            self.server.mount(app)
+            app.run(port=self.port)
+        else:
+            self.server.start()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class ServerTest(unittest.TestCase):
+    MOUNT = False
+
+    @classmethod
+    def setUpClass(cls):
+        cls.s = SyncServerInstance(mount=cls.MOUNT)
+        cls.s.start()
+        time.sleep(0.5)  # Let it start
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.s.stop()
+        time.sleep(0.5)
+
+    def poll(self, *updates, **kwargs):
+        """Subscribe, send `updates` once the backlog is received and return
+        the records and metadata of the first two messages.
+        """
+        client = prologin.synchronisation.Client(URL, 'k', 'pub', 'sub')
+        async_client = prologin.synchronisation.AsyncClient(URL, 'k', 'sub')
+
+        async def poll():
+            messages = async_client.subscribe(**kwargs)
+            try:
+                records, metadata = await messages.__anext__()
+                received = [(dict(records), metadata)]
+                client.send_updates(list(updates))
+                records, metadata = await messages.__anext__()
+                return received + [(dict(records), metadata)]
+            finally:
+                await messages.aclose()
+
+        loop = asyncio.get_event_loop()
+        try:
+            return loop.run_until_complete(
+                asyncio.wait_for(poll(), timeout=5))
+        finally:
+            prologin.synchronisation.session_pool.close(loop)
+
+    def test_poll(self):
+        (backlog, _), (records, metadata) = self.poll(update(2, 1))
+        self.assertIn(1, backlog)
+        self.assertEqual(records[2], {'k': 2, 'v': 1})
+        self.assertEqual(metadata, {2: 'created'})
+
+    def test_poll_compressed_filtered(self):
+        _, (records, metadata) = self.poll(update(3, 0), update(3, 5),
+                                           where={'v': 5}, compress=True)
+        self.assertEqual(records[3], {'k': 3, 'v': 5})
+        self.assertEqual(metadata, {3: 'created'})
+
+    def test_poll_non_ascii(self):
+        _, (records, metadata) = self.poll(update(6, 'Rémi'))
+        self.assertEqual(records[6], {'k': 6, 'v': 'Rémi'})
+
+    def test_bad_secret(self):
+        client = prologin.synchronisation.Client(URL, 'k', 'bad', 'sub')
+        with self.assertRaises(RuntimeError):
+            client.send_update(update(4, 1))
+
+
+class MountedServerTest(ServerTest):
+    MOUNT = True
+
+    def test_shared_state(self):
+        client = prologin.synchronisation.Client(URL, 'k', 'pub', 'sub')
+        client.send_update(update(5, 1))
+        records = prologin.rpc.client.SyncClient(URL).query()
+        self.assertIn({'k': 5, 'v': 1}, records)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+
+import time
+import unittest
+import unittest.mock
+
+import prologin.config
+import prologin.timeauth
+
+
+class TokenVerifierTest(unittest.TestCase):
+    SECRET = b'secret42'
+
+    def setUp(self):
+        patcher = unittest.mock.patch.dict(prologin.config.loaded_configs,
+                                           {'timeauth': {'enabled': True}})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Forget the verifiers created by get_verifier.
+        patcher = unittest.mock.patch.dict(prologin.timeauth._verifiers)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.verifier = prologin.timeauth.TokenVerifier(self.SECRET)
+
+    def test_valid(self):
+        token = prologin.timeauth.generate_token(self.SECRET, 'msg')
+        self.assertTrue(self.verifier.check(token, 'msg'))
+        # Second check is answered by the cache.
+        self.assertTrue(self.verifier.check(token, 'msg'))
+
+    def test_bad_secret(self):
+        token = prologin.timeauth.generate_token(b'secret51', 'msg')
+        self.assertFalse(self.verifier.check(token, 'msg'))
+
+    def test_bad_message(self):
+        token = prologin.timeauth.generate_token(self.SECRET, 'msg')
+        self.assertTrue(self.verifier.check(token, 'msg'))
+        self.assertFalse(self.verifier.check(token, 'other'))
+
+    def test_non_ascii(self):
+        msg = '{"name": "Rémi"}'
+        token = prologin.timeauth.generate_token(self.SECRET, msg)
+        self.assertTrue(self.verifier.check(token, msg))
+        self.assertFalse(self.verifier.check(token, '{"name": "Remi"}'))
+
+    def test_malformed(self):
+        self.assertFalse(self.verifier.check(None, 'msg'))
+        self.assertFalse(self.verifier.check('garbage', 'msg'))
+        self.assertFalse(self.verifier.check('abc:def', 'msg'))
+
+    def test_expired(self):
+        token = prologin.timeauth.generate_token(self.SECRET, 'msg')
+        self.assertTrue(self.verifier.check(token, 'msg'))
+        later = time.time() + prologin.timeauth.TOKEN_TIMEOUT + 1
+        with unittest.mock.patch('time.time', return_value=later):
+            self.assertFalse(self.verifier.check(token, 'msg'))
+
+    def test_cache_bounded(self):
+        verifier = prologin.timeauth.TokenVerifier(self.SECRET, cache_size=2)
+        for i in range(5):
+            msg = 'msg{}'.format(i)
+            token = prologin.timeauth.generate_token(self.SECRET, msg)
+            self.assertTrue(verifier.check(token, msg))
+        self.assertEqual(len(verifier.verified), 2)
+
+    def test_disabled(self):
+        with unittest.mock.patch.dict(prologin.config.loaded_configs,
+                                      {'timeauth': {'enabled': False}}):
+            verifier = prologin.timeauth.TokenVerifier(self.SECRET)
+        self.assertTrue(verifier.check(None, 'msg'))
+
+    def test_check_token(self):
+        token = prologin.timeauth.generate_token(self.SECRET, 'msg')
+        self.assertTrue(prologin.timeauth.check_token(token, self.SECRET,
+                                                      'msg'))
+        self.assertIs(prologin.timeauth.get_verifier(self.SECRET),
+                      prologin.timeauth.get_verifier(self.SECRET))
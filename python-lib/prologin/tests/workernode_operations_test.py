@@ -11,8 +11,6 @@ import tempfile
 import unittest
 import yaml
 
-from base64 import b64decode, b64encode
-
 from prologin.workernode import operations
 
 
@@ -38,7 +36,7 @@ def get_hello_src_tgz():
     with tarfile.open(fileobj=out, mode="w:gz") as tar:
         put_file_in_tar(tar, 'prologin.c', HELLO_SRC)
         put_file_in_tar(tar, '_lang', 'cxx')
-    return b64encode(out.getvalue())
+    return out.getvalue()
 
 
 def get_hello_compiled_so():
@@ -58,7 +56,7 @@ def get_hello_compiled_tgz():
          tarfile.open(fileobj=out, mode="w:gz") as tar:
         compiled_path.write(compiled)
         tar.add(compiled_path.name, arcname='champion.so')
-    return b64encode(out.getvalue())
+    return out.getvalue()
 
 
 # Compilation tests
@@ -90,7 +88,7 @@ list-run-reqs:
         for f in ('prologin.c', '_lang', 'champion.so'):
             self.assertIn(f, log)
 
-        tgz = b64decode(compiled)
+        tgz = compiled
         with tempfile.TemporaryDirectory() as tmpdir:
             operations.untar(tgz, tmpdir)
             cpath = os.path.join(tmpdir, 'champion.so')
@@ -235,13 +233,13 @@ class FakeMatchTest(unittest.TestCase):
             # Construct map player_id -> [champion id, tarball]
             players = {42: [0, ctgz], 1337: [0, ctgz]}
             opts = {'--test_opt': 'TEST_OPT'}
-            f_opts = {'--test_fopt': b64encode(b'TEST_FOPT')}
+            f_opts = {'--test_fopt': b'TEST_FOPT'}
 
             server_result, server_out, dump, players_info = (
                 loop.run_until_complete(operations.spawn_match(
                     config, players, opts, f_opts)))
 
-        self.assertEqual(gzip.decompress(b64decode(dump)), b'DUMP TEST\n')
+        self.assertEqual(gzip.decompress(dump), b'DUMP TEST\n')
 
         sr_expected = [{'player': 1, 'score': 42, 'nb_timeout': 0},
                        {'player': 2, 'score': 1337, 'nb_timeout': 0}]
@@ -18,6 +18,7 @@
 time synchronisation between endpoints.
 """
 
+import collections
 import hashlib
 import hmac
 import time
@@ -27,6 +28,9 @@ import prologin.config
 # Validity time (in seconds) of a generated token.
 TOKEN_TIMEOUT = 120
 
+# Number of recently verified tokens remembered by verifiers.
+VERIFIED_CACHE_SIZE = 1024
+
 
 def generate_token(secret, message=None):
     """Generate a token given some `secret`."""
@@ -37,39 +41,86 @@ def generate_token(secret, message=None):
     )
 
 
-def check_token(token, secret, message=None):
-    """Return if `token` is valid according to `secret` and current time."""
+class TokenVerifier:
+    """Check tokens generated using some `secret`.
+
+    Create one verifier per secret and keep it: the HMAC key state is
+    computed only once, and recently verified (token, message digest) pairs
+    are remembered so that repeated tokens (several calls or heartbeats in
+    the same second) do not need a new HMAC.
+    """
+
+    def __init__(self, secret, cache_size=VERIFIED_CACHE_SIZE):
+        self.enabled = prologin.config.load('timeauth')['enabled']
+        self.hmac = hmac.new(secret, digestmod=hashlib.sha256)
+        self.cache_size = cache_size
+        self.verified = collections.OrderedDict()
+
+    def get_hmac(self, message):
+        """Return a HMAC of `message` for the secret."""
+        h = self.hmac.copy()
+        h.update(message.encode())
+        return h.hexdigest()
+
+    def check(self, token, message=None):
+        """Return if `token` is valid for `message` and current time."""
+        if not self.enabled:
+            return True
+
+        if token is None:
+            return False
+
+        # Reject badly formatted tokens.
+        chunks = token.split(':')
+        if len(chunks) != 2:
+            return False
+        try:
+            timestamp = int(chunks[0])
+        except ValueError:
+            return False
+
+        # Reject outdated tokens, even if they were valid before.
+        if time.time() - timestamp > TOKEN_TIMEOUT:
+            return False
+
+        message = str(message)
+        key = (token, hashlib.sha256(message.encode()).digest())
+        if key in self.verified:
+            self.verified.move_to_end(key)
+            return True
+
+        # Check if the token is valid.
+        if not hmac.compare_digest(self.get_hmac(message + chunks[0]),
+                                   chunks[1]):
+            return False
+
+        self.verified[key] = True
+        if len(self.verified) > self.cache_size:
+            self.verified.popitem(last=False)
+        return True
 
-    config = prologin.config.load('timeauth')
 
-    if not config['enabled']:
-        return True
+_verifiers = {}
 
-    if token is None:
-        return False
 
-    # Reject badly formatted tokens.
-    chunks = token.split(':')
-    if len(chunks) != 2:
-        return False
+def get_verifier(secret):
+    """Return the verifier for `secret`, creating it if needed."""
     try:
-        timestamp = int(chunks[0])
-    except ValueError:
-        return False
+        return _verifiers[secret]
+    except KeyError:
+        verifier = _verifiers[secret] = TokenVerifier(secret)
+        return verifier
 
-    # Reject outdated tokens.
-    if time.time() - timestamp > TOKEN_TIMEOUT:
-        return False
 
-    # Check if the token is valid.
-    return hmac.compare_digest(get_hmac(secret, str(message) + chunks[0]),
-                               chunks[1])
+def check_token(token, secret, message=None):
+    """Return if `token` is valid according to `secret` and current time."""
+    return get_verifier(secret).check(token, message)
 
 
 def get_hmac(secret, message):
     """Return a HMAC of `message` for some `secret`."""
     return hmac.new(
         secret,
-        message.encode('ascii'),
+        message.encode(),
         digestmod=hashlib.sha256
     ).hexdigest()
@@ -38,9 +38,8 @@ def signature_checked(secret_name, check_msg=False):
                 None
             )
             secret = getattr(self.application, secret_name)
-            if not prologin.timeauth.check_token(
-                self.get_argument('hmac'), secret, msg
-            ):
+            verifier = prologin.timeauth.get_verifier(secret)
+            if not verifier.check(self.get_argument('hmac'), msg):
                 logging.error('INVALID TOKEN!')
                 self.set_status(403, 'Invalid token')
                 self.write('Invalid token')
@@ -17,6 +17,7 @@
 import logging
 import prologin.log
 import prologin.udbsync.client
+import prologin.rpc.server
 import queue
 import threading
 
@@ -56,14 +57,23 @@ class UpdateSenderTask(threading.Thread):
 
 _update_sender = UpdateSenderTask()
 
+# Responses of the cacheable UDB methods. Changes made by other processes
+# (e.g. management commands) do not go through these receivers, hence the
+# short TTL.
+response_cache = prologin.rpc.server.ResponseCache(ttl=5)
+
 @receiver(post_save)
 def post_save_handler(sender, instance, created, *args, **kwargs):
+    if sender in (User,):
+        response_cache.invalidate()
     if sender is not User:
         return
     _update_sender.send({ "type": "update", "data": instance.to_dict() })
 
 @receiver(pre_delete)
 def pre_delete_handler(sender, instance, *args, **kwargs):
+    if sender in (User,):
+        response_cache.invalidate()
     if sender is not User:
         return
     _update_sender.send({ "type": "delete", "data": instance.to_dict() })
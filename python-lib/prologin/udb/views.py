@@ -27,7 +27,9 @@ CFG = prologin.config.load('udb-client-auth')
 class UDBServer(prologin.rpc.server.BaseRPCApp):
     def __init__(self, *args, **kwargs):
         secret = CFG['shared_secret'].encode()
-        super().__init__(*args, secret=secret, **kwargs)
+        super().__init__(
+            *args, secret=secret,
+            response_cache=prologin.udb.receivers.response_cache, **kwargs)
 
     def get_users(self, **kwargs):
         fields = {'login', 'uid', 'group', 'shell', 'ssh_key', 'id'}
@@ -36,13 +38,13 @@ class UDBServer(prologin.rpc.server.BaseRPCApp):
         users = [m.to_dict() for m in users]
         return users
 
-    @prologin.rpc.remote_method(auth_required=False)
+    @prologin.rpc.remote_method(auth_required=False, cacheable=True)
     async def query(self, **kwargs):
         users = self.get_users(**kwargs)
         for u in users:
             del u['password']
         return users
 
-    @prologin.rpc.remote_method
+    @prologin.rpc.remote_method(cacheable=True)
     async def query_private(self, **kwargs):
         return self.get_users(**kwargs)
@@ -40,3 +40,10 @@ def connect(pub=False):
     return prologin.synchronisation.Client(
         url, 'login', pub_secret, sub_secret
     )
+
+
+def connect_async():
+    """Return an AsyncClient subscribing to the UDBSync server."""
+    return prologin.synchronisation.AsyncClient(
+        SUB_CFG['url'], 'login', SUB_CFG['shared_secret']
+    )
@@ -35,9 +35,9 @@ if 'shared_secret' not in SUB_CFG:
 
 
 class SyncServer(prologin.synchronisation.Server):
-    def __init__(self, pub_secret, sub_secret, port):
+    def __init__(self, pub_secret, sub_secret, port, **kwargs):
         super(SyncServer, self).__init__(
-            'login', pub_secret, sub_secret, port, 'udbsync',
+            'login', pub_secret, sub_secret, port, 'udbsync', **kwargs
         )
 
     def get_initial_backlog(self):
@@ -53,6 +53,7 @@ if __name__ == '__main__':
     server = SyncServer(
         PUB_CFG['shared_secret'],
         SUB_CFG['shared_secret'],
-        port
+        port,
+        **prologin.synchronisation.server_options(PUB_CFG)
     )
     server.start()
@@ -22,6 +22,7 @@ import os
 import prologin.config
 import prologin.log
 import prologin.presenced.client
+import prologin.synchronisation
 import prologin.udbsync.client
 import re
 import shutil
@@ -256,4 +257,6 @@ if __name__ == '__main__':
         root_path = sys.argv[1]
     prologin.log.setup_logging('udbsync_passwd({})'.format(root_path))
     callback = functools.partial(callback, root_path)
-    prologin.udbsync.client.connect().poll_updates(callback)
+    prologin.udbsync.client.connect().poll_updates(
+        callback, cache_path=prologin.synchronisation.cache_path('udbsync'),
+        debounce=1)
@@ -13,7 +13,7 @@
 
 """Utilities for Web API."""
 
-import json
+import prologin.jsoncodec
 import prologin.timeauth
 import requests
 import urllib.parse
@@ -31,8 +31,8 @@ class Client:
         default URL if `url` is None. Return the request object.
         """
         try:
-            data = json.dumps(msg)
-        except TypeError:
+            data = prologin.jsoncodec.dumps(msg)
+        except prologin.jsoncodec.EncodeError:
             raise ValueError('non serializable argument type')
 
         full_url = urllib.parse.urljoin(url or self.url, resource)
@@ -28,7 +28,6 @@ import tempfile
 import textwrap
 import yaml
 
-from base64 import b64decode, b64encode
 from camisole import isolate
 
 ioloop = asyncio.get_event_loop()
@@ -52,7 +51,7 @@ def create_file_opts(file_opts):
     files = []
     for l, content in file_opts.items():
         f = tempfile.NamedTemporaryFile()
-        f.write(b64decode(content))
+        f.write(content)
         f.flush()
         os.chmod(f.name, 0o644)
         opts.append(l)
@@ -90,7 +89,6 @@ async def compile_champion(config, ctgz):
     Compiles the champion contained in ctgz and returns a tuple TODO
 
     """
-    ctgz = b64decode(ctgz)
     code_dir = os.path.abspath(os.path.dirname(__file__))
     compile_script = os.path.join(code_dir, 'compile-champion.sh')
 
@@ -126,8 +124,7 @@ async def compile_champion(config, ctgz):
         except FileNotFoundError:
             pass
 
-    b64compiled = b64encode(compilation_content).decode()
-    return ret, b64compiled, log
+    return ret, compilation_content, log
 
 
 async def spawn_server(config, rep_addr, pub_addr, nb_players, sockets_dir,
@@ -280,7 +277,6 @@ async def spawn_match(config, players, opts=None, file_opts=None):
 
     # Sort by MatchPlayer id
     for oid, (pl_id, (c_id, ctgz)) in enumerate(sorted(players.items()), 1):
-        ctgz = b64decode(ctgz)
         cdir = tempfile.TemporaryDirectory()
         champion_dirs.append(cdir)
         untar(ctgz, cdir.name)
@@ -301,7 +297,6 @@ async def spawn_match(config, players, opts=None, file_opts=None):
 
     # Get the output of the tasks
     server_out, dump = task_server.result()
-    dump = b64encode(dump).decode()
     players_info = {
         pl_id: (
             players[pl_id][0],  # champion_id
@@ -17,10 +17,13 @@
 # You should have received a copy of the GNU General Public License
 # along with Prologin-SADM.  If not, see <http://www.gnu.org/licenses/>.
 
+import aiohttp
 import asyncio
 import functools
+import io
 import logging
 import logging.handlers
+import prologin.rpc.channel
 import prologin.rpc.client
 import prologin.rpc.server
 import socket
@@ -65,6 +68,7 @@ class WorkerNode(prologin.rpc.server.BaseRPCApp):
         super().__init__(*args, secret=secret, **kwargs)
         self.config = config
         self.interval = config['master']['heartbeat_secs']
+        self.retry_max_delay = config['master'].get('retry_max_delay', 300)
         self.hostname = socket.gethostname()
         self.port = config['worker']['port']
         self.slots = self.max_slots = config['worker']['available_slots']
@@ -75,6 +79,8 @@ class WorkerNode(prologin.rpc.server.BaseRPCApp):
     def run(self):
         logging.info('worker listening on %s', self.config['worker']['port'])
         asyncio.Task(self.send_heartbeat())
+        if self.config['master'].get('channel', False):
+            asyncio.Task(self.channel_task())
         super().run(port=self.config['worker']['port'])
 
     def stop(self):
@@ -87,7 +93,7 @@ class WorkerNode(prologin.rpc.server.BaseRPCApp):
         config = self.config
         host, port = (config['master']['host'], config['master']['port'])
         url = "http://{}:{}/".format(host, port)
-        return prologin.rpc.client.Client(
+        return prologin.rpc.channel.ChannelClient(
             url, secret=config['master']['shared_secret'].encode('utf-8'))
 
     async def update_master(self):
@@ -111,6 +117,35 @@ class WorkerNode(prologin.rpc.server.BaseRPCApp):
 
             await asyncio.sleep(self.interval)
 
+    async def channel_task(self):
+        """Keep a channel to the master open: calls in both directions go
+        through it instead of separate HTTP requests while it is open.
+        """
+        attempt = 0
+        while True:
+            try:
+                channel = await prologin.rpc.channel.connect(
+                    self.master.base_url, self.master.secret,
+                    self.dispatch_call,
+                    params={'hostname': self.hostname, 'port': self.port},
+                    heartbeat=self.interval)
+            except (socket.error, asyncio.TimeoutError,
+                    aiohttp.ClientError) as e:
+                delay = prologin.rpc.client.backoff_delay(attempt, 1, 60)
+                logging.warning('cannot open a channel to the master (%r), '
+                                'retrying in %.1fs', e, delay)
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+
+            logging.info('channel to the master opened')
+            attempt = 0
+            self.master.channel = channel
+            await channel.run()
+            self.master.channel = None
+            logging.warning('channel to the master closed')
+            await asyncio.sleep(prologin.rpc.client.backoff_delay(0, 1))
+
     @prologin.rpc.remote_method
     async def reachable(self):
         return True
@@ -127,9 +162,12 @@ class WorkerNode(prologin.rpc.server.BaseRPCApp):
                 self.get_worker_infos(),
                 cid, user, ret, compiled, log,
                 max_retries=self.config['master']['max_retries'],
-                retry_delay=self.config['master']['retry_delay'])
+                retry_delay=self.config['master']['retry_delay'],
+                retry_max_delay=self.retry_max_delay)
         except socket.error:
             logging.warning('master down, cannot send compiled %s', cid)
+        except prologin.rpc.client.ServerBusy:
+            logging.warning('master busy, cannot send compiled %s', cid)
 
         workernode_compile_champion_summary.observe(
             max(time.monotonic() - compile_champion_start, 0))
@@ -147,11 +185,15 @@ class WorkerNode(prologin.rpc.server.BaseRPCApp):
         try:
             await self.master.match_done(
                 self.get_worker_infos(),
-                match_id, server_result, dump, server_out, players_info,
+                match_id, server_result, server_out, players_info,
+                dumper_stdout=io.BytesIO(dump),
                 max_retries=self.config['master']['max_retries'],
-                retry_delay=self.config['master']['retry_delay'])
+                retry_delay=self.config['master']['retry_delay'],
+                retry_max_delay=self.retry_max_delay)
         except socket.error:
             logging.warning('master down, cannot send match %s result', match_id)
+        except prologin.rpc.client.ServerBusy:
+            logging.warning('master busy, cannot send match %s result', match_id)
 
         workernode_run_match_summary.observe(
             max(time.monotonic() - run_match_start, 0))